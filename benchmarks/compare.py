@@ -0,0 +1,55 @@
+"""Compares two result files of benchmarks.load or benchmarks.micro, e.g. from two commits.
+
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+
+
+def change(before, after):
+    if not before or after is None:
+        return ""
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def compare_load(before, after):
+    print(f"{'endpoint':<46} {'req/s':>10} {'':>8} {'p95 ms':>10} {'':>8} {'p99 ms':>10} {'':>8}")
+    rows = [("total", before["total"], after["total"])]
+    rows += [(name, stats, after["endpoints"].get(name, {})) for name, stats in before["endpoints"].items()]
+    for name, old, new in rows:
+        print(f"{name:<46} {new.get('throughput') or 0:>10.1f} {change(old['throughput'], new.get('throughput')):>8}"
+              f" {new.get('p95_ms') or 0:>10.2f} {change(old['p95_ms'], new.get('p95_ms')):>8}"
+              f" {new.get('p99_ms') or 0:>10.2f} {change(old['p99_ms'], new.get('p99_ms')):>8}")
+
+
+def compare_micro(before, after):
+    print(f"{'benchmark':<54} {'ops/s':>14} {'':>8}")
+    for name, old in before.get("micro", {}).items():
+        new = after.get("micro", {}).get(name, {})
+        print(f"{name:<54} {new.get('ops_per_second') or 0:>14.1f}"
+              f" {change(old['ops_per_second'], new.get('ops_per_second')):>8}")
+    for name, old in before.get("tasks", {}).items():
+        new = after.get("tasks", {}).get(name, {})
+        if "mean_seconds" in old:
+            print(f"{name:<54} {new.get('mean_seconds') or 0:>13.4f}s"
+                  f" {change(old['mean_seconds'], new.get('mean_seconds')):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+    print(f"{before['meta'].get('commit')} -> {after['meta'].get('commit')}")
+    if "endpoints" in before:
+        compare_load(before, after)
+    else:
+        compare_micro(before, after)
+
+
+if __name__ == '__main__':
+    main()
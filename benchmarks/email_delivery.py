@@ -0,0 +1,91 @@
+"""Messages per second sent to a local aiosmtpd server, one connection per message versus the pooled mailer.
+
+`--latency-ms` delays every reply to DATA, standing in for a remote SMTP server.
+
+    python -m benchmarks.email_delivery --messages 2000 --concurrency 8 --latency-ms 20
+"""
+import argparse
+import asyncio
+import socket
+import time
+
+from aiosmtpd.controller import Controller
+
+from benchmarks.results import metadata, write_results
+from src.mailer import Mailer, SmtpPool, Email
+
+
+class SlowHandler:
+    def __init__(self, latency_seconds):
+        self.latency_seconds = latency_seconds
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.latency_seconds)
+        self.received += 1
+        return "250 OK"
+
+
+class ConnectionPerMessage:
+    """The naive transport: a new SMTP connection for every message."""
+
+    def __init__(self, port):
+        self.port = port
+
+    def send(self, email):
+        pool = SmtpPool("127.0.0.1", self.port)
+        pool.send(email)
+        pool.close()
+
+    def close(self):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure(mailer, messages):
+    emails = [Email(f"patron{i}@example.com", "Overdue Book Reminder", f"Dear patron {i}") for i in range(messages)]
+    started = time.perf_counter()
+    stats = mailer.send_all(emails)
+    elapsed = time.perf_counter() - started
+    mailer.close()
+    return {"messages": messages, "sent": stats["sent"], "failed": stats["failed"],
+            "ops_per_second": round(stats["sent"] / elapsed, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=10)
+    parser.add_argument("--output", default="email-delivery-results.json")
+    args = parser.parse_args()
+
+    controller = Controller(SlowHandler(args.latency_ms / 1000), hostname="127.0.0.1", port=free_port())
+    controller.start()
+    try:
+        micro = {
+            "connection per message, serial": measure(
+                Mailer(ConnectionPerMessage(controller.port), concurrency=1, rate_per_second=0), args.messages),
+            f"pooled, {args.concurrency} concurrent": measure(
+                Mailer(SmtpPool("127.0.0.1", controller.port), concurrency=args.concurrency, rate_per_second=0),
+                args.messages),
+        }
+    finally:
+        controller.stop()
+    results = {
+        "meta": metadata(kind="micro", messages=args.messages, concurrency=args.concurrency,
+                         latency_ms=args.latency_ms),
+        "micro": micro,
+    }
+    write_results(args.output, results)
+    for name, stats in micro.items():
+        print(f"{name:<34} {stats['ops_per_second']:>10,.1f} messages/s  failed {stats['failed']}")
+
+
+if __name__ == '__main__':
+    main()
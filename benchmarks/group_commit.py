@@ -0,0 +1,105 @@
+"""Creates per second under concurrent `POST /books/` and `POST /patrons/`, with and without group commit.
+
+"Per-request commit" is the default, one INSERT and one commit per request. "Group commit" batches the concurrent
+creates as GROUP_COMMIT_WINDOW_MS and GROUP_COMMIT_MAX_ROWS would. The database is recreated for every run.
+
+    python -m benchmarks.group_commit --database-url sqlite:///./bench_group_commit.db --concurrency 64
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from benchmarks.results import latency_stats, metadata, write_results
+from benchmarks.seed import seed
+from src import crud
+from src.database_config import DatabaseConfig
+from src.group_commit import GroupCommit
+
+
+async def create_concurrently(app, path, make_body, concurrency, requests):
+    """Sends `requests` creates from `concurrency` concurrent clients, returning their latencies and failures."""
+    latencies = []
+    failures = 0
+    remaining = iter(range(requests))
+
+    async def client_loop(client):
+        nonlocal failures
+        for number in remaining:
+            started = time.perf_counter()
+            response = await client.post(path, json=make_body(number))
+            latencies.append(time.perf_counter() - started)
+            failures += response.status_code != 200
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, elapsed, failures
+
+
+def measure(app_module, database_url, async_mode, path, make_body, concurrency, requests):
+    seed(database_url, books=0, patrons=0)
+    config = DatabaseConfig(database_url=database_url, async_mode=async_mode)
+    app_module.app.dependency_overrides[app_module.database_config.get_db] = config.get_db
+
+    async def run():
+        try:
+            return await create_concurrently(app_module.app, path, make_body, concurrency, requests)
+        finally:
+            if config.async_engine is not None:
+                await config.async_engine.dispose()
+
+    latencies, elapsed, failures = asyncio.run(run())
+    config.engine.dispose()
+    stats = latency_stats(latencies, elapsed)
+    return {"ops_per_second": stats["throughput"], "failures": failures, **stats}
+
+
+def book(number):
+    return {"title": f"Book {number}", "author": "Author", "published_year": 2000}
+
+
+def patron(number):
+    return {"name": f"Patron {number}", "email": f"patron{number}@example.com"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="sqlite:///./bench_group_commit.db")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="Use the AsyncSession path")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=5000, help="Creates per run")
+    parser.add_argument("--window-ms", type=float, default=2)
+    parser.add_argument("--max-rows", type=int, default=256)
+    parser.add_argument("--output", default="group-commit-results.json")
+    args = parser.parse_args()
+
+    # Imported after the arguments are read, the app's own database settings are replaced by the benchmark database
+    import main as app_module
+
+    modes = {
+        "per-request commit": (GroupCommit(crud.create_books), GroupCommit(crud.create_patrons)),
+        "group commit": (GroupCommit(crud.create_books, args.window_ms / 1000, args.max_rows),
+                         GroupCommit(crud.create_patrons, args.window_ms / 1000, args.max_rows)),
+    }
+    micro = {}
+    for mode, (book_commits, patron_commits) in modes.items():
+        app_module.book_commits, app_module.patron_commits = book_commits, patron_commits
+        for path, make_body in (("/books/", book), ("/patrons/", patron)):
+            micro[f"POST {path}, {mode}"] = measure(app_module, args.database_url, args.async_mode, path, make_body,
+                                                    args.concurrency, args.requests)
+    results = {
+        "meta": metadata(kind="micro", concurrency=args.concurrency, requests=args.requests,
+                         window_ms=args.window_ms, max_rows=args.max_rows, async_mode=args.async_mode),
+        "micro": micro,
+    }
+    write_results(args.output, results)
+    for name, stats in micro.items():
+        print(f"{name:<36} {stats['ops_per_second']:>10,.1f} creates/s  p99 {stats['p99_ms']:>8.2f} ms"
+              f"  failures {stats['failures']}")
+
+
+if __name__ == '__main__':
+    main()
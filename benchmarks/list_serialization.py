@@ -0,0 +1,90 @@
+"""Requests per second of `GET /books` pages over a 50k-row table, before and after the serialization fast path.
+
+"Before" is the original endpoint: ORM objects validated against `response_model` and encoded with the standard
+JSON encoder. "After" is the endpoint of main.py, which reads column rows and encodes them with orjson.
+
+    python -m benchmarks.list_serialization --database-url sqlite:///./bench_list.db --books 50000 --limit 500
+"""
+import argparse
+import asyncio
+import time
+from typing import Optional
+
+import httpx
+from fastapi import FastAPI, Depends
+
+from benchmarks.results import metadata, write_results
+from benchmarks.seed import seed
+from src.database_config import DatabaseConfig
+from src.model import Book
+from src.model_dto import PageDto, BookDto
+from src.pagination import paginate
+
+
+def legacy_app(config):
+    legacy = FastAPI()
+
+    @legacy.get("/books", response_model=PageDto[BookDto])
+    async def list_books(limit: int = 50, cursor: Optional[str] = None, db=Depends(config.get_db)):
+        return await db.run(lambda session: paginate(session.query(Book), Book.id, limit, cursor))
+
+    return legacy
+
+
+async def walk_pages(app, limit, rounds):
+    """Reads every page of the books list `rounds` times, returning the number of requests and rows."""
+    requests = rows = 0
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        for _ in range(rounds):
+            cursor = None
+            while True:
+                params = {"limit": limit, **({"cursor": cursor} if cursor else {})}
+                page = (await client.get("/books", params=params)).json()
+                requests += 1
+                rows += len(page["items"])
+                cursor = page["next_cursor"]
+                if cursor is None:
+                    break
+    return requests, rows
+
+
+def measure(app, limit, rounds):
+    asyncio.run(walk_pages(app, limit, 1))
+    started = time.perf_counter()
+    requests, rows = asyncio.run(walk_pages(app, limit, rounds))
+    elapsed = time.perf_counter() - started
+    return {"requests": requests, "ops_per_second": round(requests / elapsed, 1),
+            "rows_per_second": round(rows / elapsed), "mean_ms": round(elapsed / requests * 1000, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="sqlite:///./bench_list.db")
+    parser.add_argument("--books", type=int, default=50000)
+    parser.add_argument("--limit", type=int, default=500, help="Page size")
+    parser.add_argument("--rounds", type=int, default=3, help="Times the whole list is read")
+    parser.add_argument("--output", default="list-serialization-results.json")
+    args = parser.parse_args()
+
+    seed(args.database_url, books=args.books, patrons=max(1, args.books // 50))
+    config = DatabaseConfig(database_url=args.database_url)
+    # Imported after seeding, the app's own database settings are replaced by the benchmark database
+    import main as app_module
+
+    app_module.app.dependency_overrides[app_module.database_config.get_db] = config.get_db
+    app_module.app.dependency_overrides[app_module.database_config.get_read_db] = config.get_read_db
+    results = {
+        "meta": metadata(kind="micro", books=args.books, limit=args.limit, rounds=args.rounds),
+        "micro": {
+            "GET /books, before": measure(legacy_app(config), args.limit, args.rounds),
+            "GET /books, after": measure(app_module.app, args.limit, args.rounds),
+        },
+    }
+    config.engine.dispose()
+    write_results(args.output, results)
+    for name, stats in results["micro"].items():
+        print(f"{name:<20} {stats['ops_per_second']:>8,.1f} req/s {stats['rows_per_second']:>10,} rows/s")
+
+
+if __name__ == '__main__':
+    main()
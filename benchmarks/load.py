@@ -0,0 +1,359 @@
+"""Load test driving every route of the API with a mixed, reproducible workload.
+
+Seed a database first, since the workload changes the data it runs on:
+
+    python -m benchmarks.seed --database-url sqlite:///./bench.db --books 100000 --patrons 5000
+    python -m benchmarks.load --database-url sqlite:///./bench.db --target asgi --output asgi.json
+    python -m benchmarks.load --database-url sqlite:///./bench.db --target uvicorn --workers 1 --output uvicorn.json
+    python -m benchmarks.compare before.json after.json
+
+`asgi` calls the app in-process, which measures the application without any HTTP server. `uvicorn` starts a real
+server on `--port`, and `url` targets an already running server at `--url`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque, Counter
+from contextlib import asynccontextmanager
+
+import httpx
+from sqlalchemy import create_engine, func, select
+
+from benchmarks.results import latency_stats, metadata, write_results
+from benchmarks.seed import ISBNS
+from src.model import Book, Patron
+
+CHECKED_OUT_SAMPLE_SIZE = 10000
+BULK_ROWS = 100
+BULK_CHECKOUT_BOOKS = 5
+LOOKUP_IDS = 50
+SERVER_START_TIMEOUT_SECONDS = 30
+
+
+class Workload:
+    """Picks weighted random requests that together call every route of the API.
+
+    Only books and patrons created by the workload itself are deleted, so the seeded data keeps its size.
+    """
+
+    def __init__(self, max_book_id, max_patron_id, checked_out_ids=(), random_seed=0):
+        self.rng = random.Random(random_seed)
+        self.max_book_id = max(max_book_id, 1)
+        self.max_patron_id = max(max_patron_id, 1)
+        self.created_books = []
+        self.created_patrons = []
+        # Books known to be checked out, which the return requests take from
+        self.loans = deque(checked_out_ids)
+        self.operations = [
+            ("GET /", 1, self.read_root),
+            ("GET /cache/stats", 0.5, self.cache_stats),
+            ("POST /books/", 3, self.create_book),
+            ("POST /books/bulk", 0.1, self.bulk_create_books),
+            ("GET /books", 8, self.list_books),
+            ("GET /books/search", 6, self.search_books),
+            ("GET /books/{book_id}", 30, self.get_book),
+            ("GET /books?ids", 4, self.get_books),
+            ("PUT /books/{book_id}", 3, self.update_book),
+            ("DELETE /books/{book_id}", 1, self.delete_book),
+            ("POST /patrons/", 2, self.create_patron),
+            ("POST /patrons/bulk", 0.1, self.bulk_create_patrons),
+            ("GET /patrons", 3, self.list_patrons),
+            ("GET /patrons/{patron_id}", 10, self.get_patron),
+            ("PUT /patrons/{patron_id}", 1, self.update_patron),
+            ("DELETE /patrons/{patron_id}", 0.5, self.delete_patron),
+            ("POST /checkout/{book_id}/patron/{patron_id}", 6, self.checkout_book),
+            ("POST /checkout/bulk", 1, self.checkout_books),
+            ("POST /return/{book_id}", 6, self.return_book),
+            ("GET /books/checkedout/", 3, self.list_checked_out_books),
+            ("GET /books/overdue/", 3, self.list_overdue_books),
+            ("GET /books/patron/{patron_id}", 4, self.list_books_by_patron),
+            ("GET /patrons/{patron_id}/loans", 2, self.list_patron_loans),
+            ("GET /books/{book_id}/loans", 2, self.list_book_loans),
+            ("GET /reports", 1, self.list_reports),
+        ]
+        self._weights = [weight for _, weight, _ in self.operations]
+
+    @classmethod
+    def from_database(cls, database_url, random_seed=0):
+        engine = create_engine(database_url)
+        with engine.connect() as connection:
+            max_book_id = connection.scalar(select(func.max(Book.id))) or 0
+            max_patron_id = connection.scalar(select(func.max(Patron.id))) or 0
+            checked_out_ids = connection.scalars(select(Book.id).where(Book.is_checked_out)
+                                                 .limit(CHECKED_OUT_SAMPLE_SIZE)).all()
+        engine.dispose()
+        return cls(max_book_id, max_patron_id, checked_out_ids, random_seed)
+
+    def next_operation(self):
+        return self.rng.choices(self.operations, weights=self._weights)[0]
+
+    def book_id(self):
+        return self.rng.randint(1, self.max_book_id)
+
+    def patron_id(self):
+        return self.rng.randint(1, self.max_patron_id)
+
+    def word(self, length):
+        return "".join(self.rng.choices(string.ascii_lowercase, k=length))
+
+    def book(self):
+        return {"title": self.word(8).capitalize(), "author": self.word(6).capitalize(),
+                "isbn": self.rng.choice(ISBNS), "published_year": self.rng.randint(1900, 2024)}
+
+    def patron(self):
+        return {"name": self.word(8).capitalize(), "email": f"{self.word(10)}@example.com"}
+
+    def ndjson(self, rows):
+        return "\n".join(json.dumps(row) for row in rows)
+
+    async def read_root(self, client):
+        return await client.get("/")
+
+    async def cache_stats(self, client):
+        return await client.get("/cache/stats")
+
+    async def create_book(self, client):
+        response = await client.post("/books/", json=self.book())
+        if response.status_code == 200:
+            self.created_books.append(response.json()["id"])
+        return response
+
+    async def bulk_create_books(self, client):
+        return await client.post("/books/bulk", content=self.ndjson(self.book() for _ in range(BULK_ROWS)))
+
+    async def list_books(self, client):
+        filters = self.rng.choice([
+            {},
+            {"title_prefix": self.word(2).capitalize()},
+            {"published_year_min": 1990, "published_year_max": 2000},
+            {"is_checked_out": self.rng.choice(["true", "false"])},
+        ])
+        return await client.get("/books", params=filters)
+
+    async def search_books(self, client):
+        return await client.get("/books/search", params={"q": self.word(self.rng.randint(2, 3))})
+
+    async def get_book(self, client):
+        return await client.get(f"/books/{self.book_id()}")
+
+    async def get_books(self, client):
+        # A patron's shelf, rendered with one lookup instead of a GET per book
+        book_ids = ",".join(str(self.book_id()) for _ in range(LOOKUP_IDS))
+        return await client.get("/books", params={"ids": book_ids, "fields": "id,title,is_checked_out,due_date"})
+
+    async def update_book(self, client):
+        return await client.put(f"/books/{self.book_id()}", json={"published_year": self.rng.randint(1900, 2024)})
+
+    async def delete_book(self, client):
+        if not self.created_books:
+            return None
+        return await client.delete(f"/books/{self.created_books.pop()}")
+
+    async def create_patron(self, client):
+        response = await client.post("/patrons/", json=self.patron())
+        if response.status_code == 200:
+            self.created_patrons.append(response.json()["id"])
+        return response
+
+    async def bulk_create_patrons(self, client):
+        return await client.post("/patrons/bulk", content=self.ndjson(self.patron() for _ in range(BULK_ROWS)))
+
+    async def list_patrons(self, client):
+        params = self.rng.choice([{}, {"name_prefix": self.word(1).capitalize()}])
+        return await client.get("/patrons", params=params)
+
+    async def get_patron(self, client):
+        return await client.get(f"/patrons/{self.patron_id()}")
+
+    async def update_patron(self, client):
+        phone_number = f"555{self.rng.randint(0, 9999999):07d}"
+        return await client.put(f"/patrons/{self.patron_id()}", json={"phone_number": phone_number})
+
+    async def delete_patron(self, client):
+        if not self.created_patrons:
+            return None
+        return await client.delete(f"/patrons/{self.created_patrons.pop()}")
+
+    async def checkout_book(self, client):
+        book_id = self.book_id()
+        response = await client.post(f"/checkout/{book_id}/patron/{self.patron_id()}")
+        if response.status_code == 200:
+            self.loans.append(book_id)
+        return response
+
+    async def checkout_books(self, client):
+        book_ids = [self.book_id() for _ in range(BULK_CHECKOUT_BOOKS)]
+        response = await client.post("/checkout/bulk", json={"patron_id": self.patron_id(), "book_ids": book_ids})
+        if response.status_code == 200:
+            self.loans.extend(result["book_id"] for result in response.json() if result["status"] == "checked_out")
+        return response
+
+    async def return_book(self, client):
+        if not self.loans:
+            return None
+        return await client.post(f"/return/{self.loans.popleft()}")
+
+    async def list_checked_out_books(self, client):
+        return await client.get("/books/checkedout/", params={"sort": self.rng.choice(["id", "due_date"])})
+
+    async def list_overdue_books(self, client):
+        return await client.get("/books/overdue/", params={"sort": self.rng.choice(["id", "due_date"])})
+
+    async def list_books_by_patron(self, client):
+        return await client.get(f"/books/patron/{self.patron_id()}")
+
+    async def list_patron_loans(self, client):
+        return await client.get(f"/patrons/{self.patron_id()}/loans")
+
+    async def list_book_loans(self, client):
+        return await client.get(f"/books/{self.book_id()}/loans")
+
+    async def list_reports(self, client):
+        return await client.get("/reports")
+
+
+def is_error(status):
+    return not status.isdigit() or int(status) >= 500
+
+
+async def run_load(client, workload, concurrency, duration, warmup=0.0):
+    """Sends the workload's requests from `concurrency` concurrent workers for `warmup + duration` seconds.
+
+    Only requests started after the warmup are measured. Responses with a 5xx status and transport errors count
+    as errors, other statuses such as a conflicting checkout are part of a realistic workload.
+
+    Returns:
+        A dict with the overall and per endpoint throughput, latency percentiles and status counts.
+    """
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    measure_from = time.perf_counter() + warmup
+    stop = measure_from + duration
+
+    async def worker():
+        while time.perf_counter() < stop:
+            name, _, operation = workload.next_operation()
+            started = time.perf_counter()
+            try:
+                response = await operation(client)
+                if response is None:
+                    continue
+                status = str(response.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            if started >= measure_from:
+                latencies[name].append(time.perf_counter() - started)
+                statuses[name][status] += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - measure_from
+
+    endpoints = {}
+    for name, _, _ in workload.operations:
+        stats = latency_stats(latencies[name], elapsed)
+        stats["errors"] = sum(count for status, count in statuses[name].items() if is_error(status))
+        stats["statuses"] = dict(statuses[name])
+        endpoints[name] = stats
+    total = latency_stats([latency for values in latencies.values() for latency in values], elapsed)
+    total["errors"] = sum(stats["errors"] for stats in endpoints.values())
+    return {"total": total, "endpoints": endpoints, "elapsed_seconds": round(elapsed, 3)}
+
+
+@asynccontextmanager
+async def asgi_client():
+    # Imported here so that the app picks up the database settings from the environment
+    import main
+
+    # ASGITransport doesn't send lifespan events, so the startup and shutdown of the app are run here
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            yield client
+
+
+@asynccontextmanager
+async def url_client(url, concurrency):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        yield client
+
+
+@asynccontextmanager
+async def uvicorn_client(port, workers, concurrency):
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers),
+               "--log-level", "warning"]
+    process = subprocess.Popen(command, env=os.environ.copy())
+    try:
+        async with url_client(f"http://127.0.0.1:{port}", concurrency) as client:
+            await wait_until_ready(client, process)
+            yield client
+    finally:
+        process.terminate()
+        process.wait(timeout=SERVER_START_TIMEOUT_SECONDS)
+
+
+async def wait_until_ready(client, process):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with code {process.returncode}")
+        try:
+            if (await client.get("/readyz")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("uvicorn didn't start in time")
+
+
+def target_client(args):
+    if args.target == "asgi":
+        return asgi_client()
+    if args.target == "uvicorn":
+        return uvicorn_client(args.port, args.workers, args.concurrency)
+    return url_client(args.url, args.concurrency)
+
+
+async def main_async(args):
+    workload = Workload.from_database(args.database_url, args.seed)
+    async with target_client(args) as client:
+        results = await run_load(client, workload, args.concurrency, args.duration, args.warmup)
+    results["meta"] = metadata(kind="load", target=args.target, database=args.database_url.split(":")[0],
+                               async_mode=args.async_mode, concurrency=args.concurrency, duration=args.duration,
+                               warmup=args.warmup, workers=args.workers, seed=args.seed,
+                               books=workload.max_book_id, patrons=workload.max_patron_id)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", required=True, help="Database of the app, seeded with benchmarks.seed")
+    parser.add_argument("--target", choices=["asgi", "uvicorn", "url"], default="asgi")
+    parser.add_argument("--url", default="http://localhost:8081", help="Server of the `url` target")
+    parser.add_argument("--port", type=int, default=8091, help="Port of the `uvicorn` target")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes of the `uvicorn` target")
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="Use the AsyncSession database path")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=30, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds run before measuring")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the request mix")
+    parser.add_argument("--output", default="load-results.json")
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["DATABASE_ASYNC"] = "true" if args.async_mode else "false"
+    results = asyncio.run(main_async(args))
+    write_results(args.output, results)
+    total = results["total"]
+    print(f"{total['count']} requests, {total['throughput']} req/s, p50 {total['p50_ms']} ms, "
+          f"p95 {total['p95_ms']} ms, p99 {total['p99_ms']} ms, {total['errors']} errors -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Micro-benchmarks of DTO serialization, the validators and the Celery tasks, run eagerly.
+
+    python -m benchmarks.micro --database-url sqlite:///./bench_micro.db --books 100000 --output micro.json
+
+The database is reseeded before the tasks are measured.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+
+from benchmarks.results import metadata, write_results
+from benchmarks.seed import ISBNS, seed
+from src import util, validation
+from src.model import Book
+from src.model_dto import BookDto, BookCreateDto, PatronCreateDto, PageDto
+
+PAGE_SIZE = 500
+
+
+def measure(fn, iterations):
+    """Calls `fn` `iterations` times and returns its throughput."""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - started
+    return {"iterations": iterations, "ops_per_second": round(iterations / elapsed, 1),
+            "mean_us": round(elapsed / iterations * 1e6, 2)}
+
+
+def sample_books(count):
+    now = datetime.utcnow()
+    return [Book(id=i, title=f"Title {i}", author=f"Author {i % 100}", isbn=ISBNS[i % (len(ISBNS) - 1)],
+                 published_year=1900 + i % 120, is_checked_out=i % 5 == 0,
+                 due_date=now + timedelta(days=i % 14) if i % 5 == 0 else None,
+                 patron_id=i % 1000 if i % 5 == 0 else None, version=1)
+            for i in range(1, count + 1)]
+
+
+def dto_benchmarks(iterations):
+    books = sample_books(PAGE_SIZE)
+    page = {"items": books, "next_cursor": "eyJrIjpbNTAwXX0"}
+    book = books[0]
+    book_dto = BookDto.model_validate(book, from_attributes=True)
+    book_values = {"title": "1984", "author": "George Orwell", "isbn": "0-8436-1072-7", "published_year": 1949}
+    patron_values = {"name": "John Doe", "email": "john.doe@example.com"}
+    page_iterations = max(1, iterations // PAGE_SIZE)
+
+    def page_response():
+        # The path FastAPI takes for a response_model: validate, encode to JSON compatible data, dump
+        json.dumps(jsonable_encoder(PageDto[BookDto].model_validate(page, from_attributes=True)))
+
+    return {
+        "BookDto.model_validate(orm)": measure(lambda: BookDto.model_validate(book, from_attributes=True),
+                                               iterations),
+        "BookDto.model_dump(json)": measure(lambda: book_dto.model_dump(mode="json"), iterations),
+        "BookCreateDto.model_validate(dict)": measure(lambda: BookCreateDto.model_validate(book_values),
+                                                      iterations),
+        "PatronCreateDto.model_validate(dict)": measure(lambda: PatronCreateDto.model_validate(patron_values),
+                                                        iterations),
+        f"PageDto[BookDto] response, {PAGE_SIZE} books": measure(page_response, page_iterations),
+        f"PageDto[BookDto].model_dump_json, {PAGE_SIZE} books": measure(
+            lambda: PageDto[BookDto].model_validate(page, from_attributes=True).model_dump_json(), page_iterations),
+    }
+
+
+def validator_benchmarks(iterations):
+    isbns = iter(ISBNS[i % len(ISBNS)] or "123" for i in range(iterations))
+    cold_emails = iter(f"patron{i}@example.com" for i in range(iterations))
+    validation.clear_caches()
+    return {
+        "util.is_valid_isbn": measure(lambda: util.is_valid_isbn(next(isbns)), iterations),
+        "util.is_valid_email, distinct": measure(lambda: util.is_valid_email(next(cold_emails)), iterations),
+        "util.is_valid_email, repeated": measure(lambda: util.is_valid_email("john.doe@example.com"), iterations),
+    }
+
+
+class NullTransport:
+    def send(self, email):
+        pass
+
+    def close(self):
+        pass
+
+
+def task_benchmarks(database_url, books, patrons, runs):
+    seeded = seed(database_url, books, patrons)
+    os.environ["DATABASE_URL"] = database_url
+    # Imported here so that the tasks connect to the seeded database
+    from src import tasks
+    from src.mailer import Mailer
+
+    tasks.mailer = Mailer(NullTransport(), rate_per_second=0)
+    results = {"seeded": seeded}
+    for task in (tasks.send_overdue_reminders, tasks.generate_weekly_reports, tasks.reconcile_circulation_counters):
+        durations = []
+        result = None
+        for _ in range(runs):
+            started = time.perf_counter()
+            result = task.apply().get()
+            durations.append(time.perf_counter() - started)
+        results[task.name] = {"runs": runs, "mean_seconds": round(sum(durations) / runs, 4),
+                              "min_seconds": round(min(durations), 4), "result": result}
+    tasks.database_config.engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="sqlite:///./bench_micro.db",
+                        help="Database reseeded for the task benchmarks")
+    parser.add_argument("--books", type=int, default=100000)
+    parser.add_argument("--patrons", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=20000, help="Calls per DTO and validator measurement")
+    parser.add_argument("--task-runs", type=int, default=3)
+    parser.add_argument("--skip-tasks", action="store_true")
+    parser.add_argument("--output", default="micro-results.json")
+    args = parser.parse_args()
+
+    results = {"meta": metadata(kind="micro", iterations=args.iterations, books=args.books, patrons=args.patrons),
+               "micro": {**dto_benchmarks(args.iterations), **validator_benchmarks(args.iterations)}}
+    if not args.skip_tasks:
+        results["tasks"] = task_benchmarks(args.database_url, args.books, args.patrons, args.task_runs)
+    write_results(args.output, results)
+    for name, stats in results["micro"].items():
+        print(f"{name:<50} {stats['ops_per_second']:>14,.1f} ops/s")
+    for name, stats in results.get("tasks", {}).items():
+        if name != "seeded":
+            print(f"{name:<50} {stats['mean_seconds']:>14.4f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import json
+import platform
+import subprocess
+from datetime import datetime
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, round(fraction * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def latency_stats(latencies, elapsed):
+    """Summarizes request latencies, in seconds, measured over `elapsed` seconds."""
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+        "p50_ms": _ms(percentile(latencies, 0.50)),
+        "p95_ms": _ms(percentile(latencies, 0.95)),
+        "p99_ms": _ms(percentile(latencies, 0.99)),
+        "max_ms": _ms(latencies[-1] if latencies else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(**settings):
+    return {"commit": git_commit(), "created_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "machine": platform.machine(), **settings}
+
+
+def write_results(path, results):
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+        file.write("\n")
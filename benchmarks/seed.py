@@ -0,0 +1,110 @@
+"""Seeds a database with a synthetic catalogue for benchmarking.
+
+    python -m benchmarks.seed --database-url sqlite:///./bench.db --books 100000 --patrons 5000 --checked-out 0.2
+
+Besides the open loans of the checked out books, `--returned-loans` past loans are added to the loan history.
+"""
+import argparse
+import random
+import string
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+from src import circulation
+from src.model import Base, Book, Patron, Loan
+
+ISBNS = ["0-8436-1072-7", "978-0-596-52068-7", "0-596-52068-9", "9780596520687", "007462542X", None]
+INSERT_BATCH_SIZE = 10000
+
+
+def words(rng, count):
+    return " ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))).capitalize()
+                    for _ in range(count))
+
+
+def seed(database_url, books=10000, patrons=1000, checked_out=0.2, overdue=0.25, random_seed=0,
+         returned_loans=None):
+    """Recreates the schema and fills it with `books` books and `patrons` patrons.
+
+    Args:
+        database_url: SQLAlchemy URL of the database to seed.
+        books: Number of books.
+        patrons: Number of patrons.
+        checked_out: Share of the books that are checked out.
+        overdue: Share of the checked out books that are overdue.
+        random_seed: Seed making the data reproducible.
+        returned_loans: Number of returned loans in the history, one per book by default.
+
+    Returns:
+        A dict describing the seeded data.
+    """
+    rng = random.Random(random_seed)
+    if returned_loans is None:
+        returned_loans = books if patrons else 0
+    engine = create_engine(database_url)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    session_local = sessionmaker(bind=engine)
+    now = datetime.utcnow()
+    authors = [words(rng, 2) for _ in range(max(1, books // 20))]
+    started = time.perf_counter()
+
+    with session_local() as db:
+        for start in range(0, patrons, INSERT_BATCH_SIZE):
+            db.execute(insert(Patron), [
+                {"name": words(rng, 2), "email": f"patron{i}@example.com", "phone_number": f"555{i:07d}",
+                 "membership_start_date": now - timedelta(days=rng.randint(0, 3650))}
+                for i in range(start, min(start + INSERT_BATCH_SIZE, patrons))
+            ])
+        for start in range(0, books, INSERT_BATCH_SIZE):
+            rows = []
+            loans = []
+            for book_id in range(start + 1, min(start + INSERT_BATCH_SIZE, books) + 1):
+                row = {"id": book_id, "title": words(rng, rng.randint(1, 4)), "author": rng.choice(authors),
+                       "isbn": rng.choice(ISBNS), "published_year": rng.randint(1900, 2024),
+                       "is_checked_out": False, "due_date": None, "patron_id": None}
+                if patrons and rng.random() < checked_out:
+                    days = -rng.randint(1, 60) if rng.random() < overdue else rng.randint(1, 14)
+                    row.update(is_checked_out=True, due_date=now + timedelta(days=days),
+                               patron_id=rng.randint(1, patrons))
+                    loans.append({"book_id": book_id, "patron_id": row["patron_id"], "due_date": row["due_date"],
+                                  "checked_out_at": row["due_date"] - timedelta(days=14), "returned_at": None})
+                rows.append(row)
+            db.execute(insert(Book), rows)
+            if loans:
+                db.execute(insert(Loan), loans)
+        for start in range(0, returned_loans, INSERT_BATCH_SIZE):
+            loans = []
+            for _ in range(start, min(start + INSERT_BATCH_SIZE, returned_loans)):
+                checked_out_at = now - timedelta(days=rng.randint(15, 1000), seconds=rng.randint(0, 86399))
+                loans.append({"book_id": rng.randint(1, books), "patron_id": rng.randint(1, patrons),
+                              "checked_out_at": checked_out_at, "due_date": checked_out_at + timedelta(days=14),
+                              "returned_at": checked_out_at + timedelta(days=rng.randint(1, 20))})
+            db.execute(insert(Loan), loans)
+        db.commit()
+        circulation.reconcile(db)
+    engine.dispose()
+    return {"books": books, "patrons": patrons, "checked_out": checked_out, "overdue": overdue,
+            "returned_loans": returned_loans,
+            "seconds": round(time.perf_counter() - started, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--books", type=int, default=10000)
+    parser.add_argument("--patrons", type=int, default=1000)
+    parser.add_argument("--checked-out", type=float, default=0.2, help="Share of books that are checked out")
+    parser.add_argument("--overdue", type=float, default=0.25, help="Share of checked out books that are overdue")
+    parser.add_argument("--returned-loans", type=int, default=None, help="Past loans, one per book by default")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(seed(args.database_url, args.books, args.patrons, args.checked_out, args.overdue, args.seed,
+               args.returned_loans))
+
+
+if __name__ == '__main__':
+    main()
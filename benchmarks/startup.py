@@ -0,0 +1,87 @@
+"""Cold start times: importing the app and the Celery tasks, and starting uvicorn until it is live and ready.
+
+Every measurement runs in a new interpreter, so modules are never already imported. Import times should stay flat
+when the database is slow or down, since nothing connects on import.
+
+    python -m benchmarks.startup --database-url sqlite:///./bench.db --runs 5
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.results import metadata, write_results
+
+SERVER_START_TIMEOUT_SECONDS = 30
+IMPORT_SCRIPT = "import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+
+
+def import_seconds(module, env, runs):
+    """Seconds taken by `import module` in a fresh interpreter, for each run."""
+    durations = []
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT.format(module=module)], env=env,
+                                   capture_output=True, text=True, check=True)
+        durations.append(float(completed.stdout.strip().splitlines()[-1]))
+    return durations
+
+
+def server_start_seconds(port, env):
+    """Seconds from launching uvicorn until `/healthz` and then `/readyz` answer 200."""
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"]
+    started = time.perf_counter()
+    process = subprocess.Popen(command, env=env)
+    reached = {}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=5) as client:
+            for probe in ("/healthz", "/readyz"):
+                while probe not in reached:
+                    if process.poll() is not None:
+                        raise RuntimeError(f"uvicorn exited with code {process.returncode}")
+                    if time.perf_counter() - started > SERVER_START_TIMEOUT_SECONDS:
+                        raise RuntimeError(f"{probe} didn't succeed in time")
+                    try:
+                        if client.get(probe).status_code == 200:
+                            reached[probe] = time.perf_counter() - started
+                            continue
+                    except httpx.TransportError:
+                        pass
+                    time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait(timeout=SERVER_START_TIMEOUT_SECONDS)
+    return reached["/healthz"], reached["/readyz"]
+
+
+def summary(durations):
+    return {"runs": len(durations), "mean_seconds": round(sum(durations) / len(durations), 4),
+            "min_seconds": round(min(durations), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="sqlite:///./bench_startup.db")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8092)
+    parser.add_argument("--output", default="startup-results.json")
+    args = parser.parse_args()
+
+    env = {**os.environ, "DATABASE_URL": args.database_url}
+    live, ready = zip(*(server_start_seconds(args.port, env) for _ in range(args.runs)))
+    micro = {
+        "import main": summary(import_seconds("main", env, args.runs)),
+        "import src.tasks": summary(import_seconds("src.tasks", env, args.runs)),
+        "uvicorn until /healthz": summary(live),
+        "uvicorn until /readyz": summary(ready),
+    }
+    write_results(args.output, {"meta": metadata(kind="micro", database=args.database_url.split(":")[0],
+                                                 runs=args.runs), "micro": micro})
+    for name, stats in micro.items():
+        print(f"{name:<24} mean {stats['mean_seconds'] * 1000:>8.1f} ms  min {stats['min_seconds'] * 1000:>8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Micro-benchmark of the ISBN and email validators, before and after caching.
+
+"Before" calls isbnlib and email_validator directly on every value, as the validators did originally. The
+deliverability mode is measured with a simulated DNS lookup of `--dns-latency-ms`, so the benchmark runs offline.
+
+    python -m benchmarks.validators --values 20000 --distinct 500
+"""
+import argparse
+import random
+import time
+
+from email_validator import validate_email, EmailNotValidError
+from isbnlib import is_isbn10, is_isbn13
+
+from src import validation
+
+ISBNS = ["0-8436-1072-7", "978-0-596-52068-7", "0-596-52068-9", "9780596520687", "007462542X", "123"]
+
+
+def uncached_isbn(isbn):
+    isbn = isbn.replace('-', '')
+    if len(isbn) == 10:
+        return is_isbn10(isbn)
+    return len(isbn) == 13 and is_isbn13(isbn)
+
+
+def uncached_email(email, dns_latency):
+    try:
+        validate_email(email, check_deliverability=False)
+    except EmailNotValidError:
+        return False
+    if dns_latency:
+        time.sleep(dns_latency)
+    return True
+
+
+def measure(name, fn, values):
+    started = time.perf_counter()
+    for value in values:
+        fn(value)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<40} {len(values) / elapsed:>14,.0f} validations/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--values", type=int, default=20000, help="Number of validations per measurement")
+    parser.add_argument("--distinct", type=int, default=500, help="Number of distinct emails among the values")
+    parser.add_argument("--domains", type=int, default=20, help="Number of distinct email domains")
+    parser.add_argument("--dns-latency-ms", type=float, default=20.0, help="Simulated DNS lookup latency")
+    args = parser.parse_args()
+
+    random.seed(0)
+    dns_latency = args.dns_latency_ms / 1000
+    emails = [f"patron{i}@library{i % args.domains}.com" for i in range(args.distinct)]
+    email_values = random.choices(emails, k=args.values)
+    isbn_values = random.choices(ISBNS, k=args.values)
+    # Deliverability without caching does a lookup per value, so it is measured on fewer values
+    dns_values = email_values[:100]
+
+    def simulated_lookup(ascii_domain, domain, timeout=None):
+        time.sleep(dns_latency)
+
+    validation.validate_email_deliverability = simulated_lookup
+    validation.clear_caches()
+
+    measure("isbn, before", uncached_isbn, isbn_values)
+    measure("isbn, after", validation.is_valid_isbn, isbn_values)
+    measure("email syntax, before", lambda email: uncached_email(email, 0), email_values)
+    measure("email syntax, after", lambda email: validation.is_valid_email(email, validation.SYNTAX), email_values)
+    measure("email deliverability, before", lambda email: uncached_email(email, dns_latency), dns_values)
+    measure("email deliverability, after",
+            lambda email: validation.is_valid_email(email, validation.DELIVERABILITY), email_values)
+
+    validation.clear_caches()
+    started = time.perf_counter()
+    validation.validate_emails(email_values, validation.DELIVERABILITY)
+    elapsed = time.perf_counter() - started
+    print(f"{'email deliverability, batch API':<40} {len(email_values) / elapsed:>14,.0f} validations/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,9 @@ celery_result_backend = os.getenv("CELERY_RESULT_BACKEND")
 overdue_reminder_hour = os.getenv("OVERDUE_REMINDER_HOUR", '6')
 generating_report_hour = os.getenv("GENERATING_REPORT_HOUR", '17')
 generating_report_minute = os.getenv("GENERATING_REPORT_MINUTE", '5')
+reconciling_counters_hour = os.getenv("RECONCILING_COUNTERS_HOUR", '3')
+exporting_hour = os.getenv("EXPORTING_HOUR", '2')
+export_format = os.getenv("EXPORT_FORMAT", 'parquet')
 
 app = Celery("library_tasks", broker=celery_broker_url, backend=celery_result_backend,
              include=["src.tasks"])
@@ -28,5 +31,21 @@ app.conf.update(
             'schedule': crontab(hour=generating_report_hour, minute='30', day_of_week='6'),
             # 'schedule': crontab(minute="*"),
         },
+        # Daily task correcting any drift of the circulation counters
+        'reconcile-circulation-counters': {
+            'task': 'src.tasks.reconcile_circulation_counters',
+            'schedule': crontab(hour=reconciling_counters_hour, minute='0'),
+        },
+        # Nightly exports of the catalogue for analytics, written to EXPORT_DIR
+        'export-books': {
+            'task': 'src.tasks.export_table',
+            'schedule': crontab(hour=exporting_hour, minute='0'),
+            'args': ('books', export_format),
+        },
+        'export-patrons': {
+            'task': 'src.tasks.export_table',
+            'schedule': crontab(hour=exporting_hour, minute='15'),
+            'args': ('patrons', export_format),
+        },
     },
 )
@@ -1,183 +1,551 @@
-import os
-from datetime import datetime, timedelta
-from typing import Optional
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Optional, Literal, Union
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, Depends, Header, WebSocket, WebSocketDisconnect
 from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.params import Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, ORJSONResponse, StreamingResponse
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
 
-from src.database_config import DatabaseConfig
-from src.model import Book, Patron
+from src import crud, validation, metrics, etags, export, events, profiling
+from src.admission import AdmissionController, AdmissionMiddleware
+from src.bulk_import import bulk_import
+from src.cache import EntityCache
+from src.config import DEFAULT_PAGE_LIMIT, MAX_PAGE_LIMIT, MAX_LOOKUP_IDS, BULK_IMPORT_BATCH_SIZE, \
+    BULK_IMPORT_MAX_BATCH_SIZE, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, SSE_KEEPALIVE_SECONDS, READY_TIMEOUT_SECONDS
+from src.crud import CrudError
+from src.database_config import DatabaseConfig, DatabaseSession, ReadYourWritesMiddleware, env_flag, env_int, \
+    reads_own_writes
+from src.events import EventBroker
+from src.group_commit import GroupCommit
+from src.responses import page_response, dto_values, lookup_response
+from src.search import BookSearch
 from src.model_dto import BookCreateDto, BookUpdateDto, BookDto, PatronDto, PatronUpdateDto, \
-    PatronCreateDto
+    PatronCreateDto, PageDto, LookupDto, BulkImportResultDto, ReportDto, BulkCheckoutDto, BulkCheckoutResultDto, \
+    LoanDto
 
 load_dotenv()
 
-database_url = os.getenv("DATABASE_URL")
-database_config = DatabaseConfig(database_url=database_url)
-
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+database_config = DatabaseConfig.from_env()
+entity_cache = EntityCache.from_env()
+book_search = BookSearch.from_env()
+# Opt-in batching of concurrent creates into shared transactions
+book_commits = GroupCommit.from_env(crud.create_books)
+patron_commits = GroupCommit.from_env(crud.create_patrons)
+event_broker = EventBroker.from_env()
+admission_controller = AdmissionController.from_env()
+request_profiler = profiling.Profiler.from_env("SLOW_REQUEST_MS")
+
+
+def track_engines():
+    for engine_name, engine in (("sync", database_config.engine), ("async", database_config.async_engine)):
+        if engine is not None:
+            metrics.track_engine(engine_name, engine)
+    for replica_number, replica in enumerate(database_config.replicas):
+        metrics.track_engine(f"replica{replica_number}", replica.engine)
+        if replica.async_engine is not None:
+            metrics.track_engine(f"replica{replica_number}_async", replica.async_engine)
+
+
+async def prewarm_pool(connections: int):
+    started = time.perf_counter()
+    try:
+        if database_config.async_mode:
+            await database_config.prewarm_async(connections)
+        else:
+            await run_in_threadpool(database_config.prewarm, connections)
+        logger.info(f"Opened {connections} database connection(s) in {time.perf_counter() - started:.3f} s")
+    except SQLAlchemyError as e:
+        logger.warning(f"Couldn't prewarm the connection pool: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Creates the engines when the server starts rather than on import, and disposes of them when it stops.
+
+    The schema is created by `python -m src.schema`, or here with `CREATE_SCHEMA_ON_STARTUP`. The pool is prewarmed
+    in the background, `/readyz` fails until it is done.
+    """
+    database_config.init_engines()
+    track_engines()
+    if env_flag("CREATE_SCHEMA_ON_STARTUP"):
+        await run_in_threadpool(database_config.create_schema)
+    prewarm_connections = env_int("DB_POOL_PREWARM", 0)
+    app.state.warmup = asyncio.create_task(prewarm_pool(prewarm_connections)) if prewarm_connections else None
+    try:
+        yield
+    finally:
+        if app.state.warmup is not None:
+            app.state.warmup.cancel()
+        await database_config.dispose()
+        metrics.process_exited()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(profiling.ProfilingMiddleware, profiler=request_profiler)
+app.add_middleware(ReadYourWritesMiddleware, window_seconds=database_config.read_your_writes_seconds)
+# Inside the metrics middleware, so that shed requests are counted with their 503
+app.add_middleware(AdmissionMiddleware, controller=admission_controller)
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 @app.exception_handler(SQLAlchemyError)
 async def sqlalchemy_exception_handler(request: Request, exc: SQLAlchemyError):
+    logger.error(f"Database error on {request.method} {request.url.path}", exc_info=exc)
     return JSONResponse(
         status_code=500,
         content={"detail": "A database error occurred. Please try again later."},
     )
 
 
+@app.exception_handler(CrudError)
+async def crud_exception_handler(request: Request, exc: CrudError):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+
+LOAN_SORT_HELP = "Sort by id, or by due date (earliest first, books without a due date are left out)"
+EXPORT_FORMAT_HELP = "csv, ndjson, or parquet with one row group per batch of rows"
+LOAN_SINCE_HELP = "Only loans checked out at or after this time"
+LOAN_UNTIL_HELP = "Only loans checked out before this time"
+IDS_HELP = f"Comma separated ids, up to {MAX_LOOKUP_IDS}, to look up instead of listing a page"
+FIELDS_HELP = "Comma separated fields to return, e.g. `id,is_checked_out,due_date`. The id is always returned"
+EVENT_BOOK_ID_HELP = "Only events of these books, repeat the parameter for several books"
+BULK_IMPORT_RESPONSES = {400: {"description": "Malformed body, with the counts of the rows committed before",
+                               "model": BulkImportResultDto}}
+
+
+def page_params(limit: int = Query(default=DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT,
+                                  description="Maximum number of items to return"),
+                cursor: Optional[str] = Query(default=None, description="`next_cursor` of the previous page")):
+    return {"limit": limit, "cursor": cursor}
+
+
+def comma_separated(value: Optional[str]) -> Optional[list[str]]:
+    return None if value is None else [item.strip() for item in value.split(",") if item.strip()]
+
+
+def ids_param(ids: Optional[str] = Query(default=None, description=IDS_HELP)) -> Optional[list[int]]:
+    values = comma_separated(ids)
+    if values is None:
+        return None
+    try:
+        entity_ids = [int(value) for value in values]
+    except ValueError:
+        raise CrudError("ids must be comma separated integers")
+    if not entity_ids or len(entity_ids) > MAX_LOOKUP_IDS:
+        raise CrudError(f"Between 1 and {MAX_LOOKUP_IDS} ids can be looked up at once")
+    return entity_ids
+
+
+def fields_param(fields: Optional[str] = Query(default=None, description=FIELDS_HELP)) -> Optional[list[str]]:
+    return comma_separated(fields)
+
+
+def batch_size_param(batch_size: int = Query(default=BULK_IMPORT_BATCH_SIZE, ge=1, le=BULK_IMPORT_MAX_BATCH_SIZE,
+                                             description="Number of rows inserted per statement and transaction")):
+    return batch_size
+
+
+def bulk_import_response(result: dict):
+    """Answers an import stopped by a malformed body with 400, still reporting the rows committed before."""
+    if result["aborted"]:
+        return JSONResponse(status_code=400, content={"detail": result["aborted"]["message"], **result})
+    return result
+
+
+def if_match_param(if_match: Optional[str] = Header(default=None,
+                                                    description="Only apply the change if the ETag still matches")):
+    return etags.match_versions(if_match)
+
+
+def set_etag(response: Response, entity):
+    response.headers["ETag"] = etags.make_etag(entity.version)
+    return entity
+
+
+def book_key(book_id: int):
+    return f"book:{book_id}"
+
+
+def patron_key(patron_id: int):
+    return f"patron:{patron_id}"
+
+
+async def cached_entity(request: Request, db: DatabaseSession, key: str, load):
+    """Reads an entity through the cache, except for clients reading their own writes.
+
+    Misses may be loaded from a replica, which may still have the data from before a write and put it back in the
+    cache right after the write invalidated it. So clients that wrote recently bypass the cache, like the replicas.
+    """
+    if db.replicated and reads_own_writes(request):
+        return await load()
+    return await entity_cache.get_or_load(key, load)
+
+
+async def publish_book_event(event_type: str, book_id: int, data: Optional[dict] = None):
+    """Publishes an event after the change is committed. A failure is logged, the change itself succeeded."""
+    try:
+        await event_broker.publish(event_type, book_id, data)
+    except Exception as e:
+        logger.warning(f"Couldn't publish the {event_type} event of book {book_id}: {e}")
+
+
+def prefetch_patron_emails(rows: list):
+    """Resolves the email domains of a batch concurrently, so that the per-row validators hit the cache."""
+    if validation.validator().email_mode == validation.DELIVERABILITY:
+        validation.validate_emails([row["email"] for row in rows
+                                    if isinstance(row, dict) and isinstance(row.get("email"), str)])
+
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"Hello": "World"}
 
 
+@app.get("/healthz", include_in_schema=False)
+async def healthz():
+    """Liveness: the process serves requests, whether or not the database is reachable."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz", include_in_schema=False)
+async def readyz(request: Request):
+    """Readiness: the connection pool is prewarmed and the primary database answers."""
+    warmup = getattr(request.app.state, "warmup", None)
+    if warmup is not None and not warmup.done():
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    try:
+        await asyncio.wait_for(database_config.ping(), READY_TIMEOUT_SECONDS)
+    except Exception as e:
+        logger.warning(f"Readiness check failed: {e!r}")
+        return JSONResponse(status_code=503, content={"status": "unavailable"})
+    return {"status": "ready"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return entity_cache.stats()
+
+
+@app.get("/admission/stats")
+async def get_admission_stats():
+    """Active and queued requests per class, and how many were shed, to tune the limits to the pool size."""
+    return admission_controller.stats()
+
+
 @app.post("/books/", response_model=BookDto)
-def create_book(book: BookCreateDto, db: Session = Depends(database_config.get_db)):
-    db_book = Book(**book.model_dump())
-    db.add(db_book)
-    db.commit()
+async def create_book(book: BookCreateDto, db: DatabaseSession = Depends(database_config.get_db)):
+    if book_commits.enabled:
+        db_book = await book_commits.submit(db, book)
+    else:
+        db_book = await db.run(crud.create_book, book)
+    book_search.book_saved(db_book)
     return db_book
 
 
-@app.get("/books", response_model=list[BookDto])
-def list_books(db: Session = Depends(database_config.get_db)):
-    books = db.query(Book).all()
-    return books
+@app.post("/books/bulk", response_model=BulkImportResultDto, responses=BULK_IMPORT_RESPONSES)
+async def bulk_create_books(request: Request, batch_size: int = Depends(batch_size_param),
+                            db: DatabaseSession = Depends(database_config.get_db)):
+    """Imports books from a JSON array or NDJSON body, which is streamed rather than buffered."""
+    try:
+        return bulk_import_response(await bulk_import(db, request.stream(), BookCreateDto, BookCreateDto.model_dump,
+                                                      crud.insert_books, batch_size))
+    finally:
+        book_search.invalidate()
+
+
+@app.get("/books", response_model=Union[PageDto[BookDto], LookupDto[BookDto]])
+async def list_books(author: Optional[str] = None,
+                     title_prefix: Optional[str] = None,
+                     published_year_min: Optional[int] = None,
+                     published_year_max: Optional[int] = None,
+                     is_checked_out: Optional[bool] = None,
+                     ids: Optional[list[int]] = Depends(ids_param),
+                     fields: Optional[list[str]] = Depends(fields_param),
+                     page: dict = Depends(page_params),
+                     db: DatabaseSession = Depends(database_config.get_read_db)):
+    """A page of books, or with `ids` the books with these ids in the same order.
+
+    A lookup by `ids` reads all of them at once and ignores the filters and the paging. Its `items` hold null for
+    ids that don't exist, which are also listed in `not_found`.
+    """
+    if ids is not None:
+        return lookup_response(ids, await db.run(crud.get_books, ids, fields))
+    return page_response(await db.run(crud.list_books, author=author, title_prefix=title_prefix,
+                                      published_year_min=published_year_min, published_year_max=published_year_max,
+                                      is_checked_out=is_checked_out, fields=fields, **page))
+
+
+@app.get("/books/search", response_model=list[BookDto])
+async def search_books(q: str = Query(min_length=1, max_length=255, description="Words or word prefixes to look for"),
+                       limit: int = Query(default=SEARCH_DEFAULT_LIMIT, ge=1, le=SEARCH_MAX_LIMIT),
+                       db: DatabaseSession = Depends(database_config.get_read_db)):
+    """Finds books whose title, author or ISBN contain every word of `q`, best matches first."""
+    return await book_search.search(db, q, limit)
 
 
 @app.get("/books/{book_id}", response_model=BookDto)
-def get_book(book_id: int, db: Session = Depends(database_config.get_db)):
-    book = db.query(Book).filter(Book.id == book_id).first()
-    if book is None:
-        raise HTTPException(status_code=404, detail="Book not found")
-    return book
+async def get_book(book_id: int, request: Request, if_none_match: Optional[str] = Header(default=None),
+                   db: DatabaseSession = Depends(database_config.get_read_db)):
+    if if_none_match is not None:
+        # Answered from the version alone when the client's copy is current
+        version = await db.run(crud.get_book_version, book_id)
+        if not etags.none_match(if_none_match, version):
+            return Response(status_code=304, headers={"ETag": etags.make_etag(version)})
 
+    async def load():
+        return dto_values(BookDto, await db.run(crud.get_book, book_id))
 
-@app.put("/books/{book_id}", response_model=BookDto)
-def update_book(book_id: int, book_update: BookUpdateDto, db: Session = Depends(database_config.get_db)):
-    book = db.query(Book).filter(Book.id == book_id).first()
-    if book is None:
-        raise HTTPException(status_code=404, detail="Book not found")
+    book = await cached_entity(request, db, book_key(book_id), load)
+    return ORJSONResponse(book, headers={"ETag": etags.make_etag(book["version"])})
 
-    update_data = book_update.model_dump(exclude_unset=True)
 
-    for key, value in update_data.items():
-        setattr(book, key, value)
-
-    db.commit()
-    return book
+@app.put("/books/{book_id}", response_model=BookDto)
+async def update_book(book_id: int, book_update: BookUpdateDto, response: Response,
+                      versions: Optional[list[int]] = Depends(if_match_param),
+                      db: DatabaseSession = Depends(database_config.get_db)):
+    book = await db.run(crud.update_book, book_id, book_update, versions)
+    await entity_cache.invalidate(book_key(book_id))
+    book_search.book_saved(book)
+    await publish_book_event(events.UPDATE, book_id, dto_values(BookDto, book))
+    return set_etag(response, book)
 
 
 @app.delete("/books/{book_id}")
-def delete_book(book_id: int, db: Session = Depends(database_config.get_db)):
-    book = db.query(Book).filter(Book.id == book_id).first()
-    if book is None:
-        raise HTTPException(status_code=404, detail="Book not found")
-    db.delete(book)
-    db.commit()
+async def delete_book(book_id: int, db: DatabaseSession = Depends(database_config.get_db)):
+    await db.run(crud.delete_book, book_id)
+    await entity_cache.invalidate(book_key(book_id))
+    book_search.book_deleted(book_id)
+    await publish_book_event(events.DELETE, book_id)
     return {"ok": True}
 
 
 @app.post("/patrons/", response_model=PatronDto)
-def create_patron(patron: PatronCreateDto, db: Session = Depends(database_config.get_db)):
-    patron_data = patron.model_dump()
-    if not patron_data["membership_start_date"]:
-        patron_data["membership_start_date"] = datetime.utcnow()
-    new_patron = Patron(**patron_data)
-    db.add(new_patron)
-    db.commit()
-    return new_patron
+async def create_patron(patron: PatronCreateDto, db: DatabaseSession = Depends(database_config.get_db)):
+    if patron_commits.enabled:
+        return await patron_commits.submit(db, patron)
+    return await db.run(crud.create_patron, patron)
+
 
+@app.post("/patrons/bulk", response_model=BulkImportResultDto, responses=BULK_IMPORT_RESPONSES)
+async def bulk_create_patrons(request: Request, batch_size: int = Depends(batch_size_param),
+                              db: DatabaseSession = Depends(database_config.get_db)):
+    """Imports patrons from a JSON array or NDJSON body, which is streamed rather than buffered."""
+    return bulk_import_response(await bulk_import(db, request.stream(), PatronCreateDto, crud.patron_values,
+                                                  crud.insert_patrons, batch_size, prefetch=prefetch_patron_emails))
 
-@app.get("/patrons", response_model=list[PatronDto])
-def list_patrons(db: Session = Depends(database_config.get_db)):
-    patrons = db.query(Patron).all()
-    return patrons
+
+@app.get("/patrons", response_model=Union[PageDto[PatronDto], LookupDto[PatronDto]])
+async def list_patrons(name_prefix: Optional[str] = None,
+                       ids: Optional[list[int]] = Depends(ids_param),
+                       fields: Optional[list[str]] = Depends(fields_param),
+                       page: dict = Depends(page_params),
+                       db: DatabaseSession = Depends(database_config.get_read_db)):
+    """A page of patrons, or with `ids` the patrons with these ids in the same order, as for books."""
+    if ids is not None:
+        return lookup_response(ids, await db.run(crud.get_patrons, ids, fields))
+    return page_response(await db.run(crud.list_patrons, name_prefix=name_prefix, fields=fields, **page))
 
 
 @app.get("/patrons/{patron_id}", response_model=PatronDto)
-def get_patron(patron_id: int, db: Session = Depends(database_config.get_db)):
-    patron = db.query(Patron).filter(Patron.id == patron_id).first()
-    if patron is None:
-        raise HTTPException(status_code=404, detail="Patron not found")
-    return patron
+async def get_patron(patron_id: int, request: Request, if_none_match: Optional[str] = Header(default=None),
+                     db: DatabaseSession = Depends(database_config.get_read_db)):
+    if if_none_match is not None:
+        version = await db.run(crud.get_patron_version, patron_id)
+        if not etags.none_match(if_none_match, version):
+            return Response(status_code=304, headers={"ETag": etags.make_etag(version)})
 
+    async def load():
+        return dto_values(PatronDto, await db.run(crud.get_patron, patron_id))
+
+    patron = await cached_entity(request, db, patron_key(patron_id), load)
+    return ORJSONResponse(patron, headers={"ETag": etags.make_etag(patron["version"])})
 
-@app.put("/patrons/{patron_id}", response_model=PatronDto)
-def update_patron(patron_id: int, patron_update: PatronUpdateDto, db: Session = Depends(database_config.get_db)):
-    patron = db.query(Patron).filter(Patron.id == patron_id).first()
-    if patron is None:
-        raise HTTPException(status_code=404, detail="Patron not found")
-    update_data = patron_update.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(patron, key, value)
 
-    db.commit()
-    return patron
+@app.put("/patrons/{patron_id}", response_model=PatronDto)
+async def update_patron(patron_id: int, patron_update: PatronUpdateDto, response: Response,
+                        versions: Optional[list[int]] = Depends(if_match_param),
+                        db: DatabaseSession = Depends(database_config.get_db)):
+    patron = await db.run(crud.update_patron, patron_id, patron_update, versions)
+    await entity_cache.invalidate(patron_key(patron_id))
+    return set_etag(response, patron)
 
 
 @app.delete("/patrons/{patron_id}")
-def delete_patron(patron_id: int, db: Session = Depends(database_config.get_db)):
-    patron = db.query(Patron).filter(Patron.id == patron_id).first()
-    if patron is None:
-        raise HTTPException(status_code=404, detail="Patron not found")
-    db.delete(patron)
-    db.commit()
+async def delete_patron(patron_id: int, db: DatabaseSession = Depends(database_config.get_db)):
+    book_ids = await db.run(crud.delete_patron, patron_id)
+    # Their books were detached, which changed their versions as well
+    await entity_cache.invalidate(patron_key(patron_id), *(book_key(book_id) for book_id in book_ids))
     return {"ok": True}
 
 
 @app.post("/checkout/{book_id}/patron/{patron_id}", response_model=BookDto)
-def checkout_book(book_id: int, patron_id: int,
-                  checkout_period: Optional[int] = Query(default=14, description="Checkout period in days"),
-                  db: Session = Depends(database_config.get_db)):
-    book = db.query(Book).filter(Book.id == book_id).first()
-    patron = db.query(Patron).filter(Patron.id == patron_id).first()
-    if book is None or patron is None:
-        raise HTTPException(status_code=404, detail="Book or Patron not found")
-    if book.is_checked_out:
-        raise HTTPException(status_code=400, detail="Book already checked out")
-    book.is_checked_out = True
-    book.due_date = datetime.utcnow() + timedelta(days=checkout_period)
-    book.patron_id = patron_id
-    db.commit()
-    return book
+async def checkout_book(book_id: int, patron_id: int, response: Response,
+                        checkout_period: Optional[int] = Query(default=14, description="Checkout period in days"),
+                        versions: Optional[list[int]] = Depends(if_match_param),
+                        db: DatabaseSession = Depends(database_config.get_db)):
+    book = await db.run(crud.checkout_book, book_id, patron_id, checkout_period, versions)
+    await entity_cache.invalidate(book_key(book_id))
+    await publish_book_event(events.CHECKOUT, book_id, dto_values(BookDto, book))
+    return set_etag(response, book)
+
+
+@app.post("/checkout/bulk", response_model=list[BulkCheckoutResultDto])
+async def checkout_books(checkout: BulkCheckoutDto, db: DatabaseSession = Depends(database_config.get_db)):
+    """Checks out several books for one patron in a single transaction, reporting the outcome per book."""
+    results = await db.run(crud.checkout_books, checkout.patron_id, checkout.book_ids, checkout.checkout_period)
+    checked_out = [result for result in results if result["status"] == "checked_out"]
+    await entity_cache.invalidate(*(book_key(result["book_id"]) for result in checked_out))
+    for result in checked_out:
+        # Only the changed fields, the rest of the book wasn't loaded
+        await publish_book_event(events.CHECKOUT, result["book_id"], {
+            "id": result["book_id"], "is_checked_out": True, "patron_id": checkout.patron_id,
+            "due_date": result["due_date"].isoformat()})
+    return results
 
 
 @app.post("/return/{book_id}", response_model=BookDto)
-def return_book(book_id: int, db: Session = Depends(database_config.get_db)):
-    book = db.query(Book).filter(Book.id == book_id).first()
-    if book is None or not book.is_checked_out:
-        raise HTTPException(status_code=404, detail="Book not found or not checked out")
-    book.is_checked_out = False
-    book.due_date = None
-    book.patron_id = None
-    db.commit()
-    return book
-
-
-@app.get("/books/checkedout/", response_model=list[BookDto])
-def list_checked_out_books(db: Session = Depends(database_config.get_db)):
-    books = db.query(Book).filter(Book.is_checked_out is True).all()
-    return books
-
-
-@app.get("/books/patron/{patron_id}", response_model=list[BookDto])
-def list_books_by_patron(patron_id: int, db: Session = Depends(database_config.get_db)):
-    books = db.query(Book).filter(Book.patron_id == patron_id).all()
-    return books
-
-
-@app.get("/books/overdue/", response_model=list[BookDto])
-def list_overdue_books(db: Session = Depends(database_config.get_db)):
-    now = datetime.utcnow()
-    books = db.query(Book).filter(Book.due_date < now, Book.is_checked_out is True).all()
-    return books
+async def return_book(book_id: int, response: Response, versions: Optional[list[int]] = Depends(if_match_param),
+                      db: DatabaseSession = Depends(database_config.get_db)):
+    book = await db.run(crud.return_book, book_id, versions)
+    await entity_cache.invalidate(book_key(book_id))
+    await publish_book_event(events.RETURN, book_id, dto_values(BookDto, book))
+    return set_etag(response, book)
+
+
+@app.get("/books/checkedout/", response_model=PageDto[BookDto])
+async def list_checked_out_books(sort: Literal["id", "due_date"] = Query(default="id", description=LOAN_SORT_HELP),
+                                 page: dict = Depends(page_params),
+                                 db: DatabaseSession = Depends(database_config.get_read_db)):
+    return page_response(await db.run(crud.list_checked_out_books, sort=sort, **page))
+
+
+@app.get("/books/patron/{patron_id}", response_model=PageDto[BookDto])
+async def list_books_by_patron(patron_id: int, page: dict = Depends(page_params),
+                               db: DatabaseSession = Depends(database_config.get_read_db)):
+    return page_response(await db.run(crud.list_books_by_patron, patron_id, **page))
+
+
+@app.get("/patrons/{patron_id}/loans", response_model=PageDto[LoanDto])
+async def list_patron_loans(patron_id: int,
+                            since: Optional[datetime] = Query(default=None, description=LOAN_SINCE_HELP),
+                            until: Optional[datetime] = Query(default=None, description=LOAN_UNTIL_HELP),
+                            page: dict = Depends(page_params),
+                            db: DatabaseSession = Depends(database_config.get_read_db)):
+    """Loan history of a patron, including returned books, oldest checkout first."""
+    return page_response(await db.run(crud.list_patron_loans, patron_id, since=since, until=until, **page))
+
+
+@app.get("/books/{book_id}/loans", response_model=PageDto[LoanDto])
+async def list_book_loans(book_id: int,
+                          since: Optional[datetime] = Query(default=None, description=LOAN_SINCE_HELP),
+                          until: Optional[datetime] = Query(default=None, description=LOAN_UNTIL_HELP),
+                          page: dict = Depends(page_params),
+                          db: DatabaseSession = Depends(database_config.get_read_db)):
+    """Loan history of a book, oldest checkout first."""
+    return page_response(await db.run(crud.list_book_loans, book_id, since=since, until=until, **page))
+
+
+@app.get("/books/overdue/", response_model=PageDto[BookDto])
+async def list_overdue_books(sort: Literal["id", "due_date"] = Query(default="id", description=LOAN_SORT_HELP),
+                             page: dict = Depends(page_params),
+                             db: DatabaseSession = Depends(database_config.get_read_db)):
+    return page_response(await db.run(crud.list_overdue_books, sort=sort, **page))
+
+
+@app.get("/reports", response_model=PageDto[ReportDto])
+async def list_reports(page: dict = Depends(page_params), db: DatabaseSession = Depends(database_config.get_read_db)):
+    """Weekly circulation reports, oldest first."""
+    return page_response(await db.run(crud.list_reports, **page))
+
+
+def export_response(table: str, export_format: str, compress: bool, session_scope) -> StreamingResponse:
+    def chunks():
+        with session_scope() as db:
+            yield from export.export(db, table, export_format, compress)
+
+    file_name = export.file_name(table, export_format, compress)
+    return StreamingResponse(chunks(), media_type=export.media_type(export_format, compress),
+                             headers={"Content-Disposition": f'attachment; filename="{file_name}"'})
+
+
+@app.get("/export/books")
+async def export_books(export_format: Literal[export.FORMATS] = Query(default="csv", alias="format",
+                                                                     description=EXPORT_FORMAT_HELP),
+                       gzip: bool = False, session_scope=Depends(database_config.get_read_session_scope)):
+    """Streams every book, without buffering the table."""
+    return export_response("books", export_format, gzip, session_scope)
+
+
+@app.get("/export/patrons")
+async def export_patrons(export_format: Literal[export.FORMATS] = Query(default="csv", alias="format",
+                                                                       description=EXPORT_FORMAT_HELP),
+                         gzip: bool = False, session_scope=Depends(database_config.get_read_session_scope)):
+    """Streams every patron, without buffering the table."""
+    return export_response("patrons", export_format, gzip, session_scope)
+
+
+@app.get("/events", response_class=StreamingResponse)
+async def stream_events(book_id: Optional[list[int]] = Query(default=None, description=EVENT_BOOK_ID_HELP),
+                        last_event_id: Optional[int] = Header(default=None,
+                                                              description="Resume after this event")):
+    """Server-sent events of book checkouts, returns, updates and deletes.
+
+    Browsers reconnecting send the `Last-Event-ID` header by themselves, and get the events they missed.
+    """
+    async def messages():
+        async for event in event_broker.subscribe(book_id, last_event_id, SSE_KEEPALIVE_SECONDS):
+            yield events.sse_message(event)
+
+    return StreamingResponse(messages(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.websocket("/events/ws")
+async def websocket_events(websocket: WebSocket,
+                           book_id: Optional[list[int]] = Query(default=None, description=EVENT_BOOK_ID_HELP),
+                           last_event_id: Optional[int] = Query(default=None, description="Resume after this event")):
+    """The events of `/events` as JSON messages over a WebSocket."""
+    await websocket.accept()
+
+    async def forward():
+        async for event in event_broker.subscribe(book_id, last_event_id, SSE_KEEPALIVE_SECONDS):
+            if event is not None:
+                await websocket.send_json(event)
+
+    async def receive():
+        # Nothing is expected from the client, this notices it going away while no event comes
+        try:
+            while True:
+                await websocket.receive_text()
+        except WebSocketDisconnect:
+            pass
+
+    tasks = [asyncio.create_task(forward()), asyncio.create_task(receive())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if tasks[1] not in done:
+            # The subscriber fell too far behind, the client may resume from the last event it got
+            await websocket.close()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 if __name__ == "__main__":
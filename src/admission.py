@@ -0,0 +1,192 @@
+"""Admission control, so that overload is answered right away instead of by requests timing out on the pool.
+
+Requests are sorted into classes with their own concurrency limit. All of them also share `max_concurrency`, which
+should match the connections a worker can open. A request that can't start waits in the queue of its class, for at
+most `max_wait_seconds`. When the queue is full or the wait times out, it is answered with `503` and `Retry-After`.
+Freed slots go to the waiting circulation requests first, then to writes, then to reads.
+"""
+import asyncio
+import math
+import os
+from collections import deque
+from typing import Optional
+
+from fastapi.responses import JSONResponse
+
+from src import metrics
+from src.database_config import env_flag, env_int, SAFE_METHODS
+
+CIRCULATION = "circulation"
+WRITE = "write"
+READ = "read"
+# Highest priority first
+PRIORITIES = (CIRCULATION, WRITE, READ)
+
+CIRCULATION_PATHS = ("/checkout/", "/return/")
+# Don't use the database, or hold a connection only briefly while streaming for a long time
+EXEMPT_PATHS = frozenset(("/", "/healthz", "/readyz", "/metrics", "/cache/stats", "/admission/stats", "/events",
+                          "/docs", "/redoc", "/openapi.json"))
+
+# SQLAlchemy's defaults for the size and overflow of a connection pool
+DEFAULT_POOL_CAPACITY = 5 + 10
+DEFAULT_MAX_WAIT_MS = 1000
+DEFAULT_RETRY_AFTER_SECONDS = 1
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class RouteClass:
+    def __init__(self, name: str, limit: int, queue_size: int):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "queued": len(self.waiters), "queue_size": self.queue_size,
+                "admitted": self.admitted, "shed": self.shed, "timed_out": self.timed_out}
+
+
+def route_class(method: str, path: str) -> Optional[str]:
+    """The class of a request, or None if it isn't subject to admission control."""
+    if path in EXEMPT_PATHS:
+        return None
+    if path.startswith(CIRCULATION_PATHS):
+        return CIRCULATION
+    return READ if method in SAFE_METHODS else WRITE
+
+
+class AdmissionController:
+    """Limits the concurrent requests of each class and of all of them, queueing the others by priority."""
+
+    def __init__(self, max_concurrency: int, limits: Optional[dict] = None, queue_size: Optional[int] = None,
+                 max_wait_seconds: float = DEFAULT_MAX_WAIT_MS / 1000,
+                 retry_after_seconds: float = DEFAULT_RETRY_AFTER_SECONDS, enabled: bool = True):
+        limits = limits or {}
+        queue_size = max_concurrency * 2 if queue_size is None else queue_size
+        self.max_concurrency = max_concurrency
+        self.classes = {name: RouteClass(name, limits.get(name) or max_concurrency, queue_size)
+                        for name in PRIORITIES}
+        self.max_wait_seconds = max_wait_seconds
+        self.retry_after_seconds = retry_after_seconds
+        self.enabled = enabled
+        self.active = 0
+
+    @classmethod
+    def from_env(cls):
+        pool_size, max_overflow = env_int("DB_POOL_SIZE"), env_int("DB_MAX_OVERFLOW")
+        pool_capacity = DEFAULT_POOL_CAPACITY if pool_size is None else pool_size + (max_overflow or 0)
+        max_concurrency = env_int("ADMISSION_MAX_CONCURRENCY", pool_capacity)
+        # Reads and writes are kept from taking every connection, circulation may use all of them
+        shared = max(1, max_concurrency * 3 // 4)
+        return cls(max_concurrency,
+                   limits={READ: env_int("ADMISSION_READ_LIMIT", shared),
+                           WRITE: env_int("ADMISSION_WRITE_LIMIT", shared),
+                           CIRCULATION: env_int("ADMISSION_CIRCULATION_LIMIT", max_concurrency)},
+                   queue_size=env_int("ADMISSION_QUEUE_SIZE"),
+                   max_wait_seconds=env_int("ADMISSION_MAX_WAIT_MS", DEFAULT_MAX_WAIT_MS) / 1000,
+                   retry_after_seconds=float(os.getenv("ADMISSION_RETRY_AFTER_SECONDS") or
+                                             DEFAULT_RETRY_AFTER_SECONDS),
+                   enabled=env_flag("ADMISSION_CONTROL"))
+
+    def _can_start(self, route: RouteClass) -> bool:
+        return route.active < route.limit and self.active < self.max_concurrency
+
+    def _start(self, route: RouteClass):
+        route.active += 1
+        route.admitted += 1
+        self.active += 1
+        metrics.ADMISSION_ACTIVE.labels(route.name).inc()
+
+    def _shed(self, route: RouteClass, reason: str):
+        route.shed += 1
+        metrics.ADMISSION_SHED.labels(route.name, reason).inc()
+        raise Overloaded(reason)
+
+    async def acquire(self, name: str):
+        """Waits for a slot of class `name`.
+
+        Raises:
+            Overloaded: If the queue of the class is full, or no slot was freed in time.
+        """
+        route = self.classes[name]
+        if not route.waiters and self._can_start(route):
+            self._start(route)
+            return
+        if len(route.waiters) >= route.queue_size:
+            self._shed(route, "queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        route.waiters.append(waiter)
+        metrics.ADMISSION_QUEUED.labels(name).inc()
+        try:
+            await asyncio.wait_for(waiter, self.max_wait_seconds)
+        except asyncio.TimeoutError:
+            route.timed_out += 1
+            self._shed(route, "timeout")
+        except asyncio.CancelledError:
+            # The client went away, possibly right after the slot was handed over
+            if waiter.done() and not waiter.cancelled():
+                self.release(name)
+            raise
+        finally:
+            metrics.ADMISSION_QUEUED.labels(name).dec()
+            if waiter in route.waiters:
+                route.waiters.remove(waiter)
+
+    def release(self, name: str):
+        route = self.classes[name]
+        route.active -= 1
+        self.active -= 1
+        metrics.ADMISSION_ACTIVE.labels(name).dec()
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hands the free slots to the waiting requests, highest priority class first."""
+        for name in PRIORITIES:
+            route = self.classes[name]
+            while route.waiters and self._can_start(route):
+                waiter = route.waiters.popleft()
+                if not waiter.done():
+                    self._start(route)
+                    waiter.set_result(None)
+            if self.active >= self.max_concurrency:
+                return
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "max_concurrency": self.max_concurrency, "active": self.active,
+                "classes": {name: route.stats() for name, route in self.classes.items()}}
+
+
+class AdmissionMiddleware:
+    """ASGI middleware holding a slot of the request's class while the request is handled and its response sent."""
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        name = None
+        if scope["type"] == "http" and self.controller.enabled:
+            name = route_class(scope["method"], scope["path"])
+        if name is None:
+            return await self.app(scope, receive, send)
+
+        try:
+            await self.controller.acquire(name)
+        except Overloaded:
+            response = JSONResponse(status_code=503, content={"detail": "The server is overloaded, retry later"},
+                                    headers={"Retry-After": str(math.ceil(self.controller.retry_after_seconds))})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(name)
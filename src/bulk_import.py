@@ -0,0 +1,178 @@
+import codecs
+import json
+from typing import AsyncIterator
+
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+
+from src.config import BULK_IMPORT_MAX_ROW_BYTES, BULK_IMPORT_MAX_ERRORS
+from src.crud import CrudError
+
+
+class MalformedRow:
+    """Placeholder for an NDJSON line that isn't valid JSON, so the import can report it and carry on."""
+
+    def __init__(self, message):
+        self.message = message
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]):
+    """Yields one decoded object (or `MalformedRow`) per non-empty line of an NDJSON byte stream."""
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > BULK_IMPORT_MAX_ROW_BYTES:
+            raise CrudError(f"Row exceeds {BULK_IMPORT_MAX_ROW_BYTES} bytes")
+        for line in lines:
+            if line.strip():
+                yield _decode_line(line)
+    if buffer.strip():
+        yield _decode_line(buffer)
+
+
+def _decode_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return MalformedRow(f"Invalid JSON: {e}")
+
+
+async def iter_json_array(chunks: AsyncIterator[bytes]):
+    """Yields the elements of a top level JSON array as they arrive, without buffering the whole body.
+
+    Raises:
+        CrudError: If the body is not a well formed JSON array.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    # What comes next: the opening bracket, the first element or the closing bracket, an element after a comma,
+    # or the comma or closing bracket after an element
+    expected = "["
+    chunks = aiter(chunks)
+    eof = False
+    while expected is not None:
+        while position < len(buffer) and buffer[position] in " \t\r\n":
+            position += 1
+        if position < len(buffer):
+            char = buffer[position]
+            if expected == "[":
+                if char != "[":
+                    raise CrudError("Expected a JSON array")
+                expected, position = "first", position + 1
+                continue
+            if char == "]" and expected in ("first", "separator"):
+                expected = None
+                continue
+            if expected == "separator":
+                if char != ",":
+                    raise CrudError("Malformed JSON array")
+                expected, position = "element", position + 1
+                continue
+            if char in ",]":
+                raise CrudError("Malformed JSON array")
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                value, end = None, None
+            if end is not None and (end < len(buffer) or eof):
+                yield value
+                buffer, position, expected = buffer[end:], 0, "separator"
+                continue
+            if eof:
+                raise CrudError("Malformed JSON array")
+            if len(buffer) - position > BULK_IMPORT_MAX_ROW_BYTES:
+                raise CrudError(f"Row exceeds {BULK_IMPORT_MAX_ROW_BYTES} bytes")
+        elif eof:
+            raise CrudError("Unexpected end of JSON array")
+        try:
+            buffer = buffer[position:] + utf8.decode(await anext(chunks))
+        except StopAsyncIteration:
+            buffer = buffer[position:] + utf8.decode(b"", final=True)
+            eof = True
+        position = 0
+
+
+async def iter_rows(chunks: AsyncIterator[bytes]):
+    """Yields rows from either a JSON array or an NDJSON body, chosen by the first non-blank byte."""
+    chunks = aiter(chunks)
+    head = b""
+    async for chunk in chunks:
+        head += chunk
+        if head.strip():
+            break
+
+    async def replay():
+        yield head
+        async for rest in chunks:
+            yield rest
+
+    rows = iter_json_array(replay()) if head.lstrip().startswith(b"[") else iter_ndjson(replay())
+    async for row in rows:
+        yield row
+
+
+async def bulk_import(db, chunks: AsyncIterator[bytes], dto_cls, to_values, insert_fn, batch_size: int,
+                      prefetch=None):
+    """Validates rows of a streamed body with `dto_cls` and inserts the valid ones in batches.
+
+    Args:
+        db: The database session the batches are inserted with.
+        chunks: The raw request body.
+        dto_cls: The pydantic model each row is validated with.
+        to_values: Turns a validated DTO into the column values of one row.
+        insert_fn: Data access function inserting a list of column values, returning failures by list index.
+        batch_size: Number of rows per INSERT statement and transaction.
+        prefetch: Optional blocking function called in the threadpool with the raw rows of a batch before they are
+            validated, e.g. to warm validation caches with one batched lookup.
+
+    Returns:
+        A dict with `received`, `inserted` and `failed` counts and the first per-row `errors`. If the body turns out
+        to be malformed part way, the rows read before are still inserted, and `aborted` holds the number of the row
+        the import stopped at and why.
+    """
+    result = {"received": 0, "inserted": 0, "failed": 0, "errors": [], "aborted": None}
+
+    def add_error(row_number, errors):
+        result["failed"] += 1
+        if len(result["errors"]) < BULK_IMPORT_MAX_ERRORS:
+            result["errors"].append({"row": row_number, "errors": errors})
+
+    async def process(rows):
+        if prefetch:
+            await run_in_threadpool(prefetch, [row for _, row in rows])
+        batch = []
+        for row_number, row in rows:
+            try:
+                dto = dto_cls.model_validate(row)
+            except ValidationError as e:
+                add_error(row_number, e.errors(include_url=False, include_context=False, include_input=False))
+                continue
+            batch.append((row_number, to_values(dto)))
+        if not batch:
+            return
+        failures = await db.run(insert_fn, [values for _, values in batch])
+        for index, message in failures.items():
+            add_error(batch[index][0], [{"msg": message}])
+        result["inserted"] += len(batch) - len(failures)
+
+    rows = []
+    try:
+        async for row in iter_rows(chunks):
+            result["received"] += 1
+            row_number = result["received"]
+            if isinstance(row, MalformedRow):
+                add_error(row_number, [{"msg": row.message}])
+                continue
+            rows.append((row_number, row))
+            if len(rows) >= batch_size:
+                await process(rows)
+                rows = []
+    except CrudError as e:
+        # Earlier batches are committed already, so report how far the import got rather than failing it as a whole
+        result["aborted"] = {"row": result["received"] + 1, "message": e.detail}
+    if rows:
+        await process(rows)
+    return result
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+DEFAULT_TTL_SECONDS = 60
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class NullCache:
+    """Backend that stores nothing, every lookup goes to the loader."""
+    name = "none"
+
+    async def get(self, key) -> Optional[dict]:
+        return None
+
+    async def set(self, key, value: dict):
+        pass
+
+    async def delete(self, *keys):
+        pass
+
+    async def clear(self):
+        pass
+
+    def size(self):
+        return 0
+
+
+class MemoryCache:
+    """In-process LRU cache whose entries expire `ttl_seconds` after they were stored."""
+    name = "memory"
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries: OrderedDict = OrderedDict()
+
+    async def get(self, key) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key, value: dict):
+        self._entries[key] = (self.clock() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def clear(self):
+        self._entries.clear()
+
+    def size(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    """Cache shared by all workers, stored as JSON strings with a Redis TTL."""
+    name = "redis"
+
+    def __init__(self, client, ttl_seconds=DEFAULT_TTL_SECONDS, prefix="library:cache:"):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    async def get(self, key) -> Optional[dict]:
+        value = await self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    async def set(self, key, value: dict):
+        await self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl_seconds)
+
+    async def delete(self, *keys):
+        if keys:
+            await self.client.delete(*(self.prefix + key for key in keys))
+
+    async def clear(self):
+        async for key in self.client.scan_iter(match=self.prefix + "*"):
+            await self.client.delete(key)
+
+    def size(self):
+        return None
+
+
+class EntityCache:
+    """Read-through cache for serialized entities.
+
+    Concurrent misses for the same key share a single call of the loader, and a load that overlaps an
+    invalidation is returned to its callers but not stored, so writes can't be overwritten by stale reads.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or NullCache()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    @classmethod
+    def from_env(cls):
+        backend_name = os.getenv("CACHE_BACKEND", "none")
+        ttl_seconds = int(os.getenv("CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS))
+        if backend_name == "memory":
+            max_entries = int(os.getenv("CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+            return cls(MemoryCache(max_entries=max_entries, ttl_seconds=ttl_seconds))
+        if backend_name == "redis":
+            from redis.asyncio import Redis
+
+            redis_url = os.getenv("CACHE_REDIS_URL") or os.getenv("CELERY_BROKER_URL")
+            return cls(RedisCache(Redis.from_url(redis_url), ttl_seconds=ttl_seconds))
+        if backend_name == "none":
+            return cls()
+        raise ValueError(f"Unknown cache backend '{backend_name}'")
+
+    async def get_or_load(self, key, loader: Callable[[], Awaitable[dict]]) -> dict:
+        value = await self.backend.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        invalidations = self.invalidations
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting for it
+            future.exception()
+            raise
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        future.set_result(value)
+        if invalidations == self.invalidations:
+            await self.backend.set(key, value)
+        return value
+
+    async def invalidate(self, *keys):
+        self.invalidations += 1
+        for key in keys:
+            self._inflight.pop(key, None)
+        await self.backend.delete(*keys)
+
+    async def clear(self):
+        self._inflight.clear()
+        await self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "entries": self.backend.size(),
+        }
@@ -0,0 +1,139 @@
+from datetime import datetime, date
+from typing import Optional
+
+from sqlalchemy import func, select, update, insert
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+
+from src import queries
+from src.model import Book, CirculationCounter, LoanDueDay
+
+TOTAL = "total"
+CHECKED_OUT = "checked_out"
+
+# Overdue buckets as (name, minimum days overdue, maximum days overdue)
+OVERDUE_BUCKETS = (
+    ("overdue_1_7_days", 1, 7),
+    ("overdue_8_30_days", 8, 30),
+    ("overdue_over_30_days", 31, None),
+)
+
+
+def _increment(db: Session, model, key_column, key, value_column, delta: int):
+    """Adds `delta` to a counter row in the current transaction, creating the row if needed."""
+    if not delta:
+        return
+    values = {key_column.key: key, value_column.key: delta}
+    dialect = db.get_bind().dialect.name
+    if dialect == "mysql":
+        statement = mysql.insert(model).values(values)
+        db.execute(statement.on_duplicate_key_update({value_column.key: value_column + delta}))
+    elif dialect == "sqlite":
+        statement = sqlite.insert(model).values(values)
+        db.execute(statement.on_conflict_do_update(index_elements=[key_column],
+                                                   set_={value_column.key: value_column + delta}))
+    else:
+        result = db.execute(update(model).where(key_column == key).values({value_column.key: value_column + delta}))
+        if result.rowcount == 0:
+            db.execute(insert(model).values(values))
+
+
+def _bump(db: Session, name: str, delta: int):
+    _increment(db, CirculationCounter, CirculationCounter.name, name, CirculationCounter.value, delta)
+
+
+def _bump_due_day(db: Session, due_date: Optional[datetime], delta: int):
+    if due_date is not None:
+        _increment(db, LoanDueDay, LoanDueDay.due_day, due_date.date(), LoanDueDay.loans, delta)
+
+
+def record_books_added(db: Session, count: int):
+    _bump(db, TOTAL, count)
+
+
+def record_book_removed(db: Session, book: Book):
+    _bump(db, TOTAL, -1)
+    if book.is_checked_out:
+        _bump(db, CHECKED_OUT, -1)
+        _bump_due_day(db, book.due_date, -1)
+
+
+def record_checkout(db: Session, due_date: datetime, count: int = 1):
+    _bump(db, CHECKED_OUT, count)
+    _bump_due_day(db, due_date, count)
+
+
+def record_return(db: Session, due_date: Optional[datetime]):
+    _bump(db, CHECKED_OUT, -1)
+    _bump_due_day(db, due_date, -1)
+
+
+def record_due_date_change(db: Session, old_due_date: Optional[datetime], new_due_date: Optional[datetime]):
+    _bump_due_day(db, old_due_date, -1)
+    _bump_due_day(db, new_due_date, 1)
+
+
+def snapshot(db: Session, now: datetime):
+    """Reads the current statistics from the counters.
+
+    Overdue loans are counted per whole day: a loan is overdue once the day it was due on has passed.
+    """
+    counters = dict(db.execute(select(CirculationCounter.name, CirculationCounter.value)).all())
+    today = now.date()
+    due_days = db.execute(select(LoanDueDay.due_day, LoanDueDay.loans)
+                          .where(LoanDueDay.due_day < today, LoanDueDay.loans != 0)).all()
+    stats = {
+        "total": counters.get(TOTAL, 0),
+        "checked_out": counters.get(CHECKED_OUT, 0),
+    }
+    stats["in_library"] = stats["total"] - stats["checked_out"]
+    stats["overdue"] = sum(loans for _, loans in due_days)
+    for name, _, _ in OVERDUE_BUCKETS:
+        stats[name] = 0
+    for due_day, loans in due_days:
+        days_overdue = (today - due_day).days
+        for name, minimum_days, maximum_days in OVERDUE_BUCKETS:
+            if days_overdue >= minimum_days and (maximum_days is None or days_overdue <= maximum_days):
+                stats[name] += loans
+    return stats
+
+
+def reconcile(db: Session):
+    """Recomputes the counters from the books table and commits the corrections.
+
+    The counter rows are locked before the books are counted, so the writes that would change them wait for the
+    correction instead of being overwritten by it.
+
+    Returns:
+        A dict of the counters that had drifted, mapping their name to the (stored, actual) values.
+    """
+    stored = dict(db.execute(select(CirculationCounter.name, CirculationCounter.value).with_for_update()).all())
+    stored_due_days = {day: loans for day, loans in
+                       db.execute(select(LoanDueDay.due_day, LoanDueDay.loans).with_for_update()).all() if loans}
+
+    actual = {
+        TOTAL: db.query(func.count(Book.id)).scalar(),
+        CHECKED_OUT: queries.checked_out_books(db).with_entities(func.count(Book.id)).scalar(),
+    }
+    drift = {name: (stored.get(name, 0), value) for name, value in actual.items() if stored.get(name, 0) != value}
+
+    due_day = func.date(Book.due_date)
+    actual_due_days = {_as_date(day): loans for day, loans in
+                       queries.checked_out_books(db).filter(Book.due_date.isnot(None))
+                       .with_entities(due_day, func.count(Book.id)).group_by(due_day).all()}
+    if actual_due_days != stored_due_days:
+        drift["due_days"] = (sum(stored_due_days.values()), sum(actual_due_days.values()))
+
+    # Applied as differences, which also keeps the increments of counter rows that didn't exist yet when locked
+    for name, value in actual.items():
+        _bump(db, name, value - stored.get(name, 0))
+    for day in stored_due_days.keys() | actual_due_days.keys():
+        _increment(db, LoanDueDay, LoanDueDay.due_day, day, LoanDueDay.loans,
+                   actual_due_days.get(day, 0) - stored_due_days.get(day, 0))
+    db.commit()
+    return drift
+
+
+def _as_date(value):
+    # SQLite returns DATE() as a string
+    return date.fromisoformat(value) if isinstance(value, str) else value
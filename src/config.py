@@ -1,3 +1,29 @@
 LOG_LEVEL = "INFO"
 TIME_FORMAT = '"%Y-%m-%d %H:%M:%S'
 LOGGING_FORMAT = "%(asctime)s.%(msecs)03d-> %(message)s"
+
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 500
+# Ids resolved by one `?ids=` lookup, they are all sent in a single IN list
+MAX_LOOKUP_IDS = 500
+
+BULK_IMPORT_BATCH_SIZE = 1000
+BULK_IMPORT_MAX_BATCH_SIZE = 10000
+BULK_IMPORT_MAX_ROW_BYTES = 64 * 1024
+BULK_IMPORT_MAX_ERRORS = 1000
+
+OVERDUE_REMINDER_CHUNK_SIZE = 500
+OVERDUE_REMINDER_FETCH_SIZE = 1000
+
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+
+BULK_CHECKOUT_MAX_BOOKS = 100
+
+EXPORT_BATCH_SIZE = 5000
+
+# Seconds without events after which a comment is sent, so that proxies keep the stream open
+SSE_KEEPALIVE_SECONDS = 15
+
+# How long /readyz waits for the database to answer
+READY_TIMEOUT_SECONDS = 2
@@ -0,0 +1,474 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import insert, update, exists
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
+
+from src import queries, circulation
+from src.model import Book, Patron, WeeklyReport, Loan
+from src.model_dto import BookCreateDto, BookUpdateDto, PatronCreateDto, PatronUpdateDto, BookDto, PatronDto, \
+    ReportDto, LoanDto
+from src.pagination import paginate, escape_like
+from src.responses import dto_columns
+
+# List endpoints read these columns as rows rather than loading ORM objects
+BOOK_COLUMNS = dto_columns(Book, BookDto)
+PATRON_COLUMNS = dto_columns(Patron, PatronDto)
+REPORT_COLUMNS = dto_columns(WeeklyReport, ReportDto)
+LOAN_COLUMNS = dto_columns(Loan, LoanDto)
+MAX_CHECKOUT_ATTEMPTS = 5
+
+
+class CrudError(Exception):
+    status_code = 400
+
+    def __init__(self, detail):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class NotFoundError(CrudError):
+    status_code = 404
+
+
+class PreconditionFailedError(CrudError):
+    status_code = 412
+
+
+class ConflictError(CrudError):
+    status_code = 409
+
+
+def check_version(entity, versions: Optional[list[int]], name: str):
+    """Raises if `versions`, the versions accepted by an `If-Match` header, doesn't include the entity's version."""
+    if versions is not None and entity.version not in versions:
+        raise PreconditionFailedError(f"{name} has been modified")
+
+
+def commit_versioned(db: Session, name: str):
+    """Commits ORM changes to versioned rows, which fail if another transaction changed the rows meanwhile."""
+    try:
+        db.commit()
+    except StaleDataError:
+        db.rollback()
+        raise PreconditionFailedError(f"{name} has been modified concurrently")
+
+
+def paginate_query(query, key_column, limit: int, cursor: Optional[str]):
+    try:
+        return paginate(query, key_column, limit, cursor)
+    except ValueError as e:
+        raise CrudError(str(e))
+
+
+def select_fields(columns: tuple, fields: Optional[list[str]]) -> tuple:
+    """The columns of `columns` named in `fields`, or all of them without `fields`. The id is always selected."""
+    if not fields:
+        return columns
+    unknown = set(fields).difference(column.key for column in columns)
+    if unknown:
+        raise CrudError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(column for column in columns if column.key == "id" or column.key in fields)
+
+
+def lookup(db: Session, columns: tuple, ids: list[int]) -> list:
+    """Reads the rows of `ids` with a single IN query.
+
+    Returns:
+        One row per id, in the order of `ids`, None for the ids that don't exist.
+    """
+    id_column = next(column for column in columns if column.key == "id")
+    rows = {row.id: row for row in db.query(*columns).filter(id_column.in_(set(ids)))}
+    return [rows.get(row_id) for row_id in ids]
+
+
+def create_book(db: Session, book: BookCreateDto):
+    db_book = Book(**book.model_dump())
+    db.add(db_book)
+    circulation.record_books_added(db, 1)
+    db.commit()
+    return db_book
+
+
+def add_all(db: Session, model, rows: list[dict], on_inserted=None) -> list:
+    """Adds one entity per row of `rows` and commits them in one transaction.
+
+    Unlike `bulk_insert`, the entities are returned with their generated ids. If the batch is rejected, the rows are
+    retried one by one in savepoints, so that only the offending rows fail.
+
+    Returns:
+        Per row, in order, the new entity or the database error of the row.
+    """
+    entities = [model(**row) for row in rows]
+    try:
+        db.add_all(entities)
+        if on_inserted:
+            on_inserted(db, len(entities))
+        db.commit()
+        return entities
+    except SQLAlchemyError:
+        db.rollback()
+
+    results = []
+    for row in rows:
+        entity = model(**row)
+        try:
+            with db.begin_nested():
+                db.add(entity)
+            results.append(entity)
+        except SQLAlchemyError as e:
+            results.append(e)
+    if on_inserted:
+        on_inserted(db, sum(1 for result in results if not isinstance(result, Exception)))
+    db.commit()
+    return results
+
+
+def create_books(db: Session, books: list[BookCreateDto]) -> list:
+    return add_all(db, Book, [book.model_dump() for book in books], on_inserted=circulation.record_books_added)
+
+
+def bulk_insert(db: Session, model, rows: list[dict], on_inserted=None):
+    """Inserts `rows` with one executemany INSERT and commits them.
+
+    If the batch is rejected, the rows are retried one by one in savepoints, so that only the offending
+    rows are lost.
+
+    Args:
+        db: The session to insert with.
+        model: The mapped class of the rows.
+        rows: Column values of the rows.
+        on_inserted: Called with the session and the number of inserted rows before the commit.
+
+    Returns:
+        A dict mapping the index of every row that couldn't be inserted to the database error message.
+    """
+    try:
+        db.execute(insert(model), rows)
+        if on_inserted:
+            on_inserted(db, len(rows))
+        db.commit()
+        return {}
+    except SQLAlchemyError:
+        db.rollback()
+
+    failures = {}
+    for index, row in enumerate(rows):
+        try:
+            with db.begin_nested():
+                db.execute(insert(model), [row])
+        except SQLAlchemyError as e:
+            failures[index] = str(getattr(e, "orig", None) or e)
+    if on_inserted:
+        on_inserted(db, len(rows) - len(failures))
+    db.commit()
+    return failures
+
+
+def insert_books(db: Session, rows: list[dict]):
+    return bulk_insert(db, Book, rows, on_inserted=circulation.record_books_added)
+
+
+def insert_patrons(db: Session, rows: list[dict]):
+    return bulk_insert(db, Patron, rows)
+
+
+def list_books(db: Session, limit: int, cursor: Optional[str] = None, author: Optional[str] = None,
+               title_prefix: Optional[str] = None, published_year_min: Optional[int] = None,
+               published_year_max: Optional[int] = None, is_checked_out: Optional[bool] = None,
+               fields: Optional[list[str]] = None):
+    query = db.query(*select_fields(BOOK_COLUMNS, fields))
+    if author is not None:
+        query = query.filter(Book.author == author)
+    if title_prefix:
+        query = query.filter(Book.title.like(escape_like(title_prefix) + "%", escape="\\"))
+    if published_year_min is not None:
+        query = query.filter(Book.published_year >= published_year_min)
+    if published_year_max is not None:
+        query = query.filter(Book.published_year <= published_year_max)
+    if is_checked_out is not None:
+        query = query.filter(Book.is_checked_out == is_checked_out)
+    return paginate_query(query, Book.id, limit, cursor)
+
+
+def get_books(db: Session, book_ids: list[int], fields: Optional[list[str]] = None) -> list:
+    return lookup(db, select_fields(BOOK_COLUMNS, fields), book_ids)
+
+
+def get_book(db: Session, book_id: int):
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if book is None:
+        raise NotFoundError("Book not found")
+    return book
+
+
+def get_book_version(db: Session, book_id: int) -> int:
+    version = db.query(Book.version).filter(Book.id == book_id).scalar()
+    if version is None:
+        raise NotFoundError("Book not found")
+    return version
+
+
+def update_book(db: Session, book_id: int, book_update: BookUpdateDto, versions: Optional[list[int]] = None):
+    book = get_book(db, book_id)
+    check_version(book, versions, "Book")
+    update_data = book_update.model_dump(exclude_unset=True)
+    if book.is_checked_out and "due_date" in update_data:
+        circulation.record_due_date_change(db, book.due_date, update_data["due_date"])
+    if book.is_checked_out and update_data.get("due_date") is not None:
+        # The open loan is due when the book is
+        db.execute(
+            update(Loan)
+            .where(Loan.book_id == book_id, Loan.returned_at.is_(None))
+            .values(due_date=update_data["due_date"])
+            .execution_options(synchronize_session=False)
+        )
+
+    for key, value in update_data.items():
+        setattr(book, key, value)
+
+    commit_versioned(db, "Book")
+    return book
+
+
+def delete_book(db: Session, book_id: int):
+    book = get_book(db, book_id)
+    circulation.record_book_removed(db, book)
+    if book.is_checked_out:
+        # The history keeps the loan, closed when the book leaves the catalogue
+        db.execute(
+            update(Loan)
+            .where(Loan.book_id == book_id, Loan.returned_at.is_(None))
+            .values(returned_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+    db.delete(book)
+    commit_versioned(db, "Book")
+
+
+def patron_values(patron: PatronCreateDto):
+    patron_data = patron.model_dump()
+    if not patron_data["membership_start_date"]:
+        patron_data["membership_start_date"] = datetime.utcnow()
+    return patron_data
+
+
+def create_patron(db: Session, patron: PatronCreateDto):
+    new_patron = Patron(**patron_values(patron))
+    db.add(new_patron)
+    db.commit()
+    return new_patron
+
+
+def create_patrons(db: Session, patrons: list[PatronCreateDto]) -> list:
+    return add_all(db, Patron, [patron_values(patron) for patron in patrons])
+
+
+def list_patrons(db: Session, limit: int, cursor: Optional[str] = None, name_prefix: Optional[str] = None,
+                 fields: Optional[list[str]] = None):
+    query = db.query(*select_fields(PATRON_COLUMNS, fields))
+    if name_prefix:
+        query = query.filter(Patron.name.like(escape_like(name_prefix) + "%", escape="\\"))
+    return paginate_query(query, Patron.id, limit, cursor)
+
+
+def get_patrons(db: Session, patron_ids: list[int], fields: Optional[list[str]] = None) -> list:
+    return lookup(db, select_fields(PATRON_COLUMNS, fields), patron_ids)
+
+
+def get_patron(db: Session, patron_id: int):
+    patron = db.query(Patron).filter(Patron.id == patron_id).first()
+    if patron is None:
+        raise NotFoundError("Patron not found")
+    return patron
+
+
+def get_patron_version(db: Session, patron_id: int) -> int:
+    version = db.query(Patron.version).filter(Patron.id == patron_id).scalar()
+    if version is None:
+        raise NotFoundError("Patron not found")
+    return version
+
+
+def update_patron(db: Session, patron_id: int, patron_update: PatronUpdateDto,
+                  versions: Optional[list[int]] = None):
+    patron = get_patron(db, patron_id)
+    check_version(patron, versions, "Patron")
+    update_data = patron_update.model_dump(exclude_unset=True)
+    for key, value in update_data.items():
+        setattr(patron, key, value)
+
+    commit_versioned(db, "Patron")
+    return patron
+
+
+def delete_patron(db: Session, patron_id: int) -> list[int]:
+    """Deletes a patron and detaches their books, returning the ids of the books that changed."""
+    patron = get_patron(db, patron_id)
+    book_ids = [book_id for book_id, in db.query(Book.id).filter(Book.patron_id == patron_id).with_for_update()]
+    # Detached with one UPDATE, since `checked_out_books` is never loaded
+    db.execute(
+        update(Book)
+        .where(Book.patron_id == patron_id)
+        .values(patron_id=None, version=Book.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    db.delete(patron)
+    commit_versioned(db, "Patron")
+    return book_ids
+
+
+def checkout_book(db: Session, book_id: int, patron_id: int, checkout_period: int,
+                  versions: Optional[list[int]] = None):
+    """Checks out a book with a single conditional UPDATE, so that concurrent checkouts can't both succeed."""
+    checked_out_at = datetime.utcnow()
+    due_date = checked_out_at + timedelta(days=checkout_period)
+    conditions = [Book.id == book_id, queries.IS_IN_LIBRARY, exists().where(Patron.id == patron_id)]
+    if versions is not None:
+        conditions.append(Book.version.in_(versions))
+    result = db.execute(
+        update(Book)
+        .where(*conditions)
+        .values(is_checked_out=True, due_date=due_date, patron_id=patron_id, version=Book.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.rollback()
+        state = db.query(Book.is_checked_out, Book.version, exists().where(Patron.id == patron_id)) \
+            .filter(Book.id == book_id).first()
+        if state is None or not state[2]:
+            raise NotFoundError("Book or Patron not found")
+        check_version(state, versions, "Book")
+        raise CrudError("Book already checked out")
+    db.execute(insert(Loan).values(book_id=book_id, patron_id=patron_id, checked_out_at=checked_out_at,
+                                   due_date=due_date))
+    circulation.record_checkout(db, due_date)
+    db.commit()
+    return db.query(Book).filter(Book.id == book_id).populate_existing().one()
+
+
+def checkout_books(db: Session, patron_id: int, book_ids: list[int], checkout_period: int):
+    """Checks out the available books among `book_ids` for one patron in a single transaction.
+
+    Returns:
+        One result per requested id, in request order, with a `status` of "checked_out",
+        "already_checked_out" or "not_found".
+
+    Raises:
+        ConflictError: If other transactions kept taking some of the books during `MAX_CHECKOUT_ATTEMPTS` attempts.
+    """
+    if db.query(Patron.id).filter(Patron.id == patron_id).first() is None:
+        raise NotFoundError("Patron not found")
+    book_ids = list(dict.fromkeys(book_ids))
+    for _ in range(MAX_CHECKOUT_ATTEMPTS):
+        checked_out_at = datetime.utcnow()
+        # Whole seconds, so that the due date reads back equal from DATETIME columns without fractions
+        due_date = (checked_out_at + timedelta(days=checkout_period)).replace(microsecond=0)
+        # Locked where the database supports it, so the books found available stay available until the UPDATE
+        states = dict(db.query(Book.id, Book.is_checked_out).filter(Book.id.in_(book_ids)).with_for_update())
+        available = [book_id for book_id, is_checked_out in states.items() if is_checked_out is False]
+        result = db.execute(
+            update(Book)
+            .where(Book.id.in_(available), queries.IS_IN_LIBRARY)
+            .values(is_checked_out=True, due_date=due_date, patron_id=patron_id, version=Book.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == len(available):
+            break
+        # Another transaction checked out some of the books in between, e.g. on SQLite which doesn't lock rows
+        db.rollback()
+    else:
+        raise ConflictError("The books are being checked out concurrently, please retry")
+    circulation.record_checkout(db, due_date, count=len(available))
+    if available:
+        db.execute(insert(Loan), [{"book_id": book_id, "patron_id": patron_id, "checked_out_at": checked_out_at,
+                                   "due_date": due_date} for book_id in available])
+    db.commit()
+
+    available = set(available)
+    results = []
+    for book_id in book_ids:
+        if book_id in available:
+            results.append({"book_id": book_id, "status": "checked_out", "due_date": due_date})
+        elif book_id in states:
+            results.append({"book_id": book_id, "status": "already_checked_out", "due_date": None})
+        else:
+            results.append({"book_id": book_id, "status": "not_found", "due_date": None})
+    return results
+
+
+def return_book(db: Session, book_id: int, versions: Optional[list[int]] = None):
+    """Returns a book with a conditional UPDATE on the version that was read, so a book can't be returned twice."""
+    book = db.query(Book).filter(Book.id == book_id).first()
+    if book is None or not book.is_checked_out:
+        raise NotFoundError("Book not found or not checked out")
+    check_version(book, versions, "Book")
+    result = db.execute(
+        update(Book)
+        .where(Book.id == book_id, queries.IS_CHECKED_OUT, Book.version == book.version)
+        .values(is_checked_out=False, due_date=None, patron_id=None, version=book.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.rollback()
+        raise NotFoundError("Book not found or not checked out")
+    db.execute(
+        update(Loan)
+        .where(Loan.book_id == book_id, Loan.returned_at.is_(None))
+        .values(returned_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    circulation.record_return(db, book.due_date)
+    db.commit()
+    for key, value in (("is_checked_out", False), ("due_date", None), ("patron_id", None),
+                       ("version", book.version + 1)):
+        set_committed_value(book, key, value)
+    return book
+
+
+def paginate_loans(query, sort: str, limit: int, cursor: Optional[str]):
+    key_columns = Book.id
+    if sort == "due_date":
+        query, key_columns = queries.due_date_order(query)
+    return paginate_query(query.with_entities(*BOOK_COLUMNS), key_columns, limit, cursor)
+
+
+def list_checked_out_books(db: Session, limit: int, cursor: Optional[str] = None, sort: str = "id"):
+    return paginate_loans(queries.checked_out_books(db), sort, limit, cursor)
+
+
+def list_books_by_patron(db: Session, patron_id: int, limit: int, cursor: Optional[str] = None):
+    return paginate_query(queries.books_by_patron(db, patron_id).with_entities(*BOOK_COLUMNS), Book.id, limit,
+                          cursor)
+
+
+def list_overdue_books(db: Session, limit: int, cursor: Optional[str] = None, sort: str = "id"):
+    return paginate_loans(queries.overdue_books(db, datetime.utcnow()), sort, limit, cursor)
+
+
+def list_loans(db: Session, column, value: int, limit: int, cursor: Optional[str] = None,
+               since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Loans with `column` equal to `value`, oldest checkout first, optionally checked out within [since, until)."""
+    query = db.query(*LOAN_COLUMNS).filter(column == value)
+    if since is not None:
+        query = query.filter(Loan.checked_out_at >= since)
+    if until is not None:
+        query = query.filter(Loan.checked_out_at < until)
+    return paginate_query(query, (Loan.checked_out_at, Loan.id), limit, cursor)
+
+
+def list_patron_loans(db: Session, patron_id: int, limit: int, cursor: Optional[str] = None,
+                      since: Optional[datetime] = None, until: Optional[datetime] = None):
+    return list_loans(db, Loan.patron_id, patron_id, limit, cursor, since, until)
+
+
+def list_book_loans(db: Session, book_id: int, limit: int, cursor: Optional[str] = None,
+                    since: Optional[datetime] = None, until: Optional[datetime] = None):
+    return list_loans(db, Loan.book_id, book_id, limit, cursor, since, until)
+
+
+def list_reports(db: Session, limit: int, cursor: Optional[str] = None):
+    return paginate_query(db.query(*REPORT_COLUMNS), WeeklyReport.id, limit, cursor)
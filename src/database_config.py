@@ -1,20 +1,387 @@
-from sqlalchemy import create_engine
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Union, Optional
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, make_url, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, Session
 
+from src import profiling
 from src.model import Base
 
+ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def to_async_url(database_url):
+    """Returns `database_url` with its driver replaced by the matching asyncio driver."""
+    url = make_url(database_url)
+    if url.get_dialect().is_async:
+        return url
+    if url.get_backend_name() not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver is known for '{url.drivername}'")
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+def env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def env_int(name, default=None):
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return int(value)
+
+
+def env_list(name):
+    return [item.strip() for item in os.getenv(name, "").split(",") if item.strip()]
+
+
+# Reads of a client go to the primary until the time in this cookie, which is set after each of its writes
+READ_PRIMARY_COOKIE = "read_primary_until"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+REPLICA_RETRY_SECONDS = 30
+READ_YOUR_WRITES_SECONDS = 5
+
+
+class SyncDatabaseSession:
+    """Runs data access functions on a regular `Session` inside Starlette's threadpool."""
+    # Set by `get_read_db` when the reads of other requests may come from lagging replicas
+    replicated = False
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    async def run(self, fn, *args, **kwargs):
+        return await run_in_threadpool(profiling.profiled(fn), self.session, *args, **kwargs)
+
+    async def close(self):
+        await run_in_threadpool(self.session.close)
+
+
+class AsyncDatabaseSession:
+    """Runs data access functions on an `AsyncSession`, without blocking a thread on I/O."""
+    replicated = False
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def run(self, fn, *args, **kwargs):
+        return await self.session.run_sync(fn, *args, **kwargs)
+
+    async def close(self):
+        await self.session.close()
+
+
+DatabaseSession = Union[SyncDatabaseSession, AsyncDatabaseSession]
+
+
+class Replica:
+    """Engines and session factories of one read replica."""
+
+    def __init__(self, database_url, engine_options, async_mode):
+        self.url = make_url(database_url)
+        self.engine = create_engine(database_url, **engine_options)
+        self.session_local = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                          bind=self.engine)
+        self.async_engine = None
+        if async_mode:
+            self.async_engine = create_async_engine(to_async_url(database_url), **engine_options)
+            self.async_session_local = async_sessionmaker(self.async_engine, autoflush=False,
+                                                          expire_on_commit=False)
+        self.down_until = 0.0
+
+
+class ReplicaSet:
+    """Spreads reads over replicas round-robin.
+
+    A replica that fails to connect is skipped for `retry_seconds`, after which it is tried again.
+    """
+
+    def __init__(self, replicas: list[Replica], retry_seconds=REPLICA_RETRY_SECONDS, clock=time.monotonic):
+        self.replicas = replicas
+        self.retry_seconds = retry_seconds
+        self.clock = clock
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def __iter__(self):
+        return iter(self.replicas)
+
+    def candidates(self) -> list[Replica]:
+        """The healthy replicas, starting with the next one in round-robin order."""
+        if not self.replicas:
+            return []
+        with self._lock:
+            start = next(self._next) % len(self.replicas)
+        now = self.clock()
+        ordered = self.replicas[start:] + self.replicas[:start]
+        return [replica for replica in ordered if replica.down_until <= now]
+
+    def mark_down(self, replica: Replica):
+        replica.down_until = self.clock() + self.retry_seconds
+
+
+def reads_own_writes(request: Request) -> bool:
+    """Whether the client wrote recently enough that the replicas may not have its write yet."""
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def _check_connection(session: Session):
+    session.connection()
+
+
+def _ping(engine):
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
 
 class DatabaseConfig:
-    def __init__(self, database_url=None):
-        if database_url:
-            engine = create_engine(database_url)
-            self.session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-            Base.metadata.create_all(bind=engine)
+    """Engines and sessions of the primary database and its replicas.
+
+    With `lazy`, the engines are only created by `init_engines`, e.g. in the lifespan of the app, so that importing
+    the app does no work. Otherwise they are created right away, along with the tables if `create_schema`.
+    """
+
+    def __init__(self, database_url=None, async_mode=False, pool_size=None, max_overflow=None,
+                 pool_pre_ping=False, pool_recycle=None, replica_urls=(), replica_retry_seconds=REPLICA_RETRY_SECONDS,
+                 read_your_writes_seconds=READ_YOUR_WRITES_SECONDS, create_schema=True, lazy=False):
+        self.database_url = database_url
+        self.async_mode = async_mode
+        self.pool_options = {"pool_size": pool_size, "max_overflow": max_overflow, "pool_pre_ping": pool_pre_ping,
+                             "pool_recycle": pool_recycle}
+        self.replica_urls = list(replica_urls)
+        self.engine = None
+        self.async_engine = None
+        self.read_your_writes_seconds = read_your_writes_seconds
+        self.replicas = ReplicaSet([], replica_retry_seconds)
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        if not lazy:
+            self.init_engines()
+            if create_schema:
+                self.create_schema()
+
+    @classmethod
+    def from_env(cls):
+        return cls(database_url=os.getenv("DATABASE_URL"),
+                   async_mode=env_flag("DATABASE_ASYNC"),
+                   pool_size=env_int("DB_POOL_SIZE"),
+                   max_overflow=env_int("DB_MAX_OVERFLOW"),
+                   pool_pre_ping=env_flag("DB_POOL_PRE_PING"),
+                   pool_recycle=env_int("DB_POOL_RECYCLE"),
+                   replica_urls=env_list("DATABASE_REPLICA_URLS"),
+                   replica_retry_seconds=env_int("DB_REPLICA_RETRY_SECONDS", REPLICA_RETRY_SECONDS),
+                   read_your_writes_seconds=env_int("READ_YOUR_WRITES_SECONDS", READ_YOUR_WRITES_SECONDS),
+                   create_schema=False, lazy=True)
+
+    def init_engines(self):
+        """Creates the engines and session factories, once. No connection is opened yet."""
+        if self._initialized or not self.database_url:
+            return
+        with self._init_lock:
+            if self._initialized or not self.database_url:
+                return
+            engine_options = self._engine_options(self.database_url, **self.pool_options)
+            self.engine = create_engine(self.database_url, **engine_options)
+            self.session_local = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False,
+                                              bind=self.engine)
+            if self.async_mode:
+                self.async_engine = create_async_engine(to_async_url(self.database_url), **engine_options)
+                self.async_session_local = async_sessionmaker(self.async_engine, autoflush=False,
+                                                              expire_on_commit=False)
+            self.replicas.replicas = [Replica(url, self._engine_options(url, **self.pool_options), self.async_mode)
+                                      for url in self.replica_urls]
+            self._initialized = True
+
+    def create_schema(self):
+        """Creates the missing tables on the primary. Replicas get their schema from replication."""
+        self.init_engines()
+        if self.engine is not None:
+            Base.metadata.create_all(bind=self.engine)
+
+    def prewarm(self, connections: int):
+        """Opens `connections` connections of the sessions used by requests, which stay in the pool for them."""
+        self.init_engines()
+        if self.engine is None or connections <= 0:
+            return
+        opened = []
+        try:
+            for _ in range(connections):
+                opened.append(self.engine.connect())
+        finally:
+            for connection in opened:
+                connection.close()
+
+    async def prewarm_async(self, connections: int):
+        self.init_engines()
+        if self.async_engine is None or connections <= 0:
+            return
+        opened = []
+        try:
+            for _ in range(connections):
+                opened.append(await self.async_engine.connect())
+        finally:
+            for connection in opened:
+                await connection.close()
+
+    async def ping(self):
+        """Raises if the primary doesn't answer a trivial query."""
+        self.init_engines()
+        if self.async_engine is not None:
+            async with self.async_engine.connect() as connection:
+                await connection.execute(text("SELECT 1"))
+        elif self.engine is not None:
+            await run_in_threadpool(_ping, self.engine)
+        else:
+            raise RuntimeError("No database is configured")
+
+    async def dispose(self):
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+        for replica in self.replicas:
+            if replica.async_engine is not None:
+                await replica.async_engine.dispose()
+            replica.engine.dispose()
+        if self.engine is not None:
+            self.engine.dispose()
+
+    @staticmethod
+    def _engine_options(database_url, pool_size, max_overflow, pool_pre_ping, pool_recycle):
+        options = {"pool_pre_ping": pool_pre_ping}
+        if pool_recycle is not None:
+            options["pool_recycle"] = pool_recycle
+        # SQLite pools are chosen per driver and don't all accept queue pool sizing
+        if make_url(database_url).get_backend_name() != "sqlite":
+            if pool_size is not None:
+                options["pool_size"] = pool_size
+            if max_overflow is not None:
+                options["max_overflow"] = max_overflow
+        return options
+
+    def _open(self, target) -> DatabaseSession:
+        # Engines are normally created on startup, this covers apps run without their lifespan
+        self.init_engines()
+        if self.async_mode:
+            return AsyncDatabaseSession(target.async_session_local())
+        return SyncDatabaseSession(target.session_local())
+
+    async def _open_replica(self) -> Optional[DatabaseSession]:
+        for replica in self.replicas.candidates():
+            db = self._open(replica)
+            try:
+                await db.run(_check_connection)
+                return db
+            except DBAPIError:
+                await db.close()
+                self.replicas.mark_down(replica)
+        return None
+
+    async def get_db(self):
+        db = self._open(self)
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    async def get_read_db(self, request: Request):
+        """Provides a session for read-only endpoints.
+
+        It is bound to a healthy replica, or to the primary when there is none or the client wrote recently.
+        """
+        db = None
+        self.init_engines()
+        if self.replicas and not reads_own_writes(request):
+            db = await self._open_replica()
+        if db is None:
+            db = self._open(self)
+        db.replicated = bool(self.replicas)
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    def get_read_session_scope(self):
+        """Provides `read_session_scope` to endpoints reading after they return, such as streamed responses.
+
+        Sessions of `get_read_db` are closed before the response is sent, so these endpoints open their own.
+        """
+        return self.read_session_scope
 
-    def get_db(self):
+    @contextmanager
+    def session_scope(self):
+        """Provides a plain `Session` for synchronous callers such as Celery tasks."""
+        self.init_engines()
         db: Session = self.session_local()
         try:
             yield db
         finally:
-            if hasattr(db, "close"):
+            db.close()
+
+    @contextmanager
+    def read_session_scope(self):
+        """Like `session_scope`, but bound to a healthy replica if there is one, for read-only work."""
+        self.init_engines()
+        db: Optional[Session] = None
+        for replica in self.replicas.candidates():
+            db = replica.session_local()
+            try:
+                _check_connection(db)
+                break
+            except DBAPIError:
                 db.close()
+                db = None
+                self.replicas.mark_down(replica)
+        if db is None:
+            db = self.session_local()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+class ReadYourWritesMiddleware:
+    """Sets the `read_primary_until` cookie on successful writes.
+
+    Until it expires, `get_read_db` serves the client from the primary, so that it reads its own writes even when
+    the replicas lag behind.
+    """
+
+    def __init__(self, app, window_seconds: float):
+        self.app = app
+        self.window_seconds = window_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS:
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                until = time.time() + self.window_seconds
+                cookie = (f"{READ_PRIMARY_COOKIE}={until:.3f}; Max-Age={math.ceil(self.window_seconds)}; Path=/; "
+                          f"HttpOnly; SameSite=Lax")
+                message = {**message, "headers": [*message.get("headers", []), (b"set-cookie", cookie.encode())]}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
@@ -0,0 +1,35 @@
+"""Entity tags of books and patrons, derived from their row version."""
+from typing import Optional
+
+
+def make_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def _tags(header: str) -> list[str]:
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+
+def none_match(header: Optional[str], version: int) -> bool:
+    """Evaluates `If-None-Match`: False if the client already has `version`, with weak comparison."""
+    if header is None:
+        return True
+    etag = make_etag(version)
+    return not any(tag == "*" or tag.removeprefix("W/") == etag for tag in _tags(header))
+
+
+def match_versions(header: Optional[str]) -> Optional[list[int]]:
+    """Parses `If-Match` into the versions it accepts, or None if any version is accepted.
+
+    Weak and malformed tags never match strongly, so they are left out and a request with only such tags fails.
+    """
+    if header is None:
+        return None
+    tags = _tags(header)
+    if "*" in tags:
+        return None
+    versions = []
+    for tag in tags:
+        if len(tag) > 2 and tag[0] == tag[-1] == '"' and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
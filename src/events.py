@@ -0,0 +1,186 @@
+"""Book events pushed to clients over SSE and WebSocket, so that they don't need to poll for availability.
+
+Every checkout, return, update and delete publishes an event with an increasing `id`. The most recent
+`history_size` events are kept, so that a client reconnecting with the id of the last event it got receives the
+events it missed. The memory broker only reaches the clients of its own worker; the Redis broker fans events out
+to every worker through pub/sub.
+"""
+import asyncio
+import json
+import os
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import AsyncIterator, Iterable, Optional
+
+CHECKOUT = "checkout"
+RETURN = "return"
+UPDATE = "update"
+DELETE = "delete"
+# Sent first to a client resuming from an event that isn't kept anymore, which should then reload its state
+RESET = "reset"
+
+DEFAULT_HISTORY_SIZE = 1000
+# A subscriber further behind than this is disconnected, it can resume from its last event id
+MAX_PENDING_EVENTS = 1000
+# Takes the next id, stores and publishes the event in one step, so that events are published in id order and an id
+# is never taken without its event. ARGV[1] is the event as JSON without its id.
+PUBLISH_SCRIPT = """
+local event_id = redis.call('INCR', KEYS[1])
+local payload = '{"id": ' .. event_id .. ', ' .. string.sub(ARGV[1], 2)
+redis.call('ZADD', KEYS[2], event_id, payload)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+redis.call('PUBLISH', ARGV[3], payload)
+return event_id
+"""
+
+
+class EventBroker(ABC):
+    def __init__(self, history_size=DEFAULT_HISTORY_SIZE):
+        self.history_size = history_size
+
+    @classmethod
+    def from_env(cls):
+        backend_name = os.getenv("EVENTS_BACKEND", "memory")
+        history_size = int(os.getenv("EVENTS_HISTORY_SIZE") or DEFAULT_HISTORY_SIZE)
+        if backend_name == "memory":
+            return MemoryBroker(history_size)
+        if backend_name == "redis":
+            from redis.asyncio import Redis
+
+            redis_url = os.getenv("EVENTS_REDIS_URL") or os.getenv("CELERY_BROKER_URL")
+            return RedisBroker(Redis.from_url(redis_url), history_size)
+        raise ValueError(f"Unknown events backend '{backend_name}'")
+
+    @abstractmethod
+    async def publish(self, event_type: str, book_id: int, data: Optional[dict] = None) -> dict:
+        """Publishes an event about a book, returning it with its id."""
+
+    @abstractmethod
+    def _events(self, last_event_id: Optional[int], keepalive_seconds: float) -> AsyncIterator[Optional[dict]]:
+        """Yields the events after `last_event_id`, then new ones as they come, with None for keepalives."""
+
+    async def subscribe(self, book_ids: Optional[Iterable[int]] = None, last_event_id: Optional[int] = None,
+                        keepalive_seconds: float = 15) -> AsyncIterator[Optional[dict]]:
+        """Yields the events of `book_ids`, or of all books, starting after `last_event_id` if given.
+
+        None is yielded when no event came for `keepalive_seconds`, so that callers can keep the connection alive.
+        """
+        book_ids = set(book_ids or ())
+        async for event in self._events(last_event_id, keepalive_seconds):
+            if event is None or not book_ids or event["type"] == RESET or event["book_id"] in book_ids:
+                yield event
+
+
+def make_event(event_id: int, event_type: str, book_id: int, data: Optional[dict]) -> dict:
+    return {"id": event_id, "type": event_type, "book_id": book_id, "data": data}
+
+
+def missed_events(history: list[dict], last_event_id: Optional[int]) -> list[dict]:
+    """The events of `history`, oldest first, that came after `last_event_id`, led by a reset if some are lost."""
+    if last_event_id is None:
+        return []
+    missed = [event for event in history if event["id"] > last_event_id]
+    oldest_id = missed[0]["id"] if missed else None
+    if oldest_id is not None and oldest_id > last_event_id + 1:
+        return [{"id": None, "type": RESET, "book_id": None, "data": None}] + missed
+    return missed
+
+
+class MemoryBroker(EventBroker):
+    """Events of a single worker, for running one worker and for tests."""
+
+    def __init__(self, history_size=DEFAULT_HISTORY_SIZE):
+        super().__init__(history_size)
+        self.last_id = 0
+        self._history = deque(maxlen=history_size)
+        self._subscribers: set[asyncio.Queue] = set()
+
+    async def publish(self, event_type: str, book_id: int, data: Optional[dict] = None) -> dict:
+        self.last_id += 1
+        event = make_event(self.last_id, event_type, book_id, data)
+        self._history.append(event)
+        for queue in list(self._subscribers):
+            if queue.qsize() >= MAX_PENDING_EVENTS:
+                self._subscribers.discard(queue)
+                queue.put_nowait(None)
+            else:
+                queue.put_nowait(event)
+        return event
+
+    async def _events(self, last_event_id, keepalive_seconds):
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        try:
+            for event in missed_events(list(self._history), last_event_id):
+                yield event
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event is None:
+                    return
+                yield event
+        finally:
+            self._subscribers.discard(queue)
+
+
+class RedisBroker(EventBroker):
+    """Events shared by all workers: published on a Redis channel and kept in a sorted set by id.
+
+    Ids are taken and events published by a Lua script, so that no publish of another worker comes in between.
+    """
+
+    def __init__(self, client, history_size=DEFAULT_HISTORY_SIZE, prefix="library:events"):
+        super().__init__(history_size)
+        self.client = client
+        self.channel = prefix
+        self.counter_key = f"{prefix}:last_id"
+        self.history_key = f"{prefix}:history"
+        self._publish_script = client.register_script(PUBLISH_SCRIPT)
+
+    async def publish(self, event_type: str, book_id: int, data: Optional[dict] = None) -> dict:
+        without_id = json.dumps({"type": event_type, "book_id": book_id, "data": data})
+        event_id = await self._publish_script(keys=[self.counter_key, self.history_key],
+                                              args=[without_id, self.history_size, self.channel])
+        return make_event(int(event_id), event_type, book_id, data)
+
+    async def _events(self, last_event_id, keepalive_seconds):
+        pubsub = self.client.pubsub()
+        # Subscribed before the history is read, so that no event falls between the two
+        await pubsub.subscribe(self.channel)
+        try:
+            replayed = set()
+            if last_event_id is not None:
+                history = [json.loads(payload) for payload in
+                           await self.client.zrangebyscore(self.history_key, f"({last_event_id}", "+inf")]
+                for event in missed_events(history, last_event_id):
+                    replayed.add(event["id"])
+                    yield event
+            loop = asyncio.get_running_loop()
+            keepalive_at = loop.time() + keepalive_seconds
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True,
+                                                   timeout=max(0.0, keepalive_at - loop.time()))
+                if message is None:
+                    # Also returned right away for an ignored subscribe confirmation
+                    if loop.time() >= keepalive_at:
+                        keepalive_at = loop.time() + keepalive_seconds
+                        yield None
+                    continue
+                keepalive_at = loop.time() + keepalive_seconds
+                event = json.loads(message["data"])
+                if event["id"] not in replayed:
+                    yield event
+        finally:
+            await pubsub.unsubscribe(self.channel)
+            await pubsub.aclose()
+
+
+def sse_message(event: Optional[dict]) -> str:
+    """Formats an event for a `text/event-stream` response, or a keepalive comment for None."""
+    if event is None:
+        return ": keepalive\n\n"
+    lines = f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    return lines if event["id"] is None else f"id: {event['id']}\n{lines}"
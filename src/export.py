@@ -0,0 +1,144 @@
+"""Exports whole tables as CSV, NDJSON or Parquet with constant memory.
+
+Rows are read in keyset-paginated batches of `EXPORT_BATCH_SIZE` within one transaction, and every batch is encoded
+and handed on before the next one is read. Unlike `yield_per`, this doesn't depend on the driver supporting
+server-side cursors, which mysql-connector doesn't, so memory stays flat on every database.
+"""
+import csv
+import io
+import zlib
+from datetime import datetime
+from typing import Iterable, Iterator
+
+import orjson
+from sqlalchemy import select, Boolean, DateTime, Integer, String
+from sqlalchemy.orm import Session
+
+from src.config import EXPORT_BATCH_SIZE
+from src.crud import BOOK_COLUMNS, PATRON_COLUMNS
+from src.model import Book, Patron
+
+# Exported tables as (key column, exported columns)
+TABLES = {
+    "books": (Book.id, BOOK_COLUMNS),
+    "patrons": (Patron.id, PATRON_COLUMNS),
+}
+FORMATS = ("csv", "ndjson", "parquet")
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+GZIP_MEDIA_TYPE = "application/gzip"
+
+
+def file_name(table: str, export_format: str, compress: bool) -> str:
+    return f"{table}.{export_format}" + (".gz" if compress else "")
+
+
+def media_type(export_format: str, compress: bool) -> str:
+    return GZIP_MEDIA_TYPE if compress else MEDIA_TYPES[export_format]
+
+
+def read_batches(db: Session, table: str, batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[list]:
+    """Reads the rows of `table` in key order, `batch_size` rows at a time."""
+    key_column, columns = TABLES[table]
+    key_index = [column.key for column in columns].index(key_column.key)
+    last_key = None
+    while True:
+        query = select(*columns).order_by(key_column).limit(batch_size)
+        if last_key is not None:
+            query = query.where(key_column > last_key)
+        rows = db.execute(query).all()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        last_key = rows[-1][key_index]
+
+
+def encode_csv(fields: list[str], batches: Iterable[list]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for rows in batches:
+        writer.writerows([value.isoformat() if isinstance(value, datetime) else value for value in row]
+                         for row in rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def encode_ndjson(fields: list[str], batches: Iterable[list]) -> Iterator[bytes]:
+    for rows in batches:
+        yield b"".join(orjson.dumps(dict(zip(fields, row)), option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+
+
+class _Chunks(io.RawIOBase):
+    """A write-only file collecting what is written to it until it is taken."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def encode_parquet(fields: list[str], columns, batches: Iterable[list]) -> Iterator[bytes]:
+    """Writes every batch as a row group, yielding the bytes of each row group once it is written."""
+    # Imported here, since pyarrow takes a while to import and only this format needs it
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {Integer: pa.int64(), String: pa.string(), DateTime: pa.timestamp("us"), Boolean: pa.bool_()}
+    schema = pa.schema([(field, arrow_types[type(column.type)]) for field, column in zip(fields, columns)])
+    sink = _Chunks()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in batches:
+            writer.write_table(pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in
+                                                     zip(zip(*rows), schema)], schema=schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(db: Session, table: str, export_format: str, compress: bool = False,
+           batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[bytes]:
+    """Encodes the rows of `table` in `export_format`, gzipped if `compress`, as a stream of byte chunks."""
+    _, columns = TABLES[table]
+    fields = [column.key for column in columns]
+    batches = read_batches(db, table, batch_size)
+    if export_format == "csv":
+        chunks = encode_csv(fields, batches)
+    elif export_format == "ndjson":
+        chunks = encode_ndjson(fields, batches)
+    elif export_format == "parquet":
+        chunks = encode_parquet(fields, columns, batches)
+    else:
+        raise ValueError(f"Unknown export format '{export_format}'")
+    return gzipped(chunks) if compress else chunks
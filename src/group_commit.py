@@ -0,0 +1,95 @@
+import asyncio
+import os
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+from src.database_config import DatabaseSession
+
+DEFAULT_MAX_ROWS = 256
+
+
+class _Batch:
+    def __init__(self):
+        self.items = []
+        self.futures = []
+        self.full = asyncio.Event()
+
+    def add(self, item) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.items.append(item)
+        self.futures.append(future)
+        return future
+
+    def resolve(self, results):
+        for future, result in zip(self.futures, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def fail(self, error: BaseException):
+        self.resolve([error] * len(self.futures))
+
+
+class GroupCommit:
+    """Writes the rows of concurrent requests with one INSERT and one commit.
+
+    The first request to arrive leads a batch: it waits up to `window_seconds` for other requests to join, or until
+    `max_rows` have, and then writes the whole batch through its own session. Every request gets back its own row,
+    or the error of its own row.
+
+    Args:
+        write: Data access function called with a session and the items of a batch. It returns, in order, the
+            result or the exception of each item.
+        window_seconds: How long a batch stays open, 0 disables batching.
+        max_rows: Number of items that closes a batch early.
+    """
+
+    def __init__(self, write: Callable[[Session, list], list], window_seconds: float = 0,
+                 max_rows: int = DEFAULT_MAX_ROWS):
+        self.write = write
+        self.window_seconds = window_seconds
+        self.max_rows = max_rows
+        self._batch = None
+
+    @classmethod
+    def from_env(cls, write: Callable[[Session, list], list]):
+        return cls(write,
+                   window_seconds=float(os.getenv("GROUP_COMMIT_WINDOW_MS") or 0) / 1000,
+                   max_rows=int(os.getenv("GROUP_COMMIT_MAX_ROWS") or DEFAULT_MAX_ROWS))
+
+    @property
+    def enabled(self):
+        return self.window_seconds > 0
+
+    async def submit(self, db: DatabaseSession, item):
+        """Writes `item` along with the items submitted concurrently, returning its result."""
+        if self._batch is not None:
+            return await self._add(self._batch, item)
+
+        batch = self._batch = _Batch()
+        future = self._add(batch, item)
+        try:
+            try:
+                await asyncio.wait_for(batch.full.wait(), self.window_seconds)
+            except asyncio.TimeoutError:
+                pass
+            if self._batch is batch:
+                self._batch = None
+            batch.resolve(await db.run(self.write, batch.items))
+        except BaseException as e:
+            # Requests that joined the batch must not wait forever if the leader fails or is cancelled
+            if self._batch is batch:
+                self._batch = None
+            batch.fail(e)
+        return await future
+
+    def _add(self, batch: _Batch, item) -> asyncio.Future:
+        future = batch.add(item)
+        if len(batch.items) >= self.max_rows:
+            self._batch = None
+            batch.full.set()
+        return future
@@ -0,0 +1,282 @@
+"""Email delivery for the Celery tasks.
+
+Messages are sent by a few threads sharing a pool of persistent SMTP connections, at most `rate_per_second` a
+second. Transient failures are retried with exponential backoff, and a message with a `dedup_key` is sent at most
+once while its key is remembered, e.g. one overdue digest per patron and day.
+"""
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from typing import Optional
+
+from src.database_config import env_flag
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SENDER = "library@localhost"
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RATE_PER_SECOND = 20
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BACKOFF_SECONDS = 1
+DEFAULT_DEDUP_TTL_SECONDS = 24 * 60 * 60
+SMTP_TIMEOUT_SECONDS = 30
+
+
+class Email:
+    def __init__(self, to: str, subject: str, body: str, dedup_key: Optional[str] = None):
+        self.to = to
+        self.subject = subject
+        self.body = body
+        self.dedup_key = dedup_key
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions a second on average, in bursts of up to `capacity`. A rate of 0 is unlimited."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting for one to be added if there is none."""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class MemoryDeduplicator:
+    """Remembers keys for `ttl_seconds` in this process only.
+
+    Processes of the prefork pool each have their own, so it doesn't prevent duplicates sent by different processes.
+    """
+
+    def __init__(self, ttl_seconds=DEFAULT_DEDUP_TTL_SECONDS, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        # In insertion order, which is also expiry order since every key is kept for the same time
+        self._expiries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key: str) -> bool:
+        """Remembers `key`, returning False if it was remembered already."""
+        with self._lock:
+            now = self.clock()
+            self._remove_expired(now)
+            if key in self._expiries:
+                return False
+            self._expiries[key] = now + self.ttl_seconds
+            return True
+
+    def _remove_expired(self, now: float):
+        while self._expiries:
+            key, expiry = next(iter(self._expiries.items()))
+            if expiry > now:
+                return
+            self._expiries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def release(self, key: str):
+        with self._lock:
+            self._expiries.pop(key, None)
+
+
+class RedisDeduplicator:
+    """Remembers keys in Redis, so that all workers share them."""
+
+    def __init__(self, client, ttl_seconds=DEFAULT_DEDUP_TTL_SECONDS, prefix="library:email:"):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def claim(self, key: str) -> bool:
+        return bool(self.client.set(self.prefix + key, 1, nx=True, ex=self.ttl_seconds))
+
+    def release(self, key: str):
+        self.client.delete(self.prefix + key)
+
+
+class LogTransport:
+    """Logs messages instead of sending them, used when no SMTP server is configured."""
+
+    def send(self, email: Email):
+        logger.info(f"Sending email to {email.to} with subject '{email.subject}' and body '{email.body}'")
+
+    def close(self):
+        pass
+
+
+class SmtpPool:
+    """Sends messages over SMTP connections that are kept open and reused.
+
+    A connection is opened when every open one is in use, so there are as many as messages sent concurrently.
+    """
+
+    def __init__(self, host: str, port: int = 25, sender: str = DEFAULT_SENDER, username: Optional[str] = None,
+                 password: Optional[str] = None, starttls: bool = False, timeout: float = SMTP_TIMEOUT_SECONDS):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.connections_opened = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        with self._lock:
+            self.connections_opened += 1
+        return smtp
+
+    def _message(self, email: Email) -> EmailMessage:
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = email.to
+        message["Subject"] = email.subject
+        message.set_content(email.body)
+        return message
+
+    def send(self, email: Email):
+        message = self._message(email)
+        try:
+            smtp, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            smtp, reused = self._connect(), False
+        try:
+            try:
+                smtp.send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                if not reused:
+                    raise
+                # Servers close idle connections, so a pooled one may be gone already
+                smtp = self._connect()
+                smtp.send_message(message)
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # The server rejected the message, the connection itself is still usable
+            self._idle.put(smtp)
+            raise
+        except OSError:
+            _close(smtp)
+            raise
+        self._idle.put(smtp)
+
+    def close(self):
+        while True:
+            try:
+                _close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+def _close(smtp: smtplib.SMTP):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp.close()
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether sending may succeed when tried again: 4xx replies and connection failures, but not 5xx replies."""
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    return isinstance(error, OSError)
+
+
+class Mailer:
+    """Sends batches of emails concurrently, rate limited, retried and deduplicated."""
+
+    def __init__(self, transport, concurrency=DEFAULT_CONCURRENCY, rate_per_second=DEFAULT_RATE_PER_SECOND,
+                 deduplicator=None, max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_seconds=DEFAULT_BACKOFF_SECONDS,
+                 sleep=time.sleep):
+        self.transport = transport
+        self.concurrency = concurrency
+        self.rate_limiter = TokenBucket(rate_per_second)
+        self.deduplicator = deduplicator or MemoryDeduplicator()
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.sleep = sleep
+
+    @classmethod
+    def from_env(cls):
+        host = os.getenv("SMTP_HOST")
+        transport = LogTransport()
+        if host:
+            transport = SmtpPool(host, int(os.getenv("SMTP_PORT") or 25),
+                                 sender=os.getenv("EMAIL_SENDER") or DEFAULT_SENDER,
+                                 username=os.getenv("SMTP_USERNAME") or None,
+                                 password=os.getenv("SMTP_PASSWORD") or None,
+                                 starttls=env_flag("SMTP_STARTTLS"))
+        deduplicator = MemoryDeduplicator()
+        if os.getenv("EMAIL_DEDUP_BACKEND", "memory") == "redis":
+            from redis import Redis
+
+            deduplicator = RedisDeduplicator(Redis.from_url(os.getenv("CELERY_BROKER_URL")))
+        return cls(transport,
+                   concurrency=int(os.getenv("EMAIL_CONCURRENCY") or DEFAULT_CONCURRENCY),
+                   rate_per_second=float(os.getenv("EMAIL_RATE_PER_SECOND") or DEFAULT_RATE_PER_SECOND),
+                   deduplicator=deduplicator,
+                   max_attempts=int(os.getenv("EMAIL_MAX_ATTEMPTS") or DEFAULT_MAX_ATTEMPTS),
+                   backoff_seconds=float(os.getenv("EMAIL_RETRY_BACKOFF_SECONDS") or DEFAULT_BACKOFF_SECONDS))
+
+    def send_all(self, emails: list[Email]) -> dict:
+        """Sends `emails`, returning how many were sent, skipped as duplicates, retried and failed."""
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            outcomes = list(executor.map(self._deliver, emails))
+        seconds = time.perf_counter() - started
+        attempts = Counter()
+        for outcome, attempt_count in outcomes:
+            attempts[outcome] += 1
+            attempts["retries"] += max(0, attempt_count - 1)
+        return {"sent": attempts["sent"], "duplicates": attempts["duplicate"], "failed": attempts["failed"],
+                "retries": attempts["retries"], "seconds": round(seconds, 3),
+                "messages_per_second": round(attempts["sent"] / seconds, 1) if seconds and attempts["sent"] else 0}
+
+    def _deliver(self, email: Email) -> tuple[str, int]:
+        if email.dedup_key and not self.deduplicator.claim(email.dedup_key):
+            return "duplicate", 0
+        for attempt in range(1, self.max_attempts + 1):
+            self.rate_limiter.acquire()
+            try:
+                self.transport.send(email)
+                return "sent", attempt
+            except Exception as e:
+                if attempt == self.max_attempts or not is_transient(e):
+                    logger.warning(f"Couldn't send email to {email.to} after {attempt} attempt(s): {e}")
+                    if email.dedup_key:
+                        self.deduplicator.release(email.dedup_key)
+                    return "failed", attempt
+                self.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,253 @@
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, \
+    CONTENT_TYPE_LATEST, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from src import profiling
+
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+DB_SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+TASK_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+UNMATCHED_ROUTE = "unmatched"
+# Set for several uvicorn workers or the prefork Celery pool, whose processes each write their metrics to files there
+MULTIPROCESS_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROCESS_DIR:
+    # Metrics without labels write their file as soon as they are defined
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+
+REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route"])
+REQUEST_BYTES = Histogram("http_request_size_bytes", "HTTP request body size", ["method", "route"],
+                          buckets=SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram("http_response_size_bytes", "HTTP response body size", ["method", "route"],
+                           buckets=SIZE_BUCKETS)
+REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests being handled", ["method"],
+                             multiprocess_mode="livesum")
+REQUEST_QUERIES = Histogram("http_request_db_queries", "Database queries per HTTP request", ["method", "route"],
+                            buckets=QUERY_COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds", "Database time per HTTP request", ["method", "route"],
+                               buckets=DB_SECONDS_BUCKETS)
+ADMISSION_ACTIVE = Gauge("admission_active_requests", "Requests admitted and being handled", ["route_class"],
+                         multiprocess_mode="livesum")
+ADMISSION_QUEUED = Gauge("admission_queued_requests", "Requests waiting to be admitted", ["route_class"],
+                         multiprocess_mode="livesum")
+ADMISSION_SHED = Counter("admission_shed_total", "Requests answered with 503 instead of being admitted",
+                         ["route_class", "reason"])
+QUERY_SECONDS = Histogram("db_query_duration_seconds", "Database query latency", buckets=DB_SECONDS_BUCKETS)
+QUERY_ERRORS = Counter("db_query_errors_total", "Database queries that raised an error")
+
+# Written by the processes owning the engines when metrics are shared through files, since a collector only sees the
+# engines of the process serving the metrics. Not registered, the files are read by the multiprocess collector.
+POOL_CHECKED_OUT = Gauge("db_pool_checked_out", "Connections in use", ["engine"], multiprocess_mode="livesum",
+                         registry=None)
+POOL_OVERFLOW = Gauge("db_pool_overflow", "Connections opened beyond the pool size", ["engine"],
+                      multiprocess_mode="livesum", registry=None)
+POOL_SIZE = Gauge("db_pool_size", "Configured pool size", ["engine"], multiprocess_mode="livesum", registry=None)
+
+TASKS = Counter("celery_tasks_total", "Celery tasks run", ["task", "state"])
+TASK_SECONDS = Histogram("celery_task_duration_seconds", "Celery task run time", ["task"],
+                         buckets=TASK_SECONDS_BUCKETS)
+TASK_QUERIES = Histogram("celery_task_db_queries", "Database queries per Celery task", ["task"],
+                         buckets=QUERY_COUNT_BUCKETS + (1000, 10000, 100000))
+TASK_DB_SECONDS = Histogram("celery_task_db_seconds", "Database time per Celery task", ["task"],
+                            buckets=TASK_SECONDS_BUCKETS)
+
+
+class QueryStats:
+    """Number of queries and the time spent in them, for the request or task being handled."""
+    __slots__ = ("queries", "seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+# Shared by reference with the threadpool and greenlets running the queries of the current request or task
+query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+# The start time is kept on the execution context, which is discarded after each statement, failed or not
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "query_started", None)
+    if started is not None:
+        _record_query(statement, time.perf_counter() - started)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    started = getattr(exception_context.execution_context, "query_started", None)
+    if started is not None:
+        QUERY_ERRORS.inc()
+        _record_query(exception_context.statement or "", time.perf_counter() - started)
+
+
+def _record_query(statement, seconds):
+    QUERY_SECONDS.observe(seconds)
+    stats = query_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += seconds
+    profiling.record_statement(statement, seconds)
+
+
+class PoolCollector:
+    """Reports the connection pool usage of the registered engines when metrics are scraped."""
+
+    def __init__(self):
+        self.engines = {}
+
+    def collect(self):
+        checked_out = GaugeMetricFamily("db_pool_checked_out", "Connections in use", labels=["engine"])
+        overflow = GaugeMetricFamily("db_pool_overflow", "Connections opened beyond the pool size",
+                                     labels=["engine"])
+        size = GaugeMetricFamily("db_pool_size", "Configured pool size", labels=["engine"])
+        for name, engine in self.engines.items():
+            pool = engine.pool
+            # Only queue pools keep these numbers, e.g. in-memory SQLite uses a singleton pool
+            if hasattr(pool, "checkedout"):
+                checked_out.add_metric([name], pool.checkedout())
+                overflow.add_metric([name], max(pool.overflow(), 0))
+                size.add_metric([name], pool.size())
+        return [checked_out, overflow, size]
+
+
+pool_collector = PoolCollector()
+REGISTRY.register(pool_collector)
+
+
+def track_engine(name: str, engine):
+    """Adds the connection pool of `engine`, sync or async, to the scraped metrics."""
+    engine = getattr(engine, "sync_engine", engine)
+    if not MULTIPROCESS_DIR:
+        pool_collector.engines[name] = engine
+        return
+    pool = engine.pool
+    if not hasattr(pool, "checkedout"):
+        return
+
+    def write_pool_usage(*args):
+        POOL_CHECKED_OUT.labels(name).set(pool.checkedout())
+        POOL_OVERFLOW.labels(name).set(max(pool.overflow(), 0))
+
+    POOL_SIZE.labels(name).set(pool.size())
+    write_pool_usage()
+    event.listen(pool, "checkout", write_pool_usage)
+    event.listen(pool, "checkin", write_pool_usage)
+
+
+def registry():
+    """The registry to expose: the metrics of all worker processes when `PROMETHEUS_MULTIPROC_DIR` is set."""
+    if not MULTIPROCESS_DIR:
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    return collected
+
+
+def remove_stale_files():
+    """Removes the metric files of processes from earlier runs, before the worker processes are started."""
+    if not MULTIPROCESS_DIR:
+        return
+    own_suffix = f"_{os.getpid()}.db"
+    for file_name in os.listdir(MULTIPROCESS_DIR):
+        if file_name.endswith(".db") and not file_name.endswith(own_suffix):
+            os.remove(os.path.join(MULTIPROCESS_DIR, file_name))
+
+
+def process_exited():
+    """Drops the live gauges of the current process, e.g. its requests in progress and pool usage."""
+    if MULTIPROCESS_DIR:
+        multiprocess.mark_process_dead(os.getpid(), MULTIPROCESS_DIR)
+
+
+def render():
+    """Returns the metrics in the Prometheus text format, with their content type."""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, body sizes and database usage per route.
+
+    Routes are labelled with their path template, e.g. `/books/{book_id}`, which the router adds to the scope.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        status = 500
+        request_bytes = 0
+        response_bytes = 0
+
+        async def receive_wrapper():
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                request_bytes += len(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        stats = QueryStats()
+        token = query_stats.set(stats)
+        in_progress = REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_progress.dec()
+            query_stats.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path_format", None) or UNMATCHED_ROUTE
+            REQUESTS.labels(method, route, str(status)).inc()
+            REQUEST_SECONDS.labels(method, route).observe(elapsed)
+            REQUEST_BYTES.labels(method, route).observe(request_bytes)
+            RESPONSE_BYTES.labels(method, route).observe(response_bytes)
+            REQUEST_QUERIES.labels(method, route).observe(stats.queries)
+            REQUEST_DB_SECONDS.labels(method, route).observe(stats.seconds)
+
+
+_running_tasks = {}
+
+
+def task_started(task_id):
+    stats = QueryStats()
+    _running_tasks[task_id] = (time.perf_counter(), stats, query_stats.set(stats))
+
+
+def task_finished(task_id, task, state):
+    running = _running_tasks.pop(task_id, None)
+    if running is None:
+        return
+    started, stats, token = running
+    query_stats.reset(token)
+    TASKS.labels(task.name, state or "UNKNOWN").inc()
+    TASK_SECONDS.labels(task.name).observe(time.perf_counter() - started)
+    TASK_QUERIES.labels(task.name).observe(stats.queries)
+    TASK_DB_SECONDS.labels(task.name).observe(stats.seconds)
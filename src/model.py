@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Date
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Date, Index, DDL, event
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
@@ -6,21 +6,89 @@ Base = declarative_base()
 
 class Book(Base):
     __tablename__ = "books"
+    __table_args__ = (
+        # Serves the checked-out and overdue listings, ordered by due date
+        Index("ix_books_is_checked_out_due_date", "is_checked_out", "due_date"),
+        # Ids of deleted books aren't reused, their loan history would be shown as that of the new book
+        {"sqlite_autoincrement": True},
+    )
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(255), index=True)
     author = Column(String(255), index=True)
     isbn = Column(String(17), index=True, nullable=True)
-    published_year = Column(Integer, nullable=True)
+    published_year = Column(Integer, index=True, nullable=True)
     is_checked_out = Column(Boolean, default=False)
     due_date = Column(DateTime, nullable=True)
-    patron_id = Column(Integer, ForeignKey("patrons.id"), nullable=True)
+    patron_id = Column(Integer, ForeignKey("patrons.id"), index=True, nullable=True)
+    # Incremented by every change, ORM flushes check it; Core updates must increment it themselves
+    version = Column(Integer, nullable=False, default=1)
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+# Backs GET /books/search on MySQL, other databases use the in-process index of src/search.py
+event.listen(
+    Book.__table__,
+    "after_create",
+    DDL("ALTER TABLE books ADD FULLTEXT INDEX ft_books_title_author_isbn (title, author, isbn)")
+    .execute_if(dialect="mysql"),
+)
 
 
 class Patron(Base):
     __tablename__ = "patrons"
+    __table_args__ = {"sqlite_autoincrement": True}
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(255), index=True)
     phone_number = Column(String(20))
     email = Column(String(255))
     membership_start_date = Column(DateTime)
-    checked_out_books = relationship("Book", backref="patron")
+    version = Column(Integer, nullable=False, default=1)
+    # Write-only, so that a patron's books are never loaded as a whole; query them through `.select()`
+    checked_out_books = relationship("Book", backref="patron", lazy="write_only", passive_deletes=True)
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+class Loan(Base):
+    """One checkout of a book, kept after the book is returned."""
+    __tablename__ = "loans"
+    __table_args__ = (
+        # Serve the loan history of a patron and of a book, in checkout order
+        Index("ix_loans_patron_id_checked_out_at", "patron_id", "checked_out_at"),
+        Index("ix_loans_book_id_checked_out_at", "book_id", "checked_out_at"),
+    )
+    id = Column(Integer, primary_key=True)
+    # Not foreign keys, so that the history outlives deleted books and patrons
+    book_id = Column(Integer, nullable=False)
+    patron_id = Column(Integer, nullable=False)
+    checked_out_at = Column(DateTime, nullable=False)
+    due_date = Column(DateTime, nullable=False)
+    returned_at = Column(DateTime, nullable=True)
+
+
+class CirculationCounter(Base):
+    """Running totals of the catalogue, kept up to date by the circulation endpoints."""
+    __tablename__ = "circulation_counters"
+    name = Column(String(32), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+
+class LoanDueDay(Base):
+    """Number of open loans per due date, from which overdue counts are derived without scanning books."""
+    __tablename__ = "loan_due_days"
+    due_day = Column(Date, primary_key=True)
+    loans = Column(Integer, nullable=False, default=0)
+
+
+class WeeklyReport(Base):
+    __tablename__ = "weekly_reports"
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime, nullable=False, index=True)
+    total = Column(Integer, nullable=False)
+    in_library = Column(Integer, nullable=False)
+    checked_out = Column(Integer, nullable=False)
+    overdue = Column(Integer, nullable=False)
+    overdue_1_7_days = Column(Integer, nullable=False)
+    overdue_8_30_days = Column(Integer, nullable=False)
+    overdue_over_30_days = Column(Integer, nullable=False)
@@ -1,10 +1,13 @@
 import datetime
-from typing import Optional
+from typing import Optional, Generic, TypeVar, Literal
 
-from pydantic import BaseModel, constr, field_validator
+from pydantic import BaseModel, ConfigDict, constr, conlist, field_validator
 
+from src.config import BULK_CHECKOUT_MAX_BOOKS
 from src.util import is_valid_isbn, is_valid_email
 
+T = TypeVar("T")
+
 
 class BookCreateDto(BaseModel):
     title: constr(max_length=255)
@@ -32,9 +35,9 @@ class BookDto(BookCreateDto):
     is_checked_out: bool
     due_date: Optional[datetime.datetime]
     patron_id: Optional[int]
+    version: int
 
-    class ConfigDict:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class PatronCreateDto(BaseModel):
@@ -60,6 +63,71 @@ class PatronUpdateDto(PatronCreateDto):
 class PatronDto(PatronCreateDto):
     id: int
     membership_start_date: datetime.datetime
+    version: int
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class PageDto(BaseModel, Generic[T]):
+    items: list[T]
+    next_cursor: Optional[str] = None
+
+
+class LookupDto(BaseModel, Generic[T]):
+    items: list[Optional[T]]
+    not_found: list[int]
+
+
+class BulkImportErrorDto(BaseModel):
+    row: int
+    errors: list[dict]
+
+
+class BulkImportAbortDto(BaseModel):
+    row: int
+    message: str
+
+
+class BulkImportResultDto(BaseModel):
+    received: int
+    inserted: int
+    failed: int
+    errors: list[BulkImportErrorDto]
+    aborted: Optional[BulkImportAbortDto] = None
 
-    class ConfigDict:
-        from_attributes = True
+
+class ReportDto(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    created_at: datetime.datetime
+    total: int
+    in_library: int
+    checked_out: int
+    overdue: int
+    overdue_1_7_days: int
+    overdue_8_30_days: int
+    overdue_over_30_days: int
+
+
+class LoanDto(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    book_id: int
+    patron_id: int
+    checked_out_at: datetime.datetime
+    due_date: datetime.datetime
+    returned_at: Optional[datetime.datetime]
+
+
+class BulkCheckoutDto(BaseModel):
+    patron_id: int
+    book_ids: conlist(int, min_length=1, max_length=BULK_CHECKOUT_MAX_BOOKS)
+    checkout_period: int = 14
+
+
+class BulkCheckoutResultDto(BaseModel):
+    book_id: int
+    status: Literal["checked_out", "already_checked_out", "not_found"]
+    due_date: Optional[datetime.datetime] = None
@@ -0,0 +1,86 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Sequence
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Query
+
+
+def encode_cursor(*key_values) -> str:
+    """Encodes the sort key of the last returned row into an opaque cursor string."""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in key_values]
+    payload = json.dumps({"k": values}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, key_columns: Sequence) -> tuple:
+    """Decodes a cursor produced by `encode_cursor` for the given sort key columns.
+
+    Raises:
+        ValueError: If the cursor is malformed or doesn't match the sort key.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))["k"]
+        if not isinstance(values, list) or len(values) != len(key_columns):
+            raise ValueError("Cursor doesn't match the sort order")
+        return tuple(_decode_value(value, column) for value, column in zip(values, key_columns))
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _decode_value(value, column):
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    # JSON booleans are ints to isinstance, but aren't valid values of an integer key
+    if not isinstance(value, python_type) or (isinstance(value, bool) and python_type is not bool):
+        raise TypeError(f"Unexpected cursor value for {column.key}")
+    return value
+
+
+def escape_like(value: str, escape_char: str = "\\") -> str:
+    """Escapes LIKE wildcards so that `value` is matched literally."""
+    return (value.replace(escape_char, escape_char * 2)
+            .replace("%", escape_char + "%")
+            .replace("_", escape_char + "_"))
+
+
+def after_key(key_columns: Sequence, key_values: tuple):
+    """Builds the predicate selecting rows that sort after `key_values` in ascending order."""
+    clauses = []
+    for position, column in enumerate(key_columns):
+        equal_prefix = [key_columns[i] == key_values[i] for i in range(position)]
+        clauses.append(and_(*equal_prefix, column > key_values[position]))
+    return or_(*clauses)
+
+
+def paginate(query: Query, key_columns, limit: int, cursor: Optional[str] = None):
+    """Applies keyset pagination on `key_columns` to `query`.
+
+    Only `limit + 1` rows are fetched, the extra row tells whether another page exists.
+
+    Args:
+        query: The filtered query to paginate.
+        key_columns: A column, or a tuple of columns, whose values are unique, non-null and indexed together,
+            e.g. the primary key or (due_date, id).
+        limit: Maximum number of rows to return.
+        cursor: The `next_cursor` value from the previous page, if any.
+
+    Returns:
+        A dict with the page `items` and the `next_cursor`, which is None on the last page.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    if not isinstance(key_columns, (tuple, list)):
+        key_columns = (key_columns,)
+    if cursor:
+        query = query.filter(after_key(key_columns, decode_cursor(cursor, key_columns)))
+    rows = query.order_by(*key_columns).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(*(getattr(rows[-1], column.key) for column in key_columns))
+    return {"items": rows, "next_cursor": next_cursor}
@@ -0,0 +1,200 @@
+"""Opt-in profiling of single requests and Celery tasks, and logging of slow ones with their SQL statements.
+
+Untraced work only costs a context variable lookup per SQL statement:
+
+- A request carrying the `PROFILE_TOKEN` in its `X-Profile` header, or in a `profile` query parameter, is run under
+  cProfile. The profile is written to `PROFILE_DIR` and named by the `X-Profile-Id` response header, e.g. to be read
+  with `python -m pstats`. Functions run by other requests at the same time on the event loop show up in it too.
+- Requests slower than `SLOW_REQUEST_MS`, and tasks slower than `SLOW_TASK_MS`, are logged with the SQL statements
+  they ran and their durations.
+- Tasks named in `PROFILE_TASKS` are profiled on every run.
+"""
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import re
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+from urllib.parse import parse_qs
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_QUERY_PARAMETER = "profile"
+MAX_LOGGED_STATEMENTS = 50
+MAX_STATEMENT_LENGTH = 1000
+
+
+class Trace:
+    """The SQL statements and profiles of the request or task being handled."""
+    __slots__ = ("name", "started", "statements", "statement_count", "statement_seconds", "profiles", "profile_id")
+
+    def __init__(self, name: str, profile_id: Optional[str]):
+        self.name = name
+        self.started = time.perf_counter()
+        self.statements = []
+        self.statement_count = 0
+        self.statement_seconds = 0.0
+        # One profiler per thread the work ran in, cProfile only sees its own thread
+        self.profiles = []
+        self.profile_id = profile_id
+
+
+# The trace of the work being handled, if it is traced. Context variables are copied into the threadpool and into
+# the greenlets of async sessions, so statements run there are added to it as well.
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def record_statement(statement: str, seconds: float):
+    """Adds a SQL statement to the current trace, called by the query timing hooks of `src.metrics`."""
+    trace = current_trace.get()
+    if trace is None:
+        return
+    trace.statement_count += 1
+    trace.statement_seconds += seconds
+    if len(trace.statements) < MAX_LOGGED_STATEMENTS:
+        trace.statements.append((statement[:MAX_STATEMENT_LENGTH], seconds))
+
+
+def profiled(fn):
+    """`fn` run under its own profiler when the current request is profiled, for calls made in another thread."""
+    trace = current_trace.get()
+    if trace is None or trace.profile_id is None:
+        return fn
+
+    def run(*args, **kwargs):
+        profile = cProfile.Profile()
+        trace.profiles.append(profile)
+        return profile.runcall(fn, *args, **kwargs)
+
+    return run
+
+
+def _slug(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "-", name).strip("-")[:80]
+
+
+class Profiler:
+    """Starts and finishes traces, writing their profiles and logging the slow ones.
+
+    `token` is the secret that requests present to be profiled.
+    """
+
+    def __init__(self, profile_dir: str = "profiles", slow_seconds: Optional[float] = None,
+                 token: Optional[str] = None):
+        self.profile_dir = profile_dir
+        self.slow_seconds = slow_seconds
+        self.token = token
+        # cProfile hooks a whole thread, so the event loop can only run one profile at a time
+        self.profiling = False
+
+    @classmethod
+    def from_env(cls, slow_ms_variable: str):
+        slow_ms = os.getenv(slow_ms_variable)
+        return cls(profile_dir=os.getenv("PROFILE_DIR") or "profiles",
+                   slow_seconds=int(slow_ms) / 1000 if slow_ms else None,
+                   token=os.getenv("PROFILE_TOKEN") or None)
+
+    def start(self, name: str, profile: bool = False) -> Optional[Trace]:
+        """Starts tracing the work of `name` in the current thread and context, profiling it if `profile`."""
+        profile = profile and not self.profiling
+        if not profile and self.slow_seconds is None:
+            return None
+        trace = Trace(name, f"{datetime.utcnow():%Y%m%dT%H%M%S}-{_slug(name)}-{uuid.uuid4().hex[:8]}"
+                      if profile else None)
+        if profile:
+            self.profiling = True
+            trace.profiles.append(cProfile.Profile())
+            trace.profiles[0].enable()
+        return trace
+
+    def finish(self, trace: Trace):
+        seconds = time.perf_counter() - trace.started
+        if trace.profile_id is not None:
+            trace.profiles[0].disable()
+            self.profiling = False
+            self._write_profile(trace)
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            logger.warning(self._slow_message(trace, seconds))
+
+    def _write_profile(self, trace: Trace):
+        stats = pstats.Stats(trace.profiles[0])
+        for profile in trace.profiles[1:]:
+            stats.add(profile)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{trace.profile_id}.prof")
+        stats.dump_stats(path)
+        logger.info(f"Profile of {trace.name} written to {path}")
+
+    @staticmethod
+    def _slow_message(trace: Trace, seconds: float) -> str:
+        lines = [f"Slow {trace.name} took {seconds * 1000:.1f} ms, {trace.statement_count} SQL statement(s) in "
+                 f"{trace.statement_seconds * 1000:.1f} ms"]
+        lines.extend(f"  {statement_seconds * 1000:8.1f} ms  {' '.join(statement.split())}"
+                     for statement, statement_seconds in trace.statements)
+        if trace.statement_count > len(trace.statements):
+            lines.append(f"  ... {trace.statement_count - len(trace.statements)} more")
+        return "\n".join(lines)
+
+
+def profile_requested(scope, token: Optional[str]) -> bool:
+    """Whether the request carries the profiling token, in its header or query string."""
+    if not token:
+        return False
+    supplied = next((value for key, value in scope["headers"] if key == PROFILE_HEADER), b"").decode("latin-1")
+    if not supplied and PROFILE_QUERY_PARAMETER.encode() in scope.get("query_string", b""):
+        supplied = parse_qs(scope["query_string"].decode("latin-1")).get(PROFILE_QUERY_PARAMETER, [""])[0]
+    return bool(supplied) and hmac.compare_digest(supplied.encode(), token.encode())
+
+
+class ProfilingMiddleware:
+    """ASGI middleware tracing requests, for the slow request log and for profiling on demand."""
+
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (self.profiler.slow_seconds is None and not self.profiler.token):
+            return await self.app(scope, receive, send)
+
+        trace = self.profiler.start(f"{scope['method']} {scope['path']}",
+                                    profile_requested(scope, self.profiler.token))
+        if trace is None:
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and trace.profile_id is not None:
+                message = {**message, "headers": [*message.get("headers", []),
+                                                  (b"x-profile-id", trace.profile_id.encode())]}
+            await send(message)
+
+        token = current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_trace.reset(token)
+            self.profiler.finish(trace)
+
+
+_running_tasks = {}
+
+
+def task_started(profiler: Profiler, task_id, name: str, profile: bool = False):
+    trace = profiler.start(f"task {name}", profile)
+    if trace is not None:
+        _running_tasks[task_id] = (trace, current_trace.set(trace))
+
+
+def task_finished(profiler: Profiler, task_id):
+    running = _running_tasks.pop(task_id, None)
+    if running is None:
+        return
+    trace, token = running
+    current_trace.reset(token)
+    profiler.finish(trace)
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+from sqlalchemy import true, false
+from sqlalchemy.orm import Session, Query
+
+from src.model import Book, Patron
+
+# Compared with `=` rather than `IS`, so that the (is_checked_out, due_date) index can be used
+IS_CHECKED_OUT = Book.is_checked_out == true()
+IS_IN_LIBRARY = Book.is_checked_out == false()
+
+
+def is_overdue(now: datetime):
+    return IS_CHECKED_OUT & (Book.due_date < now)
+
+
+def checked_out_books(db: Session) -> Query:
+    return db.query(Book).filter(IS_CHECKED_OUT)
+
+
+def overdue_books(db: Session, now: datetime) -> Query:
+    return db.query(Book).filter(is_overdue(now))
+
+
+def books_by_patron(db: Session, patron_id: int) -> Query:
+    return db.query(Book).filter(Book.patron_id == patron_id)
+
+
+def due_date_order(query: Query):
+    """Restricts `query` to loans with a due date, so that it can be paginated on (due_date, id)."""
+    return query.filter(Book.due_date.isnot(None)), (Book.due_date, Book.id)
+
+
+def count_books(db: Session, now: datetime):
+    """Counts all books, the ones in the library and the overdue ones."""
+    return {
+        "all": db.query(Book).count(),
+        "in_library": db.query(Book).filter(IS_IN_LIBRARY).count(),
+        "overdue": overdue_books(db, now).count(),
+    }
+
+
+def overdue_patron_ids(db: Session, now: datetime) -> Query:
+    """Distinct ids of the patrons holding at least one overdue book."""
+    return db.query(Book.patron_id).filter(is_overdue(now), Book.patron_id.isnot(None)).distinct()
+
+
+def overdue_loans_of_patrons(db: Session, patron_ids: list[int], now: datetime) -> Query:
+    """Overdue books joined with their patron, grouped by patron and ordered by due date.
+
+    Rows carry only the columns a reminder needs, so no patron is lazy-loaded per book.
+    """
+    return (db.query(Patron.id.label("patron_id"), Patron.name, Patron.email, Book.title, Book.due_date)
+            .join(Book, Book.patron_id == Patron.id)
+            .filter(Patron.id.in_(patron_ids), is_overdue(now))
+            .order_by(Patron.id, Book.due_date))
@@ -0,0 +1,34 @@
+"""Fast path for read endpoints.
+
+The data access functions of these endpoints select only the columns of the response DTO, so the rows are encoded
+with orjson as they are. FastAPI doesn't validate a returned `Response` against the `response_model`, which is
+only used for the documentation then, so the input validators of the DTOs don't run again on stored data.
+"""
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+def dto_columns(model, dto_cls: type[BaseModel]) -> tuple:
+    """The columns of `model` backing the fields of `dto_cls`, in the order of the fields."""
+    return tuple(getattr(model, field) for field in dto_cls.model_fields)
+
+
+def page_response(page) -> ORJSONResponse:
+    """Encodes a page of column rows returned by `paginate`."""
+    rows = page["items"]
+    # The column names are shared by every row of the page, so they are looked up once
+    fields = rows[0]._fields if rows else ()
+    return ORJSONResponse({"items": [dict(zip(fields, row)) for row in rows], "next_cursor": page["next_cursor"]})
+
+
+def dto_values(dto_cls: type[BaseModel], obj) -> dict:
+    """JSON compatible values of `obj` as `dto_cls`, built without running the validators of the DTO."""
+    return dto_cls.model_construct(**{field: getattr(obj, field) for field in dto_cls.model_fields}) \
+        .model_dump(mode="json")
+
+
+def lookup_response(ids: list[int], rows: list) -> ORJSONResponse:
+    """Encodes the rows returned by `lookup`, with null items and `not_found` entries for the ids that don't exist."""
+    fields = next((row._fields for row in rows if row is not None), ())
+    return ORJSONResponse({"items": [None if row is None else dict(zip(fields, row)) for row in rows],
+                           "not_found": [row_id for row_id, row in zip(ids, rows) if row is None]})
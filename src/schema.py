@@ -0,0 +1,59 @@
+"""Creates the missing tables of the database in `DATABASE_URL`.
+
+Run it once before starting the app and the Celery workers, which don't create tables themselves:
+
+    python -m src.schema --wait-seconds 60
+
+It waits for the database to accept connections, e.g. while its container is still starting.
+"""
+import argparse
+import logging
+import time
+
+from dotenv import load_dotenv
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+from src.database_config import DatabaseConfig
+
+logger = logging.getLogger(__name__)
+
+RETRY_INTERVAL_SECONDS = 2
+
+
+def create_schema(database_config: DatabaseConfig, wait_seconds: float = 0, sleep=time.sleep):
+    """Creates the tables, retrying for up to `wait_seconds` while the database can't be connected to."""
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        try:
+            database_config.create_schema()
+            return
+        except (OperationalError, InterfaceError) as e:
+            if time.monotonic() >= deadline:
+                raise
+            logger.warning(f"Couldn't connect to the database: {e}, will try again shortly.")
+            sleep(RETRY_INTERVAL_SECONDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wait-seconds", type=float, default=0,
+                        help="How long to wait for the database to accept connections")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+
+    database_config = DatabaseConfig.from_env()
+    if not database_config.database_url:
+        parser.error("DATABASE_URL is not set")
+    started = time.perf_counter()
+    try:
+        create_schema(database_config, args.wait_seconds)
+    finally:
+        # Not created if the URL couldn't be parsed or its driver is missing
+        if database_config.engine is not None:
+            database_config.engine.dispose()
+    logger.info(f"Schema created in {time.perf_counter() - started:.2f} s")
+
+
+if __name__ == '__main__':
+    main()
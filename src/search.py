@@ -0,0 +1,249 @@
+import asyncio
+import heapq
+import logging
+import os
+import re
+from bisect import bisect_left, insort
+from typing import Optional
+
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from src.model import Book
+
+logger = logging.getLogger(__name__)
+
+FIELD_WEIGHTS = {"title": 3.0, "author": 2.0, "isbn": 1.0}
+# Bonus for a query token matching a whole token rather than a prefix of it
+EXACT_MATCH_BONUS = 1.5
+LOAD_BATCH_SIZE = 10000
+# MySQL error raised by MATCH when the FULLTEXT index doesn't exist, e.g. on tables created before it was added
+ER_FT_MATCHING_KEY_NOT_FOUND = 1191
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text_value: Optional[str]) -> list[str]:
+    """Splits `text_value` into lower case word tokens."""
+    if not text_value:
+        return []
+    return TOKEN_PATTERN.findall(text_value.lower())
+
+
+def isbn_tokens(isbn: Optional[str]) -> list[str]:
+    """Tokens of an ISBN, including the whole number without hyphens so it can be typed either way."""
+    tokens = tokenize(isbn)
+    if len(tokens) > 1:
+        tokens.append("".join(tokens))
+    return tokens
+
+
+class MemorySearchIndex:
+    """In-process inverted index over book titles, authors and ISBNs.
+
+    Tokens are kept in a sorted list, so that the index tokens starting with a query token are found with a
+    binary search.
+    """
+
+    def __init__(self):
+        self._postings: dict[str, dict[int, float]] = {}
+        self._sorted_tokens: list[str] = []
+        self._documents: dict[int, dict[str, float]] = {}
+
+    def __len__(self):
+        return len(self._documents)
+
+    @classmethod
+    def build(cls, rows) -> "MemorySearchIndex":
+        """Indexes `(id, title, author, isbn)` rows, sorting the tokens once rather than inserting them one by one."""
+        index = cls()
+        for row in rows:
+            index._index_document(*row)
+        index._sorted_tokens = sorted(index._postings)
+        return index
+
+    def add(self, book_id: int, title: Optional[str], author: Optional[str], isbn: Optional[str]):
+        self.remove(book_id)
+        for token in self._index_document(book_id, title, author, isbn):
+            insort(self._sorted_tokens, token)
+
+    def _index_document(self, book_id: int, title: Optional[str], author: Optional[str],
+                        isbn: Optional[str]) -> list[str]:
+        """Adds the postings of a book, returning the tokens that are new to the index."""
+        weights: dict[str, float] = {}
+        for field, tokens in (("title", tokenize(title)), ("author", tokenize(author)), ("isbn", isbn_tokens(isbn))):
+            for token in tokens:
+                weights[token] = weights.get(token, 0.0) + FIELD_WEIGHTS[field]
+        self._documents[book_id] = weights
+        new_tokens = []
+        for token, weight in weights.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                new_tokens.append(token)
+            postings[book_id] = weight
+        return new_tokens
+
+    def remove(self, book_id: int):
+        weights = self._documents.pop(book_id, None)
+        if weights is None:
+            return
+        for token in weights:
+            postings = self._postings[token]
+            del postings[book_id]
+            if not postings:
+                del self._postings[token]
+                del self._sorted_tokens[bisect_left(self._sorted_tokens, token)]
+
+    def _expansion(self, prefix: str) -> tuple[int, int]:
+        """The range of `_sorted_tokens` starting with `prefix`."""
+        return (bisect_left(self._sorted_tokens, prefix),
+                bisect_left(self._sorted_tokens, prefix + "\U0010ffff"))
+
+    def _prefix_scores(self, prefix: str, start: int, end: int) -> dict[int, float]:
+        """Scores of every book with a token in the expansion of `prefix`, read from the postings."""
+        scores: dict[int, float] = {}
+        for token in self._sorted_tokens[start:end]:
+            bonus = EXACT_MATCH_BONUS if token == prefix else 1.0
+            for book_id, weight in self._postings[token].items():
+                scores[book_id] = max(scores.get(book_id, 0.0), weight * bonus)
+        return scores
+
+    def _candidate_scores(self, prefix: str, candidates) -> dict[int, float]:
+        """Scores of `prefix` for the given books only, read from their own tokens."""
+        scores: dict[int, float] = {}
+        for book_id in candidates:
+            score = max((weight * (EXACT_MATCH_BONUS if token == prefix else 1.0)
+                         for token, weight in self._documents[book_id].items() if token.startswith(prefix)),
+                        default=0.0)
+            if score:
+                scores[book_id] = score
+        return scores
+
+    def search(self, query: str, limit: int) -> list[int]:
+        """Returns the ids of the books matching every token of `query` as a prefix, best matches first."""
+        query_tokens = list(dict.fromkeys(tokenize(query)))
+        if not query_tokens:
+            return []
+        # Starts from the query token with the fewest index tokens. A short prefix like "p" of "harry p" can expand
+        # to most of the index, so the following tokens are checked against the books matched so far instead,
+        # whenever there are fewer of those than index tokens to read.
+        expansions = sorted(((token, *self._expansion(token)) for token in query_tokens),
+                            key=lambda expansion: expansion[2] - expansion[1])
+        token, start, end = expansions[0]
+        totals = self._prefix_scores(token, start, end)
+        for token, start, end in expansions[1:]:
+            if not totals:
+                return []
+            if end - start > len(totals):
+                scores = self._candidate_scores(token, totals)
+            else:
+                scores = self._prefix_scores(token, start, end)
+            totals = {book_id: total + scores[book_id] for book_id, total in totals.items() if book_id in scores}
+        ranked = heapq.nsmallest(limit, totals.items(), key=lambda item: (-item[1], item[0]))
+        return [book_id for book_id, _ in ranked]
+
+
+def fulltext_search(db: Session, query: str, limit: int) -> list[Book]:
+    """Ranked prefix search using the MySQL FULLTEXT index on title, author and ISBN."""
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    boolean_query = " ".join(f"+{token}*" for token in tokens)
+    relevance = match(Book.title, Book.author, Book.isbn, against=boolean_query).in_boolean_mode()
+    return db.query(Book).filter(relevance).order_by(relevance.desc(), Book.id).limit(limit).all()
+
+
+def missing_fulltext_index(error: DBAPIError) -> bool:
+    code = getattr(error.orig, "errno", None)
+    if code is None and error.orig is not None and error.orig.args:
+        code = error.orig.args[0]
+    return code == ER_FT_MATCHING_KEY_NOT_FOUND
+
+
+def load_index_rows(db: Session):
+    rows = (db.query(Book.id, Book.title, Book.author, Book.isbn)
+            .execution_options(yield_per=LOAD_BATCH_SIZE))
+    return MemorySearchIndex.build(rows)
+
+
+def get_books_in_order(db: Session, book_ids: list[int]) -> list[Book]:
+    if not book_ids:
+        return []
+    books = {book.id: book for book in db.query(Book).filter(Book.id.in_(book_ids))}
+    return [books[book_id] for book_id in book_ids if book_id in books]
+
+
+class BookSearch:
+    """Searches books through MySQL FULLTEXT, or an in-process index for other databases.
+
+    The in-process index is built from the books table on the first search and then kept up to date by the
+    write endpoints of this worker, so it is meant for SQLite and single worker setups.
+    """
+
+    def __init__(self, backend="auto"):
+        if backend not in ("auto", "fulltext", "memory"):
+            raise ValueError(f"Unknown search backend '{backend}'")
+        self.backend = backend
+        self._index: Optional[MemorySearchIndex] = None
+        self._pending: Optional[list] = None
+        self._generation = 0
+        self._load_lock = asyncio.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv("SEARCH_BACKEND", "auto"))
+
+    def uses_fulltext(self, db) -> bool:
+        if self.backend == "auto":
+            return db.session.get_bind().dialect.name == "mysql"
+        return self.backend == "fulltext"
+
+    async def search(self, db, query: str, limit: int) -> list[Book]:
+        if self.uses_fulltext(db):
+            try:
+                return await db.run(fulltext_search, query, limit)
+            except DBAPIError as e:
+                if not missing_fulltext_index(e):
+                    raise
+                logger.warning("The books table has no FULLTEXT index, searching an in-process index instead. "
+                               "See the README to add the index.")
+                self.backend = "memory"
+        index = await self._ensure_loaded(db)
+        return await db.run(get_books_in_order, index.search(query, limit))
+
+    async def _ensure_loaded(self, db) -> MemorySearchIndex:
+        async with self._load_lock:
+            if self._index is None:
+                # Changes made while the rows are read are replayed on the new index
+                self._pending = []
+                generation = self._generation
+                try:
+                    index = await db.run(load_index_rows)
+                    for change in self._pending:
+                        change(index)
+                finally:
+                    self._pending = None
+                if generation != self._generation:
+                    return index
+                self._index = index
+            return self._index
+
+    def _apply(self, change):
+        if self._pending is not None:
+            self._pending.append(change)
+        if self._index is not None:
+            change(self._index)
+
+    def book_saved(self, book):
+        fields = (book.id, book.title, book.author, book.isbn)
+        self._apply(lambda index: index.add(*fields))
+
+    def book_deleted(self, book_id: int):
+        self._apply(lambda index: index.remove(book_id))
+
+    def invalidate(self):
+        """Drops the in-process index, e.g. after a bulk import, so that the next search rebuilds it."""
+        self._generation += 1
+        self._index = None
@@ -1,58 +1,191 @@
 import os
 import time
 from datetime import datetime
+from itertools import groupby
+from operator import attrgetter
 
+from celery import group
+from celery.signals import task_prerun, task_postrun, worker_init, worker_process_init, worker_process_shutdown
 from celery.utils.log import get_task_logger
+from prometheus_client import start_http_server
+from sqlalchemy.exc import SQLAlchemyError
 
 from celery_app import app
-from src.database_config import DatabaseConfig
-from src.model import Book
+from src import queries, circulation, metrics, export, profiling
+from src.config import OVERDUE_REMINDER_CHUNK_SIZE, OVERDUE_REMINDER_FETCH_SIZE
+from src.database_config import DatabaseConfig, env_list, env_int
+from src.mailer import Mailer, Email
+from src.model import WeeklyReport
 
 logger = get_task_logger(__name__)
 database_url = os.getenv("DATABASE_URL")
-database_config = None
+metrics_port = os.getenv("CELERY_METRICS_PORT")
+export_dir = os.getenv("EXPORT_DIR", "exports")
+task_profiler = profiling.Profiler.from_env("SLOW_TASK_MS")
+# Task names profiled on every run, or "*" for all of them
+profiled_tasks = set(env_list("PROFILE_TASKS"))
+# The engines are created by each worker process, the tables by `python -m src.schema`
+database_config = DatabaseConfig(database_url=database_url, replica_urls=env_list("DATABASE_REPLICA_URLS"),
+                                 create_schema=False, lazy=True)
+# Created on first use, so that every worker process has its own SMTP connections
+mailer = None
 
-while True:
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    # Runs in the parent of the prefork pool, which only serves the metrics written by the pool processes
+    metrics.remove_stale_files()
+    if metrics_port:
+        start_http_server(int(metrics_port), registry=metrics.registry())
+
+
+@worker_process_init.connect
+def init_database(**kwargs):
+    database_config.init_engines()
+    if database_config.engine is not None:
+        metrics.track_engine("celery", database_config.engine)
+        for replica_number, replica in enumerate(database_config.replicas):
+            metrics.track_engine(f"celery_replica{replica_number}", replica.engine)
     try:
-        database_config = DatabaseConfig(database_url=database_url)
-        break
-    except Exception as e:
-        logger.error(f"Couldn't connect to DB: {e}, will try again shortly after.")
-        time.sleep(2)
+        database_config.prewarm(env_int("DB_POOL_PREWARM", 0))
+    except SQLAlchemyError as e:
+        logger.warning(f"Couldn't prewarm the connection pool: {e}")
+
+
+@worker_process_shutdown.connect
+def close_mailer(**kwargs):
+    if mailer is not None:
+        mailer.close()
+
+
+@worker_process_shutdown.connect
+def mark_process_exited(**kwargs):
+    metrics.process_exited()
+
+
+def get_mailer() -> Mailer:
+    global mailer
+    if mailer is None:
+        mailer = Mailer.from_env()
+    return mailer
+
+
+@task_prerun.connect
+def record_task_started(task_id=None, task=None, **kwargs):
+    metrics.task_started(task_id)
+    profiling.task_started(task_profiler, task_id, task.name, task.name in profiled_tasks or "*" in profiled_tasks)
+
+
+@task_postrun.connect
+def record_task_finished(task_id=None, task=None, state=None, **kwargs):
+    profiling.task_finished(task_profiler, task_id)
+    metrics.task_finished(task_id, task, state)
 
 
 @app.task
-def send_overdue_reminders():
+def send_overdue_reminders(chunk_size=OVERDUE_REMINDER_CHUNK_SIZE):
+    """Finds the patrons with overdue books and fans their reminders out to `send_overdue_digests` subtasks.
+
+    When run eagerly, the subtasks run inline and their statistics are summed into the result.
+    """
     logger.info("Sending overdue reminders")
+    started = time.perf_counter()
     now = datetime.utcnow()
-    db = next(database_config.get_db())
-    overdue_books = db.query(Book).filter(Book.due_date < now, Book.is_checked_out).all()
+    with database_config.read_session_scope() as db:
+        patron_ids = [patron_id for (patron_id,) in
+                      queries.overdue_patron_ids(db, now).execution_options(yield_per=OVERDUE_REMINDER_FETCH_SIZE)]
+    chunk_ids = [patron_ids[start:start + chunk_size] for start in range(0, len(patron_ids), chunk_size)]
+    stats = {"patrons": len(patron_ids), "chunks": len(chunk_ids),
+             "planning_seconds": round(time.perf_counter() - started, 3)}
+
+    job = group(send_overdue_digests.s(ids, now.isoformat()) for ids in chunk_ids)
+    if send_overdue_reminders.request.is_eager:
+        results = job.apply().get() if chunk_ids else []
+        for key in ("books", "sent", "duplicates", "failed"):
+            stats[key] = sum(result[key] for result in results)
+        stats["query_seconds"] = round(sum(result["query_seconds"] for result in results), 3)
+        stats["send_seconds"] = round(sum(result["send_seconds"] for result in results), 3)
+    elif chunk_ids:
+        job.apply_async()
+    logger.info(f"Overdue reminders dispatched: {stats}")
+    return stats
+
+
+@app.task
+def send_overdue_digests(patron_ids, now):
+    """Sends one digest per patron listing all of their overdue books.
 
-    for book in overdue_books:
-        patron = book.patron
-        send_email(patron.email, "Overdue Book Reminder", f"Your book '{book.title}' is overdue.")
+    A patron gets at most one digest a day, even if the reminders are sent again.
+    """
+    started = time.perf_counter()
+    now = datetime.fromisoformat(now)
+    emails = []
+    stats = {"patrons": 0, "books": 0}
+    with database_config.read_session_scope() as db:
+        rows = (queries.overdue_loans_of_patrons(db, patron_ids, now)
+                .execution_options(yield_per=OVERDUE_REMINDER_FETCH_SIZE))
+        for patron_id, loans in groupby(rows, key=attrgetter("patron_id")):
+            loans = list(loans)
+            lines = "\n".join(f"- '{loan.title}', due {loan.due_date:%Y-%m-%d}" for loan in loans)
+            emails.append(Email(loans[0].email, "Overdue Book Reminder",
+                                f"Dear {loans[0].name}, the following books are overdue:\n{lines}",
+                                dedup_key=f"overdue-digest:{patron_id}:{now:%Y-%m-%d}"))
+            stats["patrons"] += 1
+            stats["books"] += len(loans)
+    stats["query_seconds"] = round(time.perf_counter() - started, 3)
+    delivery = get_mailer().send_all(emails)
+    stats["send_seconds"] = delivery.pop("seconds")
+    stats.update(delivery)
+    logger.info(f"Overdue digests sent: {stats}")
+    return stats
 
 
 @app.task
 def generate_weekly_reports():
     logger.info("Generating weekly reports")
     now = datetime.utcnow()
-    db = next(database_config.get_db())
-
-    books_count = db.query(Book).count()
-    books_in_library_count = db.query(Book).filter(~Book.is_checked_out).count()
-    books_with_overdue_count = db.query(Book).filter(Book.is_checked_out, Book.due_date < now).count()
-    report = f"[ In library: {books_in_library_count} | All:{books_count} | " \
-             f"With overdue: {books_with_overdue_count}"
+    with database_config.session_scope() as db:
+        stats = circulation.snapshot(db, now)
+        db.add(WeeklyReport(created_at=now, **stats))
+        db.commit()
+    report = f"[ In library: {stats['in_library']} | All:{stats['total']} | " \
+             f"With overdue: {stats['overdue']}"
     logger.info(f"Weekly book report: {report} ]")
-    # Generate and save the report
-    with open("weekly_report.txt", "a+") as report_file:
-        report_file.write(f"\n{datetime.now()} - {report}")
+    return stats
+
+
+@app.task
+def reconcile_circulation_counters():
+    logger.info("Reconciling circulation counters")
+    with database_config.session_scope() as db:
+        drift = circulation.reconcile(db)
+    if drift:
+        logger.warning(f"Circulation counters had drifted (stored, actual): {drift}")
+    return drift
+
 
+@app.task
+def export_table(table, export_format="parquet", compress=False, path=None):
+    """Writes the same export as `GET /export/<table>` to a file, by default a dated one in EXPORT_DIR.
 
-def send_email(to, subject, body):
-    # Email sending logic here
-    logger.info(f"Sending email to {to} with subject '{subject}' and body '{body}'")
+    The export is written next to the file and renamed once complete, so readers never see a partial file.
+    """
+    if path is None:
+        file_name = export.file_name(f"{table}-{datetime.utcnow():%Y%m%d}", export_format, compress)
+        path = os.path.join(export_dir, file_name)
+    logger.info(f"Exporting {table} to {path}")
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    partial_path = f"{path}.part"
+    size = 0
+    with database_config.read_session_scope() as db, open(partial_path, "wb") as file:
+        for chunk in export.export(db, table, export_format, compress):
+            file.write(chunk)
+            size += len(chunk)
+    os.replace(partial_path, path)
+    stats = {"path": path, "bytes": size, "seconds": round(time.perf_counter() - started, 3)}
+    logger.info(f"Export finished: {stats}")
+    return stats
 
 
 if __name__ == '__main__':
@@ -62,4 +195,3 @@ if __name__ == '__main__':
     logging.basicConfig(level=getattr(logging, cfg.LOG_LEVEL), format=cfg.LOGGING_FORMAT, datefmt=cfg.TIME_FORMAT)
     generate_weekly_reports.apply()
     send_overdue_reminders.apply()
-    send_email("1", "2", "3")
@@ -0,0 +1,180 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+from email_validator import validate_email, EmailNotValidError
+from email_validator.deliverability import validate_email_deliverability
+from isbnlib import is_isbn13, is_isbn10
+
+SYNTAX = "syntax"
+DELIVERABILITY = "deliverability"
+
+DEFAULT_VALIDATION_CACHE_SIZE = 65536
+DEFAULT_DOMAIN_CACHE_SIZE = 4096
+DEFAULT_DOMAIN_CACHE_TTL_SECONDS = 3600
+DEFAULT_DNS_TIMEOUT_SECONDS = 5
+DNS_LOOKUP_CONCURRENCY = 16
+
+
+def _is_valid_isbn(isbn: str) -> bool:
+    isbn = isbn.replace('-', '')
+
+    if len(isbn) == 10:
+        return is_isbn10(isbn)
+    elif len(isbn) == 13:
+        return is_isbn13(isbn)
+    else:
+        return False
+
+
+def _email_domain(email: str) -> Optional[tuple[str, str]]:
+    try:
+        validated = validate_email(email, check_deliverability=False)
+    except EmailNotValidError:
+        return None
+    return validated.ascii_domain, validated.domain
+
+
+class DomainCache:
+    """Bounded cache of DNS deliverability results, which expire after `ttl_seconds`."""
+
+    def __init__(self, max_entries=DEFAULT_DOMAIN_CACHE_SIZE, ttl_seconds=DEFAULT_DOMAIN_CACHE_TTL_SECONDS,
+                 clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, domain) -> Optional[bool]:
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is None:
+                return None
+            expires_at, deliverable = entry
+            if expires_at <= self.clock():
+                del self._entries[domain]
+                return None
+            self._entries.move_to_end(domain)
+            return deliverable
+
+    def set(self, domain, deliverable: bool):
+        with self._lock:
+            self._entries[domain] = (self.clock() + self.ttl_seconds, deliverable)
+            self._entries.move_to_end(domain)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class Validator:
+    """ISBN and email validators with their caches.
+
+    Args:
+        email_mode: `syntax` to only check addresses themselves, or `deliverability` to also check that their
+            domains accept email.
+        cache_size: The number of ISBNs and email addresses whose results are cached.
+    """
+
+    def __init__(self, email_mode=SYNTAX, cache_size=DEFAULT_VALIDATION_CACHE_SIZE,
+                 domain_cache: Optional[DomainCache] = None, dns_timeout_seconds=DEFAULT_DNS_TIMEOUT_SECONDS):
+        self.email_mode = email_mode
+        self.is_valid_isbn = lru_cache(maxsize=cache_size)(_is_valid_isbn)
+        self.email_domain = lru_cache(maxsize=cache_size)(_email_domain)
+        self.domain_cache = domain_cache or DomainCache()
+        self.dns_timeout_seconds = dns_timeout_seconds
+
+    @classmethod
+    def from_env(cls):
+        return cls(email_mode=os.getenv("EMAIL_VALIDATION_MODE") or SYNTAX,
+                   cache_size=int(os.getenv("VALIDATION_CACHE_SIZE") or DEFAULT_VALIDATION_CACHE_SIZE),
+                   domain_cache=DomainCache(
+                       int(os.getenv("DOMAIN_CACHE_SIZE") or DEFAULT_DOMAIN_CACHE_SIZE),
+                       int(os.getenv("DOMAIN_CACHE_TTL_SECONDS") or DEFAULT_DOMAIN_CACHE_TTL_SECONDS)),
+                   dns_timeout_seconds=int(os.getenv("DNS_TIMEOUT_SECONDS") or DEFAULT_DNS_TIMEOUT_SECONDS))
+
+    def is_deliverable_domain(self, ascii_domain: str, domain: str) -> bool:
+        """Looks up the MX/A records of a domain, or answers from the domain cache."""
+        deliverable = self.domain_cache.get(ascii_domain)
+        if deliverable is None:
+            try:
+                validate_email_deliverability(ascii_domain, domain, timeout=self.dns_timeout_seconds)
+                deliverable = True
+            except EmailNotValidError:
+                deliverable = False
+            self.domain_cache.set(ascii_domain, deliverable)
+        return deliverable
+
+    def is_valid_email(self, email: str, mode: Optional[str] = None) -> bool:
+        domains = self.email_domain(email)
+        if domains is None:
+            return False
+        if (mode or self.email_mode) == DELIVERABILITY:
+            return self.is_deliverable_domain(*domains)
+        return True
+
+    def validate_emails(self, emails: list[str], mode: Optional[str] = None) -> list[bool]:
+        domains = [self.email_domain(email) for email in emails]
+        if (mode or self.email_mode) != DELIVERABILITY:
+            return [domain is not None for domain in domains]
+
+        uncached = {domain for domain in domains if domain is not None and self.domain_cache.get(domain[0]) is None}
+        if uncached:
+            with ThreadPoolExecutor(max_workers=min(DNS_LOOKUP_CONCURRENCY, len(uncached))) as executor:
+                list(executor.map(lambda domain: self.is_deliverable_domain(*domain), uncached))
+        return [domain is not None and self.is_deliverable_domain(*domain) for domain in domains]
+
+    def clear_caches(self):
+        self.is_valid_isbn.cache_clear()
+        self.email_domain.cache_clear()
+        self.domain_cache.clear()
+
+
+_validator: Optional[Validator] = None
+
+
+def validator() -> Validator:
+    """The validator configured by the environment. It is created on first use, after `.env` files are loaded."""
+    global _validator
+    if _validator is None:
+        _validator = Validator.from_env()
+    return _validator
+
+
+def is_valid_isbn(isbn: str) -> bool:
+    """Validates an ISBN-10 or ISBN-13 number, ignoring hyphens."""
+    return validator().is_valid_isbn(isbn)
+
+
+def is_valid_email(email: str, mode: Optional[str] = None) -> bool:
+    """Validates an email address.
+
+    Args:
+        email: The address to validate.
+        mode: `syntax` to only check the address itself, or `deliverability` to also check that its domain
+            accepts email. Defaults to the `EMAIL_VALIDATION_MODE` env var.
+    """
+    return validator().is_valid_email(email, mode)
+
+
+def validate_isbns(isbns: list[str]) -> list[bool]:
+    return [is_valid_isbn(isbn) for isbn in isbns]
+
+
+def validate_emails(emails: list[str], mode: Optional[str] = None) -> list[bool]:
+    """Validates a batch of email addresses.
+
+    In deliverability mode every distinct, uncached domain of the batch is looked up once, concurrently.
+    """
+    return validator().validate_emails(emails, mode)
+
+
+def clear_caches():
+    validator().clear_caches()
@@ -0,0 +1,64 @@
+from contextlib import contextmanager
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import app, database_config
+from src.cache import EntityCache, MemoryCache
+from src.database_config import DatabaseConfig
+from src.model import Base
+from src.search import BookSearch
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+
+
+@pytest.fixture(scope="function")
+def make_config():
+    """Creates database configs, on the test database unless given another URL, and drops their tables afterwards."""
+    configs = []
+
+    def make(**kwargs) -> DatabaseConfig:
+        config = DatabaseConfig(**{"database_url": SQLALCHEMY_DATABASE_URL, **kwargs})
+        configs.append(config)
+        return config
+
+    yield make
+    for config in configs:
+        if config.engine is None:
+            continue
+        Base.metadata.drop_all(bind=config.engine)
+        for engine in [config.engine, *(replica.engine for replica in config.replicas)]:
+            engine.dispose()
+
+
+@pytest.fixture(scope="function")
+def use_config(monkeypatch):
+    """Points the app at a database config, with an empty entity cache and search index."""
+
+    def use(config: DatabaseConfig, cache=None):
+        monkeypatch.setattr(main, "entity_cache", EntityCache(cache or MemoryCache()))
+        monkeypatch.setattr(main, "book_search", BookSearch())
+        for dependency in ("get_db", "get_read_db", "get_read_session_scope"):
+            monkeypatch.setitem(app.dependency_overrides, getattr(database_config, dependency),
+                                getattr(config, dependency))
+
+    return use
+
+
+@pytest.fixture(scope="function")
+def serve(use_config):
+    """Runs the app on a database config, see `use_config`, and yields its `TestClient`."""
+
+    @contextmanager
+    def run(config: DatabaseConfig, cache=None):
+        use_config(config, cache)
+        with TestClient(app) as test_client:
+            yield test_client
+            # Async engines have to be disposed of on the event loop of the client that used them
+            if config.async_mode:
+                for replica in config.replicas:
+                    test_client.portal.call(replica.async_engine.dispose)
+                test_client.portal.call(config.async_engine.dispose)
+
+    return run
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import app
+from src.admission import AdmissionController, Overloaded, route_class, CIRCULATION, WRITE, READ
+
+
+def test_requests_are_classified_by_route():
+    assert route_class("POST", "/checkout/1/patron/2") == CIRCULATION
+    assert route_class("POST", "/return/1") == CIRCULATION
+    assert route_class("PUT", "/books/1") == WRITE
+    assert route_class("GET", "/export/books") == READ
+    assert route_class("GET", "/metrics") is None
+    assert route_class("GET", "/events") is None
+
+
+def test_freed_slots_go_to_circulation_first():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1)
+        await controller.acquire(READ)
+        admitted = []
+
+        async def request(name):
+            await controller.acquire(name)
+            admitted.append(name)
+            await asyncio.sleep(0)
+            controller.release(name)
+
+        waiting = [asyncio.create_task(request(name)) for name in (READ, WRITE, CIRCULATION)]
+        await asyncio.sleep(0)
+        assert controller.stats()["classes"][READ]["queued"] == 1
+        controller.release(READ)
+        await asyncio.gather(*waiting)
+        return admitted, controller
+
+    admitted, controller = asyncio.run(scenario())
+
+    assert admitted == [CIRCULATION, WRITE, READ]
+    assert controller.active == 0
+
+
+def test_class_limits_leave_room_for_other_classes():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=2, limits={READ: 1})
+        await controller.acquire(READ)
+        second_read = asyncio.create_task(controller.acquire(READ))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(controller.acquire(CIRCULATION), 1)
+        assert not second_read.done()
+        controller.release(READ)
+        await second_read
+        return controller.stats()
+
+    stats = asyncio.run(scenario())
+
+    assert stats["active"] == 2
+    assert stats["classes"][READ]["admitted"] == 2
+
+
+def test_overload_is_shed_when_the_queue_is_full_or_the_wait_too_long():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, queue_size=1, max_wait_seconds=0.05)
+        await controller.acquire(WRITE)
+        waiting = asyncio.create_task(controller.acquire(WRITE))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded, match="queue_full"):
+            await controller.acquire(WRITE)
+        with pytest.raises(Overloaded, match="timeout"):
+            await waiting
+        return controller.stats()["classes"][WRITE]
+
+    stats = asyncio.run(scenario())
+
+    assert (stats["shed"], stats["timed_out"], stats["queued"], stats["active"]) == (2, 1, 0, 1)
+
+
+def test_overloaded_requests_get_503_with_retry_after(monkeypatch):
+    controller = main.admission_controller
+    monkeypatch.setattr(controller, "enabled", True)
+    monkeypatch.setattr(controller.classes[READ], "limit", 0)
+    monkeypatch.setattr(controller.classes[READ], "queue_size", 0)
+    shed_before = controller.classes[READ].shed
+
+    with TestClient(app) as client:
+        response = client.get("/books")
+        stats = client.get("/admission/stats").json()
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert stats["enabled"] and stats["classes"][READ]["shed"] == shed_before + 1
@@ -0,0 +1,66 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import httpx
+
+import main
+from benchmarks.load import Workload, run_load
+from benchmarks.results import percentile, latency_stats
+from benchmarks.seed import seed
+from benchmarks.startup import import_seconds
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 0.50) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([7], 0.95) == 7
+    assert percentile([], 0.95) is None
+
+
+def test_latency_stats():
+    stats = latency_stats([0.002, 0.001, 0.003, 0.004], elapsed=2)
+    assert stats["count"] == 4
+    assert stats["throughput"] == 2
+    assert stats["p50_ms"] == 2
+    assert stats["max_ms"] == 4
+
+
+def test_load_runs_the_mixed_workload(tmp_path, make_config, use_config):
+    database_url = f"sqlite:///{tmp_path / 'bench.db'}"
+    assert seed(database_url, books=200, patrons=20)["books"] == 200
+    use_config(make_config(database_url=database_url))
+
+    workload = Workload.from_database(database_url)
+    assert workload.max_book_id == 200 and workload.loans
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            return await run_load(client, workload, concurrency=2, duration=1)
+
+    results = asyncio.run(scenario())
+
+    assert set(results["endpoints"]) == {name for name, _, _ in workload.operations}
+    assert results["total"]["count"] > 0
+    assert results["total"]["errors"] == 0
+    assert results["endpoints"]["GET /books/{book_id}"]["count"] > 0
+
+
+def test_import_seconds_are_measured_in_a_fresh_interpreter():
+    durations = import_seconds("src.schema", os.environ.copy(), runs=1)
+    assert len(durations) == 1 and 0 < durations[0] < 30
+
+
+def test_micro_benchmarks_run(tmp_path):
+    output = tmp_path / "micro.json"
+    subprocess.run([sys.executable, "-m", "benchmarks.micro", "--database-url", f"sqlite:///{tmp_path / 'micro.db'}",
+                    "--books", "50", "--patrons", "5", "--iterations", "20", "--task-runs", "1",
+                    "--output", str(output)], check=True, capture_output=True)
+
+    results = json.loads(output.read_text())
+    assert results["micro"]["BookDto.model_validate(orm)"]["iterations"] == 20
+    assert results["tasks"]["seeded"]["books"] == 50
@@ -0,0 +1,89 @@
+import asyncio
+
+import fakeredis.aioredis
+
+from src.cache import EntityCache, MemoryCache, RedisCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_memory_cache_evicts_least_recently_used():
+    async def scenario():
+        cache = MemoryCache(max_entries=2)
+        await cache.set("a", {"id": 1})
+        await cache.set("b", {"id": 2})
+        await cache.get("a")
+        await cache.set("c", {"id": 3})
+        return await cache.get("a"), await cache.get("b"), await cache.get("c")
+
+    assert asyncio.run(scenario()) == ({"id": 1}, None, {"id": 3})
+
+
+def test_memory_cache_expires_entries():
+    async def scenario():
+        clock = FakeClock()
+        cache = MemoryCache(ttl_seconds=10, clock=clock)
+        await cache.set("a", {"id": 1})
+        clock.now = 9
+        fresh = await cache.get("a")
+        clock.now = 10
+        return fresh, await cache.get("a")
+
+    assert asyncio.run(scenario()) == ({"id": 1}, None)
+
+
+def test_concurrent_misses_share_one_load():
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"id": 1}
+
+    async def scenario():
+        cache = EntityCache(MemoryCache())
+        results = await asyncio.gather(*(cache.get_or_load("book:1", load) for _ in range(10)))
+        return cache, results
+
+    cache, results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert results == [{"id": 1}] * 10
+    assert cache.stats()["misses"] == 10
+
+
+def test_load_overlapping_invalidation_is_not_stored():
+    async def scenario():
+        cache = EntityCache(MemoryCache())
+
+        async def stale_load():
+            await cache.invalidate("book:1")
+            return {"id": 1, "title": "stale"}
+
+        await cache.get_or_load("book:1", stale_load)
+        return await cache.backend.get("book:1")
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_redis_cache_round_trip():
+    async def scenario():
+        cache = EntityCache(RedisCache(fakeredis.aioredis.FakeRedis(), ttl_seconds=30))
+
+        async def load():
+            return {"id": 1}
+
+        await cache.get_or_load("book:1", load)
+        await cache.get_or_load("book:1", load)
+        stats = cache.stats()
+        await cache.invalidate("book:1")
+        return stats, await cache.backend.get("book:1")
+
+    stats, value = asyncio.run(scenario())
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    assert value is None
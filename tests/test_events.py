@@ -0,0 +1,165 @@
+import asyncio
+import json
+
+import fakeredis.aioredis
+import pytest
+
+import main
+from src import events
+from src.events import MemoryBroker, RedisBroker
+from src.model import Book, Patron
+
+
+@pytest.fixture(scope="function", params=["memory", "redis"])
+def broker(request):
+    if request.param == "memory":
+        return lambda history_size=1000: MemoryBroker(history_size)
+    return lambda history_size=1000: RedisBroker(fakeredis.aioredis.FakeRedis(), history_size)
+
+
+@pytest.fixture(scope="function")
+def client(make_config, serve, monkeypatch):
+    config = make_config()
+    with config.session_scope() as db:
+        db.add_all([Book(title=f"Book {i}", author="Author", published_year=2000) for i in range(3)])
+        db.add(Patron(name="John Doe", email="johndoe@gmail.com"))
+        db.commit()
+    monkeypatch.setattr(main, "event_broker", MemoryBroker())
+    with serve(config) as test_client:
+        yield test_client
+
+
+async def take(subscription, count):
+    return [await anext(subscription) for _ in range(count)]
+
+
+def test_subscribers_get_the_events_of_their_books(broker):
+    async def scenario():
+        event_broker = broker()
+        all_books = event_broker.subscribe(keepalive_seconds=1)
+        second_book = event_broker.subscribe([2], keepalive_seconds=1)
+        # Subscribed once the generators start, the broker doesn't replay events to new subscribers
+        first_events = asyncio.gather(take(all_books, 3), take(second_book, 1))
+        await asyncio.sleep(0.05)
+        await event_broker.publish(events.CHECKOUT, 1, {"id": 1})
+        await event_broker.publish(events.UPDATE, 2, {"id": 2})
+        await event_broker.publish(events.DELETE, 3)
+        everything, filtered = await first_events
+        await all_books.aclose()
+        await second_book.aclose()
+        return everything, filtered
+
+    everything, filtered = asyncio.run(scenario())
+
+    assert [(event["id"], event["type"], event["book_id"]) for event in everything] == \
+           [(1, "checkout", 1), (2, "update", 2), (3, "delete", 3)]
+    assert filtered == [{"id": 2, "type": "update", "book_id": 2, "data": {"id": 2}}]
+
+
+def test_redis_workers_publish_in_id_order():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        workers = [RedisBroker(fakeredis.aioredis.FakeRedis(server=server)) for _ in range(2)]
+        subscription = workers[0].subscribe(keepalive_seconds=1)
+        received = asyncio.ensure_future(take(subscription, 20))
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*(workers[book_id % 2].publish(events.UPDATE, book_id) for book_id in range(20)))
+        ids = [event["id"] for event in await received]
+        await subscription.aclose()
+        return ids
+
+    assert asyncio.run(scenario()) == list(range(1, 21))
+
+
+def test_subscribers_resume_after_the_last_event_id(broker):
+    async def scenario():
+        event_broker = broker()
+        for book_id in range(1, 5):
+            await event_broker.publish(events.RETURN, book_id)
+        subscription = event_broker.subscribe(last_event_id=2, keepalive_seconds=0.01)
+        resumed = await take(subscription, 3)
+        await subscription.aclose()
+        return resumed
+
+    assert [event and event["id"] for event in asyncio.run(scenario())] == [3, 4, None]
+
+
+def test_resuming_from_a_forgotten_event_starts_with_a_reset(broker):
+    async def scenario():
+        event_broker = broker(history_size=2)
+        for book_id in range(1, 6):
+            await event_broker.publish(events.RETURN, book_id)
+        subscription = event_broker.subscribe([5], last_event_id=1)
+        resumed = await take(subscription, 2)
+        await subscription.aclose()
+        return resumed
+
+    reset, missed = asyncio.run(scenario())
+
+    assert reset["type"] == "reset"
+    assert (missed["id"], missed["book_id"]) == (5, 5)
+    assert events.sse_message(reset) == f"event: reset\ndata: {json.dumps(reset)}\n\n"
+
+
+def test_memory_broker_drops_subscribers_that_fall_behind(monkeypatch):
+    monkeypatch.setattr(events, "MAX_PENDING_EVENTS", 2)
+
+    async def scenario():
+        event_broker = MemoryBroker()
+        subscription = event_broker.subscribe()
+        pending = asyncio.create_task(anext(subscription))
+        await asyncio.sleep(0)
+        for book_id in range(1, 5):
+            await event_broker.publish(events.RETURN, book_id)
+        received = [(await pending)["id"]] + [event["id"] async for event in subscription]
+        return received, event_broker._subscribers
+
+    received, subscribers = asyncio.run(scenario())
+
+    assert received == [1, 2]
+    assert not subscribers
+
+
+def test_websocket_receives_checkouts_and_returns(client):
+    with client.websocket_connect("/events/ws?book_id=2") as websocket:
+        assert client.post("/checkout/1/patron/1").status_code == 200
+        assert client.post("/checkout/2/patron/1").status_code == 200
+        assert client.post("/return/2").status_code == 200
+
+        checkout = websocket.receive_json()
+        returned = websocket.receive_json()
+
+    assert (checkout["type"], checkout["book_id"], checkout["data"]["patron_id"]) == ("checkout", 2, 1)
+    assert (returned["type"], returned["data"]["is_checked_out"]) == ("return", False)
+    assert returned["id"] == checkout["id"] + 1
+
+
+def test_bulk_checkouts_updates_and_deletes_are_published(client):
+    client.post("/checkout/bulk", json={"patron_id": 1, "book_ids": [1, 3, 99]})
+    client.put("/books/2", json={"title": "Renamed"})
+    client.delete("/books/3")
+
+    history = list(main.event_broker._history)
+
+    assert [(event["type"], event["book_id"]) for event in history] == \
+           [("checkout", 1), ("checkout", 3), ("update", 2), ("delete", 3)]
+    assert history[0]["data"]["patron_id"] == 1 and history[0]["data"]["due_date"]
+    assert history[2]["data"]["title"] == "Renamed"
+
+
+def test_event_stream_resumes_from_the_last_event_id(client):
+    for book_id in (1, 2, 3):
+        client.post(f"/checkout/{book_id}/patron/1")
+
+    async def scenario():
+        response = await main.stream_events(book_id=[1, 3], last_event_id=1)
+        messages = response.body_iterator
+        resumed = await anext(messages)
+        await messages.aclose()
+        return response, resumed
+
+    response, resumed = asyncio.run(scenario())
+
+    assert response.media_type == "text/event-stream"
+    assert resumed.startswith("id: 3\nevent: checkout\ndata: ")
+    assert json.loads(resumed.split("data: ", 1)[1])["data"]["title"] == "Book 2"
@@ -0,0 +1,73 @@
+import csv
+import gzip
+import io
+import json
+
+import pyarrow.parquet as pq
+import pytest
+
+from src import export, tasks
+from src.model import Book, Patron
+
+
+@pytest.fixture(scope="function")
+def config(make_config):
+    config = make_config()
+    with config.session_scope() as db:
+        db.add_all([Book(title=f"Book {i}", author="Author", published_year=2000 + i) for i in range(7)])
+        db.add(Patron(name="John Doe", email="johndoe@gmail.com"))
+        db.commit()
+    return config
+
+
+@pytest.fixture(scope="function")
+def client(config, serve):
+    with serve(config) as test_client:
+        yield test_client
+
+
+def test_export_books_as_csv(client):
+    response = client.get("/export/books")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.headers["content-disposition"] == 'attachment; filename="books.csv"'
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["title"] for row in rows] == [f"Book {i}" for i in range(7)]
+    assert rows[0]["published_year"] == "2000"
+
+
+def test_export_patrons_as_gzipped_ndjson(client):
+    response = client.get("/export/patrons", params={"format": "ndjson", "gzip": True})
+    assert response.headers["content-type"] == "application/gzip"
+    patrons = [json.loads(line) for line in gzip.decompress(response.content).splitlines()]
+    assert [(patron["name"], patron["version"]) for patron in patrons] == [("John Doe", 1)]
+
+
+def test_export_books_as_parquet(client):
+    response = client.get("/export/books", params={"format": "parquet"})
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.column("title").to_pylist() == [f"Book {i}" for i in range(7)]
+    assert table.schema.field("is_checked_out").type == "bool"
+
+
+def test_export_rejects_unknown_formats(client):
+    assert client.get("/export/books", params={"format": "xlsx"}).status_code == 422
+
+
+def test_export_is_written_batch_by_batch(config):
+    with config.session_scope() as db:
+        assert len(list(export.export(db, "books", "ndjson", batch_size=3))) == 3
+        parquet = b"".join(export.export(db, "books", "parquet", batch_size=3))
+    assert pq.ParquetFile(io.BytesIO(parquet)).num_row_groups == 3
+
+
+def test_export_task_writes_a_file(config, monkeypatch, tmp_path):
+    monkeypatch.setattr(tasks, "database_config", config)
+    monkeypatch.setattr(tasks, "export_dir", str(tmp_path))
+
+    stats = tasks.export_table.apply(args=("books", "csv", True)).get()
+
+    assert stats["path"].startswith(str(tmp_path)) and stats["path"].endswith(".csv.gz")
+    with gzip.open(stats["path"], "rt") as file:
+        assert len(list(csv.DictReader(file))) == 7
+    assert [path.name for path in tmp_path.iterdir()] == [stats["path"].rsplit("/", 1)[1]]
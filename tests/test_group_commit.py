@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime
+
+import httpx
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+import main
+from main import app
+from src import circulation, crud
+from src.group_commit import GroupCommit
+from src.model import Book
+
+
+class FakeDatabaseSession:
+    async def run(self, fn, *args):
+        return fn(None, *args)
+
+
+def test_concurrent_submissions_share_one_write():
+    writes = []
+
+    def write(db, items):
+        writes.append(list(items))
+        return [ValueError(item) if item < 0 else item * 10 for item in items]
+
+    async def scenario():
+        group_commit = GroupCommit(write, window_seconds=0.05, max_rows=3)
+        return await asyncio.gather(*(group_commit.submit(FakeDatabaseSession(), item) for item in [1, 2, -3, 4]),
+                                    return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert results[:2] == [10, 20] and results[3] == 40
+    assert isinstance(results[2], ValueError)
+    # The third item fills the first batch, the fourth starts another one
+    assert writes == [[1, 2, -3], [4]]
+
+
+def test_failed_write_fails_the_whole_batch():
+    def write(db, items):
+        raise RuntimeError("Database is gone")
+
+    async def scenario():
+        group_commit = GroupCommit(write, window_seconds=0.01)
+        return await asyncio.gather(*(group_commit.submit(FakeDatabaseSession(), item) for item in range(3)),
+                                    return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(scenario()))
+
+
+def counting_writes(write):
+    def counted(db, items):
+        counted.batch_sizes.append(len(items))
+        return write(db, items)
+
+    counted.batch_sizes = []
+    return counted
+
+
+@pytest.fixture(scope="function", params=["sync", "async"])
+def config(request, make_config, use_config, monkeypatch):
+    config = make_config(async_mode=request.param == "async")
+    use_config(config)
+    monkeypatch.setattr(main, "book_commits", GroupCommit(counting_writes(crud.create_books), window_seconds=0.2,
+                                                          max_rows=8))
+    monkeypatch.setattr(main, "patron_commits", GroupCommit(crud.create_patrons, window_seconds=0.05, max_rows=8))
+    return config
+
+
+def test_concurrent_creates_are_group_committed(config):
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            books = await asyncio.gather(*(client.post("/books/", json={"title": f"Book {i}", "author": "Author"})
+                                           for i in range(20)))
+            patrons = await asyncio.gather(*(client.post("/patrons/", json={"name": f"Patron {i}",
+                                                                             "email": f"patron{i}@example.com"})
+                                             for i in range(5)))
+            search = await client.get("/books/search", params={"q": "Book"})
+        if config.async_mode:
+            await config.async_engine.dispose()
+        return books, patrons, search
+
+    books, patrons, search = asyncio.run(scenario())
+    assert all(response.status_code == 200 for response in books + patrons)
+    book_ids = [response.json()["id"] for response in books]
+    assert len(set(book_ids)) == 20
+    assert sorted(main.book_commits.write.batch_sizes) == [4, 8, 8]
+    assert [response.json()["title"] for response in books] == [f"Book {i}" for i in range(20)]
+    assert len({response.json()["id"] for response in patrons}) == 5
+    assert len(search.json()) == 10
+    with config.session_scope() as db:
+        assert circulation.snapshot(db, datetime.utcnow())["total"] == 20
+
+
+def test_add_all_reports_the_error_of_each_row(config):
+    with config.session_scope() as db:
+        first = crud.add_all(db, Book, [{"title": "1984", "author": "George Orwell"}])[0]
+    with config.session_scope() as db:
+        results = crud.add_all(db, Book, [{"title": "Dune", "author": "Frank Herbert"},
+                                          {"id": first.id, "title": "Duplicate", "author": "Author"},
+                                          {"title": "Emma", "author": "Jane Austen"}],
+                               on_inserted=circulation.record_books_added)
+        assert isinstance(results[1], IntegrityError)
+        assert [results[0].title, results[2].title] == ["Dune", "Emma"]
+        assert db.query(Book).count() == 3
+        assert circulation.snapshot(db, datetime.utcnow())["total"] == 2
@@ -0,0 +1,143 @@
+import socket
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from src.mailer import Mailer, SmtpPool, Email, TokenBucket, MemoryDeduplicator
+
+
+class RecordingHandler:
+    """Accepts every message, or rejects the first ones with the replies in `failures`."""
+
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.messages = []
+        self.peers = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.failures:
+            return self.failures.pop(0)
+        self.messages.append(envelope)
+        self.peers.add(session.peer)
+        return "250 OK"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="function")
+def smtp_server():
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    yield controller
+    controller.stop()
+
+
+def emails(count, dedup_keys=False):
+    return [Email(f"patron{i}@example.com", "Overdue Book Reminder", f"Dear patron {i}",
+                  dedup_key=f"patron:{i}" if dedup_keys else None) for i in range(count)]
+
+
+def test_messages_share_pooled_connections(smtp_server):
+    pool = SmtpPool("127.0.0.1", smtp_server.port)
+    mailer = Mailer(pool, concurrency=4, rate_per_second=0)
+
+    stats = mailer.send_all(emails(200))
+    mailer.close()
+
+    assert (stats["sent"], stats["failed"]) == (200, 0)
+    assert stats["messages_per_second"] > 0
+    assert len(smtp_server.handler.messages) == 200
+    assert len({envelope.rcpt_tos[0] for envelope in smtp_server.handler.messages}) == 200
+    assert len(smtp_server.handler.peers) <= 4
+
+
+def test_transient_failures_are_retried_with_backoff(smtp_server):
+    smtp_server.handler.failures = ["451 Try again later", "421 Too busy"]
+    backoffs = []
+    mailer = Mailer(SmtpPool("127.0.0.1", smtp_server.port), concurrency=1, rate_per_second=0,
+                    sleep=backoffs.append)
+
+    stats = mailer.send_all(emails(1))
+
+    assert (stats["sent"], stats["retries"]) == (1, 2)
+    assert backoffs == [1, 2]
+    mailer.close()
+
+
+def test_permanent_failures_are_not_retried(smtp_server):
+    smtp_server.handler.failures = ["550 No such user"]
+    deduplicator = MemoryDeduplicator()
+    mailer = Mailer(SmtpPool("127.0.0.1", smtp_server.port), concurrency=1, rate_per_second=0,
+                    deduplicator=deduplicator, sleep=lambda seconds: None)
+
+    stats = mailer.send_all(emails(1, dedup_keys=True))
+
+    assert (stats["sent"], stats["failed"], stats["retries"]) == (0, 1, 0)
+    # The failed message may be sent again later
+    assert mailer.send_all(emails(1, dedup_keys=True))["sent"] == 1
+    mailer.close()
+
+
+def test_unreachable_server_fails_after_all_attempts():
+    backoffs = []
+    mailer = Mailer(SmtpPool("127.0.0.1", 1, timeout=1), concurrency=1, rate_per_second=0, max_attempts=3,
+                    sleep=backoffs.append)
+
+    assert mailer.send_all(emails(1))["failed"] == 1
+    assert backoffs == [1, 2]
+
+
+def test_duplicates_are_skipped(smtp_server):
+    mailer = Mailer(SmtpPool("127.0.0.1", smtp_server.port), rate_per_second=0)
+
+    first = mailer.send_all(emails(3, dedup_keys=True))
+    second = mailer.send_all(emails(5, dedup_keys=True))
+    mailer.close()
+
+    assert (first["sent"], second["sent"], second["duplicates"]) == (3, 2, 3)
+    assert len(smtp_server.handler.messages) == 5
+
+
+def test_pooled_connection_closed_by_the_server_is_replaced(smtp_server):
+    pool = SmtpPool("127.0.0.1", smtp_server.port)
+    mailer = Mailer(pool, rate_per_second=0)
+    mailer.send_all(emails(1))
+    idle = pool._idle.get_nowait()
+    idle.close()
+    pool._idle.put(idle)
+
+    assert mailer.send_all(emails(1))["sent"] == 1
+    assert pool.connections_opened == 2
+    mailer.close()
+
+
+def test_token_bucket_limits_the_rate():
+    now = [0.0]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(rate=10, capacity=2, clock=lambda: now[0], sleep=sleep)
+    for _ in range(4):
+        bucket.acquire()
+
+    assert waits == [pytest.approx(0.1), pytest.approx(0.1)]
+
+
+def test_memory_deduplicator_forgets_expired_keys():
+    now = [0.0]
+    deduplicator = MemoryDeduplicator(ttl_seconds=10, clock=lambda: now[0])
+    assert deduplicator.claim("patron-1") and deduplicator.claim("patron-2")
+    assert not deduplicator.claim("patron-1")
+
+    now[0] = 10
+    assert deduplicator.claim("patron-3")
+    assert len(deduplicator) == 1
+    assert deduplicator.claim("patron-1")
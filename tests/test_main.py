@@ -1,39 +1,34 @@
+from datetime import datetime
+
 import pytest
-from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import false
+from sqlalchemy.exc import ProgrammingError
+
+import main
+from src import circulation, crud, queries, search
+from src.search import BookSearch
+from src.model import Book, WeeklyReport
+from src.model_dto import BookUpdateDto
+from src.pagination import encode_cursor
 
-from main import app, database_config
-from src.model import Base
 
-# Set up an in-memory SQLite database for testing purposes
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+@pytest.fixture(scope="function")
+def config(make_config):
+    return make_config()
 
 
 # Create a new database session for each test
 @pytest.fixture(scope="function")
-def db_session():
-    Base.metadata.create_all(bind=engine)
-    db = TestingSessionLocal()
-    try:
+def db_session(config):
+    with config.session_scope() as db:
         yield db
-    finally:
-        db.close()
-        Base.metadata.drop_all(bind=engine)
-
 
-@pytest.fixture(scope="function")
-def client(db_session):
-    def _get_db():
-        try:
-            yield db_session
-        finally:
-            db_session.close()
 
-    app.dependency_overrides[database_config.get_db] = _get_db
-    return TestClient(app)
+# Every API test runs against both the threadpool (sync) and the AsyncSession (async) database path
+@pytest.fixture(scope="function", params=["sync", "async"])
+def client(request, config, db_session, make_config, serve):
+    with serve(config if request.param == "sync" else make_config(async_mode=True)) as test_client:
+        yield test_client
 
 
 def test_read_root(client):
@@ -111,6 +106,452 @@ def test_delete_patron(client):
     assert response.status_code == 404
 
 
+def test_list_books_paginates_with_cursor(client):
+    for i in range(5):
+        client.post("/books/", json={"title": f"Book {i}", "author": "Author", "isbn": "0-8436-1072-7",
+                                     "published_year": 2000 + i})
+    response = client.get("/books", params={"limit": 2})
+    assert response.status_code == 200
+    first_page = response.json()
+    assert [book["title"] for book in first_page["items"]] == ["Book 0", "Book 1"]
+    assert first_page["next_cursor"]
+
+    seen = [book["id"] for book in first_page["items"]]
+    cursor = first_page["next_cursor"]
+    while cursor:
+        page = client.get("/books", params={"limit": 2, "cursor": cursor}).json()
+        seen.extend(book["id"] for book in page["items"])
+        cursor = page["next_cursor"]
+    assert len(seen) == 5 and seen == sorted(seen)
+
+
+def test_list_books_filters(client):
+    client.post("/books/", json={"title": "Animal Farm", "author": "George Orwell", "published_year": 1945})
+    client.post("/books/", json={"title": "1984", "author": "George Orwell", "published_year": 1949})
+    client.post("/books/", json={"title": "Brave New World", "author": "Aldous Huxley", "published_year": 1932})
+
+    response = client.get("/books", params={"author": "George Orwell", "published_year_min": 1946})
+    assert [book["title"] for book in response.json()["items"]] == ["1984"]
+    response = client.get("/books", params={"title_prefix": "Br"})
+    assert [book["title"] for book in response.json()["items"]] == ["Brave New World"]
+    response = client.get("/books", params={"title_prefix": "%"})
+    assert response.json()["items"] == []
+
+
+def test_get_books_by_ids(client):
+    for title in ("Animal Farm", "1984", "Brave New World"):
+        client.post("/books/", json={"title": title, "author": "Author"})
+
+    response = client.get("/books", params={"ids": "3,99,1,3", "fields": "title"})
+    assert response.status_code == 200
+    assert response.json() == {
+        "items": [{"id": 3, "title": "Brave New World"}, None, {"id": 1, "title": "Animal Farm"},
+                  {"id": 3, "title": "Brave New World"}],
+        "not_found": [99],
+    }
+    response = client.get("/books", params={"ids": "2", "fields": "is_checked_out,due_date", "author": "Nobody"})
+    assert list(response.json()["items"][0]) == ["id", "is_checked_out", "due_date"]
+    assert client.get("/books", params={"ids": "1", "fields": "password"}).status_code == 400
+    assert client.get("/books", params={"ids": "1,two"}).status_code == 400
+    assert client.get("/books", params={"ids": ",".join(map(str, range(501)))}).status_code == 400
+
+
+def test_lookups_are_documented(client):
+    schema = client.get("/openapi.json").json()
+    for path, dto in (("/books", "BookDto"), ("/patrons", "PatronDto")):
+        response_schema = schema["paths"][path]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+        assert [option["$ref"] for option in response_schema["anyOf"]] == \
+               [f"#/components/schemas/PageDto_{dto}_", f"#/components/schemas/LookupDto_{dto}_"]
+
+
+def test_list_with_sparse_fields(client):
+    client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"})
+    client.post("/patrons/", json={"name": "Jane Doe", "email": "janedoe@gmail.com"})
+
+    response = client.get("/patrons", params={"fields": "name", "limit": 1})
+    assert response.json()["items"] == [{"id": 1, "name": "John Doe"}]
+    response = client.get("/patrons", params={"fields": "name", "cursor": response.json()["next_cursor"]})
+    assert response.json()["items"] == [{"id": 2, "name": "Jane Doe"}]
+    response = client.get("/patrons", params={"ids": "2,3", "fields": "email"})
+    assert response.json() == {"items": [{"id": 2, "email": "janedoe@gmail.com"}, None], "not_found": [3]}
+
+
+def test_list_books_rejects_invalid_page_params(client):
+    assert client.get("/books", params={"cursor": "not-a-cursor"}).status_code == 400
+    assert client.get("/books", params={"cursor": encode_cursor(True)}).status_code == 400
+    assert client.get("/books", params={"cursor": encode_cursor("1")}).status_code == 400
+    assert client.get("/books", params={"limit": 100000}).status_code == 422
+
+
+def test_bulk_create_books_from_ndjson(client):
+    body = "\n".join([
+        '{"title": "1984", "author": "George Orwell", "isbn": "0-8436-1072-7"}',
+        '{"title": "Bad ISBN", "author": "Nobody", "isbn": "123"}',
+        'not json',
+        '',
+        '{"title": "Animal Farm", "author": "George Orwell"}',
+    ])
+
+    def chunks():
+        for start in range(0, len(body), 7):
+            yield body[start:start + 7].encode()
+
+    response = client.post("/books/bulk", params={"batch_size": 1}, content=chunks(),
+                           headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    result = response.json()
+    assert (result["received"], result["inserted"], result["failed"]) == (4, 2, 2)
+    assert [error["row"] for error in result["errors"]] == [2, 3]
+    books = client.get("/books").json()["items"]
+    assert [book["title"] for book in books] == ["1984", "Animal Farm"]
+    assert [book["version"] for book in books] == [1, 1]
+
+
+def test_bulk_create_patrons_from_json_array(client):
+    response = client.post("/patrons/bulk", json=[
+        {"name": "John Doe", "email": "johndoe@gmail.com"},
+        {"name": "No Email"},
+        {"name": "Jane Doe", "email": "janedoe@gmail.com"},
+    ])
+    assert response.status_code == 200
+    result = response.json()
+    assert (result["received"], result["inserted"], result["failed"]) == (3, 2, 1)
+    patrons = client.get("/patrons").json()["items"]
+    assert [patron["name"] for patron in patrons] == ["John Doe", "Jane Doe"]
+    assert all(patron["membership_start_date"] for patron in patrons)
+
+
+def test_bulk_create_books_rejects_malformed_array(client):
+    response = client.post("/books/bulk", params={"batch_size": 1},
+                           content=b'[{"title": "1984", "author": "George Orwell"}, {"title"',
+                           headers={"Content-Type": "application/json"})
+    assert response.status_code == 400
+    result = response.json()
+    # The first book was committed before the body turned out to be malformed
+    assert (result["received"], result["inserted"], result["aborted"]["row"]) == (1, 1, 2)
+    assert result["detail"] == result["aborted"]["message"] == "Malformed JSON array"
+    assert [book["title"] for book in client.get("/books").json()["items"]] == ["1984"]
+
+
+@pytest.mark.parametrize("body, inserted", [
+    (b'[{"title": "1984", "author": "George Orwell"} {"title": "Animal Farm", "author": "George Orwell"}]', 1),
+    (b'[,,{"title": "1984", "author": "George Orwell"}]', 0),
+    (b'[{"title": "1984", "author": "George Orwell"},]', 1),
+])
+def test_bulk_create_books_requires_one_comma_between_elements(client, body, inserted):
+    response = client.post("/books/bulk", content=body, headers={"Content-Type": "application/json"})
+    assert response.status_code == 400
+    result = response.json()
+    assert (result["inserted"], result["aborted"]["row"]) == (inserted, inserted + 1)
+    assert result["detail"] == "Malformed JSON array"
+
+
+def test_get_book_is_cached_and_invalidated_on_update(client):
+    response = client.post("/books/", json={"title": "1984", "author": "George Orwell"})
+    book_id = response.json()["id"]
+    client.get(f"/books/{book_id}")
+    client.get(f"/books/{book_id}")
+    assert main.entity_cache.stats()["hits"] == 1
+
+    client.put(f"/books/{book_id}", json={"author": "G. Orwell"})
+    assert client.get(f"/books/{book_id}").json()["author"] == "G. Orwell"
+
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    client.post(f"/checkout/{book_id}/patron/{patron_id}")
+    assert client.get(f"/books/{book_id}").json()["patron_id"] == patron_id
+    client.post(f"/return/{book_id}")
+    assert client.get(f"/books/{book_id}").json()["patron_id"] is None
+    assert client.get("/cache/stats").json()["backend"] == "memory"
+
+
+def test_list_checked_out_and_overdue_books(client):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_ids = [client.post("/books/", json={"title": f"Book {i}", "author": "Author"}).json()["id"]
+                for i in range(4)]
+    for book_id, period in zip(book_ids[:3], [30, 7, 14]):
+        client.post(f"/checkout/{book_id}/patron/{patron_id}", params={"checkout_period": period})
+    client.put(f"/books/{book_ids[0]}", json={"due_date": "2000-01-01T00:00:00"})
+    client.put(f"/books/{book_ids[1]}", json={"due_date": "2000-01-02T00:00:00"})
+
+    checked_out = client.get("/books/checkedout/").json()["items"]
+    assert [book["id"] for book in checked_out] == book_ids[:3]
+
+    overdue = client.get("/books/overdue/", params={"sort": "due_date"}).json()["items"]
+    assert [book["id"] for book in overdue] == book_ids[:2]
+
+    page = client.get("/books/checkedout/", params={"sort": "due_date", "limit": 2}).json()
+    assert [book["id"] for book in page["items"]] == book_ids[:2]
+    page = client.get("/books/checkedout/",
+                      params={"sort": "due_date", "limit": 2, "cursor": page["next_cursor"]}).json()
+    assert [book["id"] for book in page["items"]] == [book_ids[2]]
+    assert page["next_cursor"] is None
+
+    by_patron = client.get(f"/books/patron/{patron_id}").json()["items"]
+    assert len(by_patron) == 3
+
+
+def test_list_items_match_the_book_representation(client):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell", "isbn": "0-8436-1072-7",
+                                           "published_year": 1949}).json()["id"]
+    client.post(f"/checkout/{book_id}/patron/{patron_id}")
+    client.put(f"/books/{book_id}", json={"due_date": "2030-01-02T03:04:05.123456"})
+
+    book = client.get(f"/books/{book_id}").json()
+    assert book["due_date"] == "2030-01-02T03:04:05.123456"
+    assert client.get("/books").json()["items"] == [book]
+    assert client.get("/books/checkedout/").json()["items"] == [book]
+    assert client.get(f"/books/patron/{patron_id}").json()["items"] == [book]
+    assert client.get("/patrons").json()["items"] == [client.get(f"/patrons/{patron_id}").json()]
+
+
+def test_circulation_counters_follow_writes(client, db_session):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_ids = [client.post("/books/", json={"title": f"Book {i}", "author": "Author"}).json()["id"]
+                for i in range(3)]
+    client.post("/books/bulk", content=b'{"title": "Bulk", "author": "Author"}\n')
+    for book_id in book_ids:
+        client.post(f"/checkout/{book_id}/patron/{patron_id}")
+    client.put(f"/books/{book_ids[0]}", json={"due_date": "2000-01-01T00:00:00"})
+    client.post(f"/return/{book_ids[1]}")
+    client.delete(f"/books/{book_ids[2]}")
+
+    stats = circulation.snapshot(db_session, datetime.utcnow())
+    assert (stats["total"], stats["checked_out"], stats["in_library"]) == (3, 1, 2)
+    assert (stats["overdue"], stats["overdue_over_30_days"]) == (1, 1)
+    assert circulation.reconcile(db_session) == {}
+
+
+def test_list_reports(client, db_session):
+    db_session.add(WeeklyReport(created_at=datetime(2024, 1, 6), total=3, in_library=2, checked_out=1, overdue=1,
+                                overdue_1_7_days=1, overdue_8_30_days=0, overdue_over_30_days=0))
+    db_session.commit()
+    reports = client.get("/reports").json()["items"]
+    assert [(report["created_at"], report["total"]) for report in reports] == [("2024-01-06T00:00:00", 3)]
+
+
+def test_search_books(client):
+    orwell_id = client.post("/books/", json={"title": "Nineteen Eighty-Four", "author": "George Orwell",
+                                             "isbn": "0-8436-1072-7"}).json()["id"]
+    client.post("/books/", json={"title": "Animal Farm", "author": "George Orwell"})
+    client.post("/books/", json={"title": "The Road to Wigan Pier", "author": "George Orwell"})
+    assert [book["title"] for book in client.get("/books/search", params={"q": "orwell nine"}).json()] == \
+           ["Nineteen Eighty-Four"]
+    assert client.get("/books/search", params={"q": "0843610727"}).json()[0]["id"] == orwell_id
+
+    results = client.get("/books/search", params={"q": "animal"}).json()
+    assert [book["title"] for book in results] == ["Animal Farm"]
+    client.put(f"/books/{results[0]['id']}", json={"title": "Animal Farm: A Fairy Story"})
+    assert len(client.get("/books/search", params={"q": "fairy"}).json()) == 1
+    client.delete(f"/books/{orwell_id}")
+    assert client.get("/books/search", params={"q": "eighty"}).json() == []
+
+    client.post("/books/bulk", content=b'{"title": "Homage to Catalonia", "author": "George Orwell"}\n')
+    assert len(client.get("/books/search", params={"q": "geo"}).json()) == 3
+
+
+def test_search_falls_back_without_a_fulltext_index(client, monkeypatch):
+    class MissingIndex(Exception):
+        errno = search.ER_FT_MATCHING_KEY_NOT_FOUND
+
+    def fulltext_search(db, query, limit):
+        raise ProgrammingError("SELECT ... MATCH", {}, MissingIndex())
+
+    monkeypatch.setattr(main, "book_search", BookSearch("fulltext"))
+    monkeypatch.setattr(search, "fulltext_search", fulltext_search)
+    client.post("/books/", json={"title": "Animal Farm", "author": "George Orwell"})
+
+    assert [book["title"] for book in client.get("/books/search", params={"q": "farm"}).json()] == ["Animal Farm"]
+    assert main.book_search.backend == "memory"
+
+
+def test_checkout_and_return_book(client):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+
+    assert client.post(f"/checkout/{book_id}/patron/999").status_code == 404
+    assert client.post(f"/checkout/999/patron/{patron_id}").status_code == 404
+    response = client.post(f"/checkout/{book_id}/patron/{patron_id}", params={"checkout_period": 7})
+    assert response.status_code == 200
+    assert response.json()["is_checked_out"] is True
+    assert response.json()["patron_id"] == patron_id
+    response = client.post(f"/checkout/{book_id}/patron/{patron_id}")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Book already checked out"}
+
+    response = client.post(f"/return/{book_id}")
+    assert response.status_code == 200
+    assert (response.json()["is_checked_out"], response.json()["due_date"]) == (False, None)
+    assert client.post(f"/return/{book_id}").status_code == 404
+
+
+def test_bulk_checkout(client):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_ids = [client.post("/books/", json={"title": f"Book {i}", "author": "Author"}).json()["id"]
+                for i in range(3)]
+    client.post(f"/checkout/{book_ids[1]}/patron/{patron_id}")
+
+    response = client.post("/checkout/bulk", json={"patron_id": patron_id, "book_ids": [book_ids[2], book_ids[1],
+                                                                                       999, book_ids[0]]})
+    assert response.status_code == 200
+    assert [(result["book_id"], result["status"]) for result in response.json()] == [
+        (book_ids[2], "checked_out"), (book_ids[1], "already_checked_out"), (999, "not_found"),
+        (book_ids[0], "checked_out")]
+    assert len(client.get("/books/checkedout/").json()["items"]) == 3
+    assert client.post("/checkout/bulk", json={"patron_id": 999, "book_ids": [book_ids[0]]}).status_code == 404
+
+    assert [book["version"] for book in client.get("/books").json()["items"]] == [2, 2, 2]
+
+    # A retry within the same second reports the books as taken rather than checking them out again
+    retry = client.post("/checkout/bulk", json={"patron_id": patron_id, "book_ids": [book_ids[0]]}).json()
+    assert [result["status"] for result in retry] == ["already_checked_out"]
+    assert len(client.get(f"/books/{book_ids[0]}/loans").json()["items"]) == 1
+
+
+def test_bulk_checkout_gives_up_under_contention(client, monkeypatch):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+    # As if another transaction took the book between every read and update
+    monkeypatch.setattr(queries, "IS_IN_LIBRARY", false())
+
+    response = client.post("/checkout/bulk", json={"patron_id": patron_id, "book_ids": [book_id]})
+
+    assert response.status_code == 409
+    assert client.get(f"/books/{book_id}/loans").json()["items"] == []
+
+
+def test_loan_history(client):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_ids = [client.post("/books/", json={"title": f"Book {i}", "author": "Author"}).json()["id"]
+                for i in range(3)]
+    client.post(f"/checkout/{book_ids[0]}/patron/{patron_id}")
+    client.post(f"/return/{book_ids[0]}")
+    client.post("/checkout/bulk", json={"patron_id": patron_id, "book_ids": book_ids})
+
+    loans = client.get(f"/patrons/{patron_id}/loans").json()["items"]
+    assert [loan["book_id"] for loan in loans] == [book_ids[0]] + book_ids
+    assert loans[0]["returned_at"] is not None
+    assert all(loan["returned_at"] is None for loan in loans[1:])
+
+    client.post(f"/return/{book_ids[0]}")
+    history = client.get(f"/books/{book_ids[0]}/loans").json()["items"]
+    assert len(history) == 2
+    assert all(loan["patron_id"] == patron_id and loan["returned_at"] is not None for loan in history)
+
+    page = client.get(f"/patrons/{patron_id}/loans", params={"limit": 2}).json()
+    rest = client.get(f"/patrons/{patron_id}/loans", params={"limit": 2, "cursor": page["next_cursor"]}).json()
+    assert [loan["id"] for loan in page["items"] + rest["items"]] == [loan["id"] for loan in loans]
+    since = loans[1]["checked_out_at"]
+    assert len(client.get(f"/patrons/{patron_id}/loans", params={"since": since}).json()["items"]) == 3
+    assert len(client.get(f"/patrons/{patron_id}/loans", params={"until": since}).json()["items"]) == 1
+
+
+def test_delete_patron_keeps_the_loan_history(client):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+    client.post(f"/checkout/{book_id}/patron/{patron_id}")
+    # Cached with the patron, which must not outlive the patron
+    assert client.get(f"/books/{book_id}").json()["patron_id"] == patron_id
+
+    assert client.delete(f"/patrons/{patron_id}").status_code == 200
+    response = client.get(f"/books/{book_id}")
+    assert (response.json()["patron_id"], response.json()["version"]) == (None, 3)
+    assert response.headers["etag"] == '"3"'
+    assert [loan["patron_id"] for loan in client.get(f"/books/{book_id}/loans").json()["items"]] == [patron_id]
+
+
+def test_delete_checked_out_book_closes_its_loan(client):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+    client.post(f"/checkout/{book_id}/patron/{patron_id}")
+
+    assert client.delete(f"/books/{book_id}").status_code == 200
+    [loan] = client.get(f"/patrons/{patron_id}/loans").json()["items"]
+    assert loan["book_id"] == book_id and loan["returned_at"] is not None
+    # The id isn't given to the next book, which starts without a history
+    new_book_id = client.post("/books/", json={"title": "Animal Farm", "author": "George Orwell"}).json()["id"]
+    assert new_book_id != book_id
+    assert client.get(f"/books/{new_book_id}/loans").json()["items"] == []
+
+
+def test_updating_the_due_date_moves_the_open_loan(client):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+    client.post(f"/checkout/{book_id}/patron/{patron_id}")
+
+    client.put(f"/books/{book_id}", json={"due_date": "2030-01-01T00:00:00"})
+
+    [loan] = client.get(f"/books/{book_id}/loans").json()["items"]
+    assert loan["due_date"] == "2030-01-01T00:00:00"
+
+
+def test_conditional_get_book(client):
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+    response = client.get(f"/books/{book_id}")
+    assert response.headers["etag"] == '"1"'
+    assert response.json()["version"] == 1
+
+    response = client.get(f"/books/{book_id}", headers={"If-None-Match": '"1"'})
+    assert response.status_code == 304
+    assert response.headers["etag"] == '"1"'
+    assert response.content == b""
+    assert client.get(f"/books/{book_id}", headers={"If-None-Match": 'W/"0", W/"1"'}).status_code == 304
+    assert client.get("/books/999", headers={"If-None-Match": '"1"'}).status_code == 404
+
+    client.put(f"/books/{book_id}", json={"published_year": 1949})
+    response = client.get(f"/books/{book_id}", headers={"If-None-Match": '"1"'})
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"2"'
+
+
+def test_update_with_if_match(client):
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+    response = client.put(f"/books/{book_id}", json={"published_year": 1949}, headers={"If-Match": '"1"'})
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"2"'
+
+    response = client.put(f"/books/{book_id}", json={"published_year": 1950}, headers={"If-Match": '"1"'})
+    assert response.status_code == 412
+    assert client.put(f"/books/{book_id}", json={"published_year": 1950}, headers={"If-Match": 'W/"2"'}) \
+        .status_code == 412
+    assert client.get(f"/books/{book_id}").json()["published_year"] == 1949
+
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    response = client.get(f"/patrons/{patron_id}")
+    assert client.get(f"/patrons/{patron_id}", headers={"If-None-Match": response.headers["etag"]}) \
+        .status_code == 304
+    assert client.put(f"/patrons/{patron_id}", json={"name": "Jane"}, headers={"If-Match": '"7"'}).status_code == 412
+    assert client.put(f"/patrons/{patron_id}", json={"name": "Jane"}, headers={"If-Match": "*"}).status_code == 200
+
+
+def test_checkout_and_return_with_if_match(client):
+    patron_id = client.post("/patrons/", json={"name": "John Doe", "email": "johndoe@gmail.com"}).json()["id"]
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+
+    assert client.post(f"/checkout/{book_id}/patron/{patron_id}", headers={"If-Match": '"5"'}).status_code == 412
+    response = client.post(f"/checkout/{book_id}/patron/{patron_id}", headers={"If-Match": '"1"'})
+    assert response.status_code == 200
+    assert response.headers["etag"] == '"2"'
+    assert client.get(f"/books/{book_id}").json()["version"] == 2
+
+    assert client.post(f"/return/{book_id}", headers={"If-Match": '"1"'}).status_code == 412
+    response = client.post(f"/return/{book_id}", headers={"If-Match": '"2"'})
+    assert response.status_code == 200
+    assert response.json()["version"] == 3
+    assert response.headers["etag"] == '"3"'
+
+
+def test_concurrent_edits_fail_with_precondition_failed(config, db_session):
+    book = Book(title="1984", author="George Orwell")
+    db_session.add(book)
+    db_session.commit()
+    with config.session_scope() as other_session:
+        crud.update_book(other_session, book.id, BookUpdateDto(published_year=1949))
+
+    with pytest.raises(crud.PreconditionFailedError):
+        crud.update_book(db_session, book.id, BookUpdateDto(published_year=1950))
+
+
 if __name__ == '__main__':
     import pytest
 
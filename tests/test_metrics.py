@@ -0,0 +1,87 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from prometheus_client import REGISTRY, CollectorRegistry, multiprocess
+
+from src import metrics, tasks
+
+
+@pytest.fixture(scope="function", params=["sync", "async"])
+def config(request, make_config):
+    return make_config(async_mode=request.param == "async")
+
+
+@pytest.fixture(scope="function")
+def client(config, serve):
+    with serve(config) as test_client:
+        yield test_client
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_request_metrics_count_the_queries_of_the_route(client):
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+    route = {"method": "GET", "route": "/books/{book_id}"}
+    requests_before = sample("http_requests_total", status="200", **route)
+    queries_before = sample("http_request_db_queries_sum", **route)
+
+    assert client.get(f"/books/{book_id}").status_code == 200
+
+    assert sample("http_requests_total", status="200", **route) == requests_before + 1
+    assert sample("http_request_db_queries_sum", **route) > queries_before
+    assert sample("http_response_size_bytes_count", **route) > 0
+
+
+def test_unknown_paths_share_one_route_label(client):
+    before = sample("http_requests_total", method="GET", route=metrics.UNMATCHED_ROUTE, status="404")
+    client.get("/no/such/path/1")
+    client.get("/no/such/path/2")
+    assert sample("http_requests_total", method="GET", route=metrics.UNMATCHED_ROUTE, status="404") == before + 2
+
+
+def test_metrics_endpoint_reports_the_pool(client, config, monkeypatch):
+    monkeypatch.setitem(metrics.pool_collector.engines, "test", config.engine)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'db_pool_checked_out{engine="test"}' in response.text
+    assert "http_request_duration_seconds_bucket" in response.text
+
+
+def test_task_metrics(config, make_config, monkeypatch):
+    monkeypatch.setattr(tasks, "database_config", make_config())
+    task = {"task": tasks.generate_weekly_reports.name}
+    runs_before = sample("celery_tasks_total", state="SUCCESS", **task)
+    queries_before = sample("celery_task_db_queries_sum", **task)
+
+    tasks.generate_weekly_reports.apply()
+
+    assert sample("celery_tasks_total", state="SUCCESS", **task) == runs_before + 1
+    assert sample("celery_task_db_queries_sum", **task) > queries_before
+
+
+CHILD_PROCESS = """
+from sqlalchemy import create_engine
+from src import metrics
+engine = create_engine("sqlite:///./test.db")
+metrics.track_engine("celery", engine)
+connection = engine.connect()
+metrics.TASKS.labels("src.tasks.export_table", "SUCCESS").inc()
+"""
+
+
+def test_pool_processes_share_their_metrics_through_files(tmp_path):
+    # Like a prefork pool process, whose metrics are served by its parent
+    subprocess.run([sys.executable, "-c", CHILD_PROCESS], env={**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)},
+                   check=True)
+
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected, path=str(tmp_path))
+    assert collected.get_sample_value("db_pool_checked_out", {"engine": "celery"}) == 1
+    assert collected.get_sample_value("db_pool_size", {"engine": "celery"}) == 5
+    assert collected.get_sample_value("celery_tasks_total",
+                                      {"task": "src.tasks.export_table", "state": "SUCCESS"}) == 1
@@ -0,0 +1,93 @@
+import logging
+import pstats
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import main
+from src import tasks, profiling
+from src.model import Book
+from src.profiling import Profiler, Trace
+
+
+@pytest.fixture(scope="function")
+def config(make_config):
+    config = make_config()
+    with config.session_scope() as db:
+        db.add(Book(title="1984", author="George Orwell"))
+        db.commit()
+    return config
+
+
+@pytest.fixture(scope="function")
+def client(config, serve, monkeypatch, tmp_path):
+    monkeypatch.setattr(main.request_profiler, "profile_dir", str(tmp_path))
+    monkeypatch.setattr(main.request_profiler, "token", "secret")
+    with serve(config) as test_client:
+        yield test_client
+
+
+def function_names(path) -> set:
+    return {function for _, _, function in pstats.Stats(str(path)).stats}
+
+
+def test_requests_with_the_token_are_profiled(client, tmp_path):
+    response = client.get("/books", headers={"X-Profile": "secret"})
+
+    assert response.status_code == 200
+    profile_path = tmp_path / f"{response.headers['X-Profile-Id']}.prof"
+    # The data access function ran in the threadpool, which is profiled as well
+    assert {"list_books", "page_response"} <= function_names(profile_path)
+
+
+def test_profiling_with_a_query_parameter(client, tmp_path):
+    response = client.get("/books/1", params={"profile": "secret"})
+
+    assert (tmp_path / f"{response.headers['X-Profile-Id']}.prof").exists()
+
+
+def test_requests_without_the_token_are_not_profiled(client, tmp_path):
+    assert "X-Profile-Id" not in client.get("/books", headers={"X-Profile": "wrong"}).headers
+    assert "X-Profile-Id" not in client.get("/books").headers
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_slow_requests_are_logged_with_their_sql(client, monkeypatch, caplog):
+    monkeypatch.setattr(main.request_profiler, "slow_seconds", 0)
+
+    with caplog.at_level(logging.WARNING, logger=profiling.__name__):
+        client.get("/books", params={"author": "George Orwell"})
+
+    message = caplog.records[-1].getMessage()
+    assert message.startswith("Slow GET /books took ")
+    assert "1 SQL statement(s)" in message and "FROM books WHERE books.author = ?" in message
+
+
+def test_tasks_are_profiled_and_logged(config, monkeypatch, tmp_path, caplog):
+    monkeypatch.setattr(tasks, "database_config", config)
+    monkeypatch.setattr(tasks, "task_profiler", Profiler(str(tmp_path), slow_seconds=0))
+    monkeypatch.setattr(tasks, "profiled_tasks", {"src.tasks.reconcile_circulation_counters"})
+
+    with caplog.at_level(logging.WARNING, logger=profiling.__name__):
+        tasks.reconcile_circulation_counters.apply().get()
+
+    [profile_path] = tmp_path.iterdir()
+    assert "reconcile_circulation_counters" in function_names(profile_path)
+    assert caplog.records[-1].getMessage().startswith("Slow task src.tasks.reconcile_circulation_counters took ")
+
+
+def test_failed_statements_are_traced_without_leaking_state(config):
+    trace = Trace("failing work", None)
+    token = profiling.current_trace.set(trace)
+    try:
+        with config.engine.connect() as connection:
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM missing_table"))
+            connection.execute(text("SELECT 1"))
+            assert not any(key.endswith("_started") for key in connection.info)
+    finally:
+        profiling.current_trace.reset(token)
+
+    assert [statement for statement, _ in trace.statements] == ["SELECT * FROM missing_table", "SELECT 1"]
+    assert trace.statement_count == 2
@@ -0,0 +1,102 @@
+import pytest
+from sqlalchemy import create_engine, insert
+
+import main
+from src.cache import EntityCache, NullCache, MemoryCache
+from src.database_config import ReplicaSet, READ_PRIMARY_COOKIE
+from src.model import Base, Book
+
+REPLICA_URL = "sqlite:///./test_replica.db"
+UNREACHABLE_REPLICA_URL = "sqlite:////nonexistent-directory/replica.db"
+
+
+@pytest.fixture(scope="function")
+def replica_engine():
+    engine = create_engine(REPLICA_URL)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Book), [{"title": "Only on the replica", "author": "Author"}])
+    yield engine
+    Base.metadata.drop_all(bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture(scope="function", params=["sync", "async"])
+def config(request, replica_engine, make_config):
+    return make_config(async_mode=request.param == "async", replica_urls=[UNREACHABLE_REPLICA_URL, REPLICA_URL])
+
+
+@pytest.fixture(scope="function")
+def client(config, serve):
+    with serve(config, NullCache()) as test_client:
+        yield test_client
+
+
+def titles(response):
+    return [book["title"] for book in response.json()["items"]]
+
+
+def test_reads_go_to_a_replica_and_writes_to_the_primary(client):
+    response = client.post("/books/", json={"title": "1984", "author": "George Orwell"})
+    assert response.status_code == 200
+    client.cookies.clear()
+
+    assert titles(client.get("/books")) == ["Only on the replica"]
+    assert client.get(f"/books/{response.json()['id'] + 1}").status_code == 404
+
+
+def test_clients_read_their_own_writes_from_the_primary(client):
+    response = client.post("/books/", json={"title": "1984", "author": "George Orwell"})
+    assert READ_PRIMARY_COOKIE in response.cookies
+    assert titles(client.get("/books")) == ["1984"]
+
+    client.cookies.set(READ_PRIMARY_COOKIE, "0")
+    assert titles(client.get("/books")) == ["Only on the replica"]
+
+
+def test_stale_replica_reads_in_the_cache_are_not_served_to_the_writer(client, monkeypatch):
+    monkeypatch.setattr(main, "entity_cache", EntityCache(MemoryCache()))
+    book_id = client.post("/books/", json={"title": "1984", "author": "George Orwell"}).json()["id"]
+    client.cookies.clear()
+
+    # The replica lags behind: it still has its own book under that id, before and after the update
+    response = client.put(f"/books/{book_id}", json={"title": "Nineteen Eighty-Four"})
+    writer_cookies = dict(response.cookies)
+    client.cookies.clear()
+    assert client.get(f"/books/{book_id}").json()["title"] == "Only on the replica"
+
+    client.cookies.update(writer_cookies)
+    assert client.get(f"/books/{book_id}").json()["title"] == "Nineteen Eighty-Four"
+
+
+def test_unreachable_replicas_are_skipped(client, config):
+    for _ in range(3):
+        assert titles(client.get("/books")) == ["Only on the replica"]
+    unreachable, reachable = config.replicas.replicas
+    assert unreachable.down_until > 0
+    assert reachable.down_until == 0
+
+
+def test_reads_fall_back_to_the_primary(replica_engine, make_config, serve):
+    config = make_config(replica_urls=[UNREACHABLE_REPLICA_URL])
+    with serve(config, NullCache()) as client:
+        client.post("/books/", json={"title": "1984", "author": "George Orwell"})
+        client.cookies.clear()
+        assert titles(client.get("/books")) == ["1984"]
+    with config.read_session_scope() as db:
+        assert db.get_bind() is config.engine
+
+
+def test_replica_set_round_robin_and_retry():
+    class FakeReplica:
+        down_until = 0.0
+
+    now = [100.0]
+    first, second, third = FakeReplica(), FakeReplica(), FakeReplica()
+    replicas = ReplicaSet([first, second, third], retry_seconds=30, clock=lambda: now[0])
+
+    assert [replicas.candidates()[0] for _ in range(4)] == [first, second, third, first]
+    replicas.mark_down(second)
+    assert replicas.candidates() == [third, first]
+    now[0] += 31
+    assert replicas.candidates() == [third, first, second]
@@ -0,0 +1,63 @@
+from src.search import MemorySearchIndex, tokenize
+
+
+def test_tokenize_splits_and_lowercases():
+    assert tokenize("The Lord of the Rings: Fellowship") == ["the", "lord", "of", "the", "rings", "fellowship"]
+    assert tokenize(None) == []
+
+
+def test_search_ranks_title_matches_first_and_requires_all_tokens():
+    index = MemorySearchIndex()
+    index.add(1, "Orwell's Essays", "Someone Else", None)
+    index.add(2, "Animal Farm", "George Orwell", None)
+    index.add(3, "Homage to Catalonia", "George Orwell", None)
+
+    assert index.search("orwell", 10) == [1, 2, 3]
+    assert index.search("orw farm", 10) == [2]
+    assert index.search("orwell missing", 10) == []
+    assert index.search("", 10) == []
+
+
+def test_search_prefers_exact_token_over_prefix():
+    index = MemorySearchIndex()
+    index.add(1, "Dunes", "A", None)
+    index.add(2, "Dune", "B", None)
+
+    assert index.search("dune", 10) == [2, 1]
+
+
+def test_remove_and_re_add_keeps_index_consistent():
+    index = MemorySearchIndex()
+    index.add(1, "Dune", "Frank Herbert", "978-0-441-17271-9")
+    index.add(1, "Dune Messiah", "Frank Herbert", None)
+    assert index.search("messiah", 10) == [1]
+    assert index.search("9780441172719", 10) == []
+
+    index.remove(1)
+    assert len(index) == 0
+    assert index.search("dune", 10) == []
+
+
+def test_short_prefixes_match_among_many_tokens():
+    index = MemorySearchIndex()
+    index.add(1, "Harry Potter and the Philosopher's Stone", "J. K. Rowling", None)
+    for book_id in range(2, 300):
+        index.add(book_id, f"P{book_id} Harry", "Author", None)
+
+    assert index.search("harry po", 10) == [1]
+    assert index.search("harry p", 1) == [1]
+    assert index.search("p harry", 1) == [1]
+    assert len(index.search("p", 1000)) == 299
+
+
+def test_build_matches_adding_one_by_one():
+    rows = [(1, "Dune", "Frank Herbert", "978-0-441-17271-9"), (2, "Dune Messiah", "Frank Herbert", None),
+            (3, "Animal Farm", "George Orwell", None)]
+    added = MemorySearchIndex()
+    for row in rows:
+        added.add(*row)
+    built = MemorySearchIndex.build(rows)
+
+    assert built._sorted_tokens == added._sorted_tokens
+    for query in ("dune", "her", "f", "9780441172719", "orwell farm"):
+        assert built.search(query, 10) == added.search(query, 10)
@@ -0,0 +1,87 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import inspect
+from sqlalchemy.exc import OperationalError
+
+import main
+from main import app
+from src.database_config import DatabaseConfig
+from src import schema
+from src.schema import create_schema
+
+UNREACHABLE_URL = "sqlite:////nonexistent-directory/library.db"
+
+
+@pytest.fixture(scope="function", params=["sync", "async"])
+def lazy_config(request, make_config):
+    return make_config(async_mode=request.param == "async", create_schema=False, lazy=True)
+
+
+def test_lazy_config_creates_nothing_until_started():
+    config = DatabaseConfig(database_url=UNREACHABLE_URL, replica_urls=[UNREACHABLE_URL], create_schema=False,
+                            lazy=True)
+    assert config.engine is None and len(config.replicas) == 0
+
+    # Creating the engines doesn't connect either
+    config.init_engines()
+    assert config.engine is not None and len(config.replicas) == 1
+    with pytest.raises(OperationalError):
+        config.create_schema()
+
+
+async def wait_for_warmup():
+    await app.state.warmup
+
+
+def test_lifespan_creates_the_schema_and_prewarms_the_pool(lazy_config, monkeypatch):
+    monkeypatch.setattr(main, "database_config", lazy_config)
+    monkeypatch.setenv("CREATE_SCHEMA_ON_STARTUP", "true")
+    monkeypatch.setenv("DB_POOL_PREWARM", "2")
+
+    with TestClient(app) as client:
+        assert "books" in inspect(lazy_config.engine).get_table_names()
+        client.portal.call(wait_for_warmup)
+        assert client.get("/healthz").json() == {"status": "ok"}
+        assert client.get("/readyz").json() == {"status": "ready"}
+
+
+def test_not_ready_while_the_database_is_unreachable(monkeypatch):
+    monkeypatch.setattr(main, "database_config", DatabaseConfig(database_url=UNREACHABLE_URL, create_schema=False,
+                                                                lazy=True))
+
+    with TestClient(app) as client:
+        assert client.get("/healthz").status_code == 200
+        response = client.get("/readyz")
+
+    assert response.status_code == 503
+    assert response.json() == {"status": "unavailable"}
+
+
+def test_schema_step_retries_until_the_deadline():
+    sleeps = []
+
+    with pytest.raises(OperationalError):
+        create_schema(DatabaseConfig(database_url=UNREACHABLE_URL, create_schema=False, lazy=True),
+                      wait_seconds=0.05, sleep=sleeps.append)
+
+    assert sleeps
+
+
+def test_schema_step_reports_a_missing_database_url(monkeypatch, capsys):
+    monkeypatch.setattr(schema, "load_dotenv", lambda: None)
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    monkeypatch.setattr("sys.argv", ["schema"])
+
+    with pytest.raises(SystemExit):
+        schema.main()
+
+    assert "DATABASE_URL is not set" in capsys.readouterr().err
+
+
+def test_schema_step_fails_with_the_connection_error(monkeypatch):
+    monkeypatch.setattr(schema, "load_dotenv", lambda: None)
+    monkeypatch.setenv("DATABASE_URL", UNREACHABLE_URL)
+    monkeypatch.setattr("sys.argv", ["schema"])
+
+    with pytest.raises(OperationalError):
+        schema.main()
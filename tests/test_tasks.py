@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from src import tasks, circulation
+from src.database_config import DatabaseConfig
+from src.mailer import Mailer
+from src.model import Base, Book, Patron, WeeklyReport
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test_tasks.db"
+
+
+@pytest.fixture(scope="function")
+def database_config(monkeypatch):
+    config = DatabaseConfig(database_url=SQLALCHEMY_DATABASE_URL)
+    monkeypatch.setattr(tasks, "database_config", config)
+    yield config
+    Base.metadata.drop_all(bind=config.engine)
+    config.engine.dispose()
+
+
+class RecordingTransport:
+    def __init__(self, emails):
+        self.emails = emails
+
+    def send(self, email):
+        self.emails.append((email.to, email.subject, email.body))
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(scope="function")
+def sent_emails(monkeypatch):
+    emails = []
+    monkeypatch.setattr(tasks, "mailer", Mailer(RecordingTransport(emails), rate_per_second=0))
+    return emails
+
+
+def add_loans(database_config):
+    now = datetime.utcnow()
+    with database_config.session_scope() as db:
+        john = Patron(name="John Doe", email="john.doe@gmail.com", membership_start_date=now)
+        jane = Patron(name="Jane Doe", email="jane.doe@gmail.com", membership_start_date=now)
+        db.add_all([john, jane])
+        db.flush()
+        db.add_all([
+            Book(title="1984", author="George Orwell", is_checked_out=True, patron_id=john.id,
+                 due_date=now - timedelta(days=3)),
+            Book(title="Animal Farm", author="George Orwell", is_checked_out=True, patron_id=john.id,
+                 due_date=now - timedelta(days=1)),
+            Book(title="Brave New World", author="Aldous Huxley", is_checked_out=True, patron_id=jane.id,
+                 due_date=now - timedelta(days=2)),
+            Book(title="Dune", author="Frank Herbert", is_checked_out=True, patron_id=jane.id,
+                 due_date=now + timedelta(days=2)),
+            Book(title="Emma", author="Jane Austen", is_checked_out=False),
+        ])
+        db.commit()
+
+
+def test_send_overdue_reminders_sends_one_digest_per_patron(database_config, sent_emails):
+    add_loans(database_config)
+
+    stats = tasks.send_overdue_reminders.apply(kwargs={"chunk_size": 1}).get()
+
+    assert (stats["patrons"], stats["chunks"], stats["books"]) == (2, 2, 3)
+    assert sorted(to for to, _, _ in sent_emails) == ["jane.doe@gmail.com", "john.doe@gmail.com"]
+    john_digest = next(body for to, _, body in sent_emails if to == "john.doe@gmail.com")
+    assert john_digest.index("1984") < john_digest.index("Animal Farm")
+    assert "Dune" not in "".join(body for _, _, body in sent_emails)
+
+
+def test_overdue_digests_are_sent_once_a_day(database_config, sent_emails):
+    add_loans(database_config)
+
+    tasks.send_overdue_reminders.apply()
+    stats = tasks.send_overdue_reminders.apply().get()
+
+    assert (stats["sent"], stats["duplicates"]) == (0, 2)
+    assert len(sent_emails) == 2
+
+
+def test_send_overdue_reminders_without_overdue_books(database_config, sent_emails):
+    stats = tasks.send_overdue_reminders.apply().get()
+
+    assert (stats["patrons"], stats["books"]) == (0, 0)
+    assert sent_emails == []
+
+
+def test_generate_weekly_reports_stores_counters(database_config):
+    add_loans(database_config)
+    with database_config.session_scope() as db:
+        drift = circulation.reconcile(db)
+    assert drift["total"] == (0, 5)
+
+    tasks.generate_weekly_reports.apply()
+
+    with database_config.session_scope() as db:
+        report = db.query(WeeklyReport).one()
+    assert (report.total, report.in_library, report.checked_out) == (5, 1, 4)
+    assert (report.overdue, report.overdue_1_7_days) == (3, 3)
@@ -0,0 +1,71 @@
+import pytest
+
+from src import validation
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    validation.clear_caches()
+    yield
+    validation.clear_caches()
+
+
+@pytest.fixture
+def dns_lookups(monkeypatch):
+    lookups = []
+
+    def fake_lookup(ascii_domain, domain, timeout=None):
+        lookups.append(ascii_domain)
+        if ascii_domain == "nowhere-at-all.com":
+            raise validation.EmailNotValidError("The domain name nowhere-at-all.com does not exist.")
+        return {"mx": [(10, f"mx.{ascii_domain}")]}
+
+    monkeypatch.setattr(validation, "validate_email_deliverability", fake_lookup)
+    return lookups
+
+
+def test_is_valid_isbn():
+    assert validation.is_valid_isbn("0-8436-1072-7")
+    assert validation.is_valid_isbn("978-0-596-52068-7")
+    assert not validation.is_valid_isbn("0-8436-1072-8")
+    assert not validation.is_valid_isbn("123")
+
+
+def test_syntax_mode_never_touches_dns(dns_lookups):
+    assert validation.is_valid_email("john.doe@gmail.com", mode=validation.SYNTAX)
+    assert not validation.is_valid_email("not-an-email", mode=validation.SYNTAX)
+    assert dns_lookups == []
+
+
+def test_deliverability_mode_caches_domains(dns_lookups):
+    assert validation.is_valid_email("john.doe@gmail.com", mode=validation.DELIVERABILITY)
+    assert validation.is_valid_email("jane.doe@gmail.com", mode=validation.DELIVERABILITY)
+    assert not validation.is_valid_email("john@nowhere-at-all.com", mode=validation.DELIVERABILITY)
+    assert not validation.is_valid_email("john@nowhere-at-all.com", mode=validation.DELIVERABILITY)
+    assert dns_lookups == ["gmail.com", "nowhere-at-all.com"]
+
+
+def test_domain_cache_expires(dns_lookups, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(validation.validator(), "domain_cache",
+                        validation.DomainCache(ttl_seconds=60, clock=lambda: now[0]))
+    validation.is_valid_email("john.doe@gmail.com", mode=validation.DELIVERABILITY)
+    now[0] = 61
+    validation.is_valid_email("john.doe@gmail.com", mode=validation.DELIVERABILITY)
+    assert dns_lookups == ["gmail.com", "gmail.com"]
+
+
+def test_validate_emails_looks_up_each_domain_once(dns_lookups):
+    emails = ["a@gmail.com", "b@gmail.com", "c@nowhere-at-all.com", "invalid", "d@example.org"]
+    assert validation.validate_emails(emails, mode=validation.DELIVERABILITY) == [True, True, False, False, True]
+    assert sorted(dns_lookups) == ["example.org", "gmail.com", "nowhere-at-all.com"]
+    assert validation.validate_emails(emails, mode=validation.SYNTAX) == [True, True, True, False, True]
+
+
+def test_settings_are_read_on_first_use(monkeypatch):
+    monkeypatch.setattr(validation, "_validator", None)
+    monkeypatch.setenv("EMAIL_VALIDATION_MODE", validation.DELIVERABILITY)
+    monkeypatch.setenv("DOMAIN_CACHE_TTL_SECONDS", "60")
+
+    assert validation.validator().email_mode == validation.DELIVERABILITY
+    assert validation.validator().domain_cache.ttl_seconds == 60